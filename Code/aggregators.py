@@ -0,0 +1,237 @@
+""" Vectorized aggregators used to downsample the GSOD data.
+
+An aggregator reduces an array along its time axis over contiguous segments
+(the periods of time, or buckets, of a downsampling), all segments and all
+the other dimensions (stations, measurements) at once. The segments are
+given by the positions where they start along the axis.
+
+The built-in aggregators are listed in AGGREGATORS by the name of the
+downsampling method they implement. Parametrized ones (WeightedAverage,
+Quantile, RandomSample) can be passed directly as downsampling methods.
+"""
+
+import numpy as np
+
+def segment_reduce(values, starts, method = "average", axis = 0):
+    """ Reduce values along axis over the contiguous segments beginning at
+    starts, with 'average', 'std', 'min' or 'max', ignoring the NaN values as
+    pandas does: a segment without values gives NaN, as well as a segment
+    with less than 2 values for the (unbiased) std. The sums are accumulated
+    in double precision.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind != "f":
+        values = values.astype(np.float64)
+    if method == "min":
+        return np.fmin.reduceat(values, starts, axis = axis)
+    elif method == "max":
+        return np.fmax.reduceat(values, starts, axis = axis)
+    missing = np.isnan(values)
+    counts = np.add.reduceat(~missing, starts, axis = axis, dtype = np.int64)
+    sums = np.add.reduceat(np.where(missing, 0, values), starts, axis = axis,
+                           dtype = np.float64)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        means = sums / counts
+        if method == "average":
+            return means
+        elif method != "std":
+            raise NotImplementedError("This downsampling method (%s) is not a"
+                                      " segmented reduction." % method)
+        # Deviations from the mean of their segment (2 passes, for accuracy)
+        lengths = np.diff(np.append(starts, values.shape[axis]))
+        deviations = np.where(missing, 0.,
+                              values - np.repeat(means, lengths, axis = axis))
+        variances = (np.add.reduceat(deviations**2, starts, axis = axis)
+                     / (counts - 1))
+    variances[counts < 2] = np.nan
+    return np.sqrt(variances)
+
+def segment_lengths(starts, num_rows):
+    return np.diff(np.append(starts, num_rows))
+
+def segment_table(values, starts, axis = 0):
+    """ Lay the segments of values out as the rows of a table padded with
+    NaN. Returns the table (segment x position in the segment x other
+    dimensions) and the length of each segment.
+    """
+    values = np.rollaxis(np.asarray(values), axis)
+    lengths = segment_lengths(starts, len(values))
+    segments = np.repeat(np.arange(len(starts)), lengths)
+    positions = np.arange(len(values)) - np.repeat(starts, lengths)
+    dtype = values.dtype if values.dtype.kind == "f" else np.float64
+    table = np.empty((len(starts), lengths.max()) + values.shape[1:],
+                     dtype = dtype)
+    table.fill(np.nan)
+    table[segments, positions] = values
+    return table, lengths
+
+def pick(table, positions):
+    """ Value at a position of each segment of a table (see segment_table),
+    for each of the other dimensions: positions has the shape of the table
+    without its second dimension.
+    """
+    num_segments, width = table.shape[:2]
+    other_shape = table.shape[2:]
+    num_others = int(np.prod(other_shape))
+    flat = table.reshape(num_segments, width, num_others)
+    picked = flat[np.arange(num_segments)[:, np.newaxis],
+                  positions.reshape(num_segments, num_others),
+                  np.arange(num_others)[np.newaxis, :]]
+    return picked.reshape((num_segments,) + other_shape)
+
+def _expand(segment_values, ndim):
+    """ Broadcast an array of values per segment (and position) over the
+    other dimensions of an array with ndim dimensions.
+    """
+    return segment_values.reshape(segment_values.shape +
+                                  (1,) * (ndim - segment_values.ndim))
+
+def _restore_axis(result, axis):
+    """ Move the segments of a result computed with the time axis first back
+    to axis.
+    """
+    return np.rollaxis(result, 0, axis+1)
+
+class Aggregator(object):
+    """ Base class of the aggregators: reduce(values, starts, axis) returns
+    the values reduced over the segments of axis beginning at starts.
+    """
+    def reduce(self, values, starts, axis = 0):
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return "%s()" % self.__class__.__name__
+
+class SegmentReduction(Aggregator):
+    """ NaN-aware average, std, min or max (see segment_reduce).
+    """
+    def __init__(self, method):
+        self.method = method
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.method)
+
+    def reduce(self, values, starts, axis = 0):
+        return segment_reduce(values, starts, self.method, axis)
+
+class Count(Aggregator):
+    """ Number of values (not NaN) in each segment.
+    """
+    def reduce(self, values, starts, axis = 0):
+        values = np.asarray(values)
+        if values.dtype.kind != "f":
+            return np.add.reduceat(np.ones_like(values, dtype = np.int64),
+                                   starts, axis = axis)
+        return np.add.reduceat(~np.isnan(values), starts, axis = axis,
+                               dtype = np.int64)
+
+class First(Aggregator):
+    """ First value of each segment (NaN if missing).
+    """
+    def reduce(self, values, starts, axis = 0):
+        return np.asarray(values).take(starts, axis = axis)
+
+class Last(Aggregator):
+    """ Last value of each segment (NaN if missing).
+    """
+    def reduce(self, values, starts, axis = 0):
+        values = np.asarray(values)
+        ends = starts + segment_lengths(starts, values.shape[axis]) - 1
+        return values.take(ends, axis = axis)
+
+class RandomSample(Aggregator):
+    """ Value of a random day of each segment, drawn independently for each
+    of the other dimensions. Reproducible if a seed is provided.
+    """
+    def __init__(self, seed = None):
+        self.seed = seed
+        self.random_state = np.random.RandomState(seed)
+
+    def __repr__(self):
+        return "%s(seed = %r)" % (self.__class__.__name__, self.seed)
+
+    def reduce(self, values, starts, axis = 0):
+        values = np.rollaxis(np.asarray(values), axis)
+        lengths = segment_lengths(starts, len(values))
+        shape = (len(starts),) + values.shape[1:]
+        draws = self.random_state.random_sample(shape)
+        rows = (_expand(starts, len(shape)) +
+                (draws * _expand(lengths, len(shape))).astype(np.int64))
+        num_others = int(np.prod(values.shape[1:]))
+        flat = values.reshape(len(values), num_others)
+        picked = flat[rows.reshape(len(starts), num_others),
+                      np.arange(num_others)[np.newaxis, :]]
+        return _restore_axis(picked.reshape(shape), axis)
+
+class Quantile(Aggregator):
+    """ Quantile q (between 0 and 1) of the values of each segment, ignoring
+    NaN, interpolated linearly between the values around it. NaN if the
+    segment has no value.
+    """
+    def __init__(self, q = 0.5):
+        self.q = q
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.q)
+
+    def reduce(self, values, starts, axis = 0):
+        table, lengths = segment_table(values, starts, axis)
+        # NaN values are sorted last
+        table.sort(axis = 1)
+        counts = (~np.isnan(table)).sum(axis = 1)
+        positions = self.q * (np.maximum(counts, 1) - 1)
+        below = np.floor(positions).astype(np.int64)
+        above = np.ceil(positions).astype(np.int64)
+        low = pick(table, below)
+        result = low + (pick(table, above) - low) * (positions - below)
+        result[counts == 0] = np.nan
+        return _restore_axis(result, axis)
+
+class WeightedAverage(Aggregator):
+    """ Average of the values of each segment weighted by weights, for the
+    segments with as many days as weights (weeks for 7 weights). The other
+    segments (incomplete periods) are averaged without weights. The missing
+    values are ignored: the weights of the values present are normalized.
+    """
+    def __init__(self, weights):
+        self.weights = np.asarray(weights, dtype = np.float64)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.weights.tolist())
+
+    def reduce(self, values, starts, axis = 0):
+        table, lengths = segment_table(values, starts, axis)
+        width = table.shape[1]
+        weights = np.ones((len(starts), width))
+        num_weights = len(self.weights)
+        if num_weights <= width:
+            weights[lengths == num_weights, :num_weights] = self.weights
+        weights = _expand(weights, table.ndim)
+        present = ~np.isnan(table)
+        totals = (np.where(present, table, 0) * weights).sum(axis = 1)
+        total_weights = (present * weights).sum(axis = 1)
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            result = totals / total_weights
+        return _restore_axis(result, axis)
+
+# Built-in downsampling methods
+AGGREGATORS = {"average": SegmentReduction("average"),
+               "std": SegmentReduction("std"),
+               "min": SegmentReduction("min"),
+               "max": SegmentReduction("max"),
+               "first": First(),
+               "last": Last(),
+               "rand_sample": RandomSample(),
+               "count": Count(),
+               "median": Quantile(0.5)}
+
+def get_aggregator(method):
+    """ Aggregator implementing a downsampling method: the name of a
+    built-in method or an Aggregator. None for other methods (custom
+    callables).
+    """
+    if isinstance(method, Aggregator):
+        return method
+    if isinstance(method, basestring):
+        return AGGREGATORS.get(method)
+    return None
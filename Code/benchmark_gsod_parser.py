@@ -0,0 +1,76 @@
+""" Benchmark of the vectorized GSOD parser against the previous regex based
+pandas.read_table parsing.
+
+Usage: python benchmark_gsod_parser.py [GSOD file (.op or .op.gz)]
+Without a file, a synthetic station file covering 30 years is generated.
+"""
+
+import sys
+import time
+import datetime
+from cStringIO import StringIO
+
+import numpy as np
+import pandas
+
+from extend_pandas import GSOD_DATA_FILE_COLS
+from file_sys_util import open_data_file
+from gsod_parser import parse_gsod_buffer, records2pandas
+
+HEADER = ("STN--- WBAN   YEARMODA    TEMP       DEWP      SLP        STP       "
+          "VISIB      WDSP     MXSPD   GUST    MAX     MIN   PRCP   SNDP   "
+          "FRSHTT\n")
+LINE = ("%06d %05d  %s  %6.1f %2d  %6.1f %2d  %6.1f %2d  %6.1f %2d  %5.1f %2d "
+        " %5.1f %2d  %5.1f  %5.1f  %6.1f%s %6.1f%s %5.2f%s %5.1f  %06d\n")
+
+def synthetic_gsod_file(num_days = 30*365):
+    """ Generate the content of a GSOD station file with random values.
+    """
+    start = datetime.date(1980, 1, 1)
+    lines = [HEADER]
+    for i in xrange(num_days):
+        day = start + datetime.timedelta(days = i)
+        lines.append(LINE % (10010, 99999, day.strftime("%Y%m%d"),
+                             np.random.uniform(-20, 100), 24,
+                             np.random.uniform(-20, 80), 24,
+                             np.random.uniform(980, 1040), 24, 9999.9, 0,
+                             np.random.uniform(0, 30), 6,
+                             np.random.uniform(0, 40), 24,
+                             np.random.uniform(0, 60), 999.9,
+                             np.random.uniform(0, 100), "*",
+                             np.random.uniform(-20, 80), " ",
+                             np.random.uniform(0, 3), "ABCDEFGHI "[i % 10],
+                             999.9, 10000*(i % 2)))
+    return "".join(lines)
+
+def regex_read_table(content):
+    """ Parsing done by datafile2pandas before the vectorized parser.
+    """
+    return pandas.read_table(StringIO(content), sep="\s*", index_col=2,
+                             parse_dates = True, names = GSOD_DATA_FILE_COLS,
+                             skiprows = [0])
+
+def time_it(func, content, repeat = 3):
+    best = np.inf
+    for i in range(repeat):
+        t0 = time.time()
+        func(content)
+        best = min(best, time.time()-t0)
+    return best
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open_data_file(sys.argv[1]) as f_in:
+            content = f_in.read()
+    else:
+        content = synthetic_gsod_file()
+    num_rows = content.count("\n") - 1
+
+    results = [("pandas.read_table (regex)", time_it(regex_read_table, content)),
+               ("vectorized parser (records)", time_it(parse_gsod_buffer, content)),
+               ("vectorized parser (DataFrame)",
+                time_it(lambda x: records2pandas(parse_gsod_buffer(x)), content))]
+    print "Parsing %s rows:" % num_rows
+    for name, duration in results:
+        print "%-32s %10.0f rows/sec  %6.1fx" % (name, num_rows/duration,
+                                                 results[0][1]/duration)
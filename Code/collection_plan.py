@@ -0,0 +1,194 @@
+""" Planning of the collection of GSOD station files.
+
+Before any file is read or retrieved, the station-years requested are matched
+against the station metadata (range of years of data in the ish-history
+file), the local files, the yearly tar archives and the local caches, to work
+out where each one will come from:
+- local: op or op.gz file on disk,
+- archive: member of the yearly tar archive on disk,
+- remote: to retrieve from the data source,
+- unavailable: known not to exist (outside of the years of data of the
+  station, recorded missing, absent from the yearly archive) or remote while
+  not connected.
+Only one listing of each year folder is done, instead of probing every file.
+"""
+
+import os
+from collections import namedtuple
+
+from retrieve_remote import info2filepath, PARTIAL_SUFFIX
+from file_sys_util import tar_member_index
+from local_cache import ish_year_range, outside_year_range
+
+# Sources of the station files
+LOCAL = "local"
+ARCHIVE = "archive"
+REMOTE = "remote"
+UNAVAILABLE = "unavailable"
+SOURCES = [LOCAL, ARCHIVE, REMOTE, UNAVAILABLE]
+
+# Estimated size of a gzipped station file retrieved from NCDC, for a full
+# year of data (365 lines of 139 characters compress about 4 times)
+ESTIMATED_REMOTE_FILE_SIZE = 13000
+
+# One station-year of a plan:
+# - source: one of SOURCES,
+# - filepath: local path of the file to read (op or op.gz file, or path of the
+#   member for the archive source, destination of the retrieval for the
+#   remote source),
+# - tar_filepath: yearly tar archive containing the file (archive source),
+# - nbytes: size of the file to read or (estimated) to retrieve,
+# - parsed: True if its records are in the cache of parsed records,
+# - reason: why it is unavailable.
+PlannedFile = namedtuple("PlannedFile", ["year", "location_WMO",
+                                         "location_WBAN", "source", "filepath",
+                                         "tar_filepath", "nbytes", "parsed",
+                                         "reason"])
+
+class CollectionPlan(object):
+    """ Station-years to collect and where each one comes from. Built by
+    plan_collection.
+    """
+    def __init__(self, years, stations, entries):
+        self.years = years
+        # Metadata of the stations requested (rows of the ish-history data)
+        self.stations = stations
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def select(self, year = None, source = None):
+        """ Entries of the plan for a year and/or a source.
+        """
+        return [entry for entry in self.entries
+                if (year is None or entry.year == year) and
+                   (source is None or entry.source == source)]
+
+    def counts(self):
+        """ Number of station-years per source.
+        """
+        counts = dict((source, 0) for source in SOURCES)
+        for entry in self.entries:
+            counts[entry.source] += 1
+        return counts
+
+    def expected_bytes(self):
+        """ Number of bytes to read (local, archive) or retrieve (remote) per
+        source. The size of the remote files is an estimate.
+        """
+        nbytes = dict((source, 0) for source in SOURCES)
+        for entry in self.entries:
+            nbytes[entry.source] += entry.nbytes
+        return nbytes
+
+    def remote_files(self, year = None):
+        """ (remote_target, local_filepath) pairs of the files to retrieve.
+        """
+        return [(os.path.join(str(entry.year),
+                              os.path.basename(entry.filepath)),
+                 entry.filepath)
+                for entry in self.select(year, REMOTE)]
+
+    def summary(self):
+        counts = self.counts()
+        nbytes = self.expected_bytes()
+        lines = ["Collection of %s stations over %s years: %s station-years."
+                 % (len(self.stations), len(self.years), len(self))]
+        for source in SOURCES:
+            lines.append("  %-12s %6s files %12s bytes"
+                         % (source, counts[source], nbytes[source]))
+        num_parsed = len([entry for entry in self.entries if entry.parsed])
+        lines.append("  %s files already parsed in the cache." % num_parsed)
+        return "\n".join(lines)
+
+    __str__ = summary
+
+def plan_collection(years, stations, internet_connected = True,
+                    missing_cache = None, record_cache = None, manifest = None):
+    """ Work out where the GSOD file of each station and year requested will
+    come from, without reading or retrieving anything.
+
+    Inputs:
+    - years, list(int). The years requested.
+    - stations, struct array. Metadata of the stations requested (rows of the
+      ish-history data as returned by read_ish_history).
+    - internet_connected, bool. If False, the files not available locally are
+      unavailable.
+    - missing_cache, MissingFileCache. Files known not to exist are
+      unavailable.
+    - record_cache, ParsedRecordCache. Used to flag the files already parsed.
+    - manifest, DownloadManifest. Retrieved files are only local if recorded
+      complete in it.
+
+    Returns a CollectionPlan.
+    """
+    begin, end = ish_year_range(stations)
+    # Last year covered by the ish-history data: the stations may have data
+    # after their END year from then on
+    if missing_cache is not None and missing_cache.history_end is not None:
+        history_end = missing_cache.history_end
+    else:
+        known = (begin > 0) & (end > 0)
+        history_end = end[known].max() if known.any() else None
+    locations = zip(stations["USAF"].tolist(), stations["WBAN"].tolist())
+    entries = []
+    for year in years:
+        folder_location = os.path.join("Data", "GSOD", "gsod_"+str(year))
+        if os.path.isdir(folder_location):
+            local_files = set(os.listdir(folder_location))
+        else:
+            local_files = set()
+
+        def is_local(filename):
+            if filename not in local_files:
+                return False
+            if manifest is None:
+                return filename+PARTIAL_SUFFIX not in local_files
+            return manifest.is_present(os.path.join(folder_location, filename))
+
+        tar_filename = info2filepath(year)
+        tar_filepath = None
+        if is_local(tar_filename):
+            tar_filepath = os.path.join(folder_location, tar_filename)
+            members = tar_member_index(tar_filepath)
+        # Known range of years of data of each station (see
+        # MissingFileCache.is_missing)
+        out_of_range = outside_year_range(year, begin, end, history_end)
+        for (location_WMO, location_WBAN), excluded in zip(locations,
+                                                           out_of_range):
+            filename = info2filepath(year, location_WMO, location_WBAN)
+            filepath = os.path.join(folder_location, filename)
+            parsed = (record_cache is not None and
+                      record_cache.has(location_WMO, location_WBAN, year))
+            archive = None
+            reason = None
+            if excluded:
+                source, nbytes = UNAVAILABLE, 0
+                reason = "outside of the years of data of the station"
+            elif is_local(filename) or is_local(filename+".gz"):
+                if not is_local(filename):
+                    filepath += ".gz"
+                source, nbytes = LOCAL, os.path.getsize(filepath)
+            elif tar_filepath is not None:
+                filepath += ".gz"
+                if filename+".gz" in members:
+                    source, nbytes = ARCHIVE, members[filename+".gz"][1]
+                    archive = tar_filepath
+                else:
+                    source, nbytes = UNAVAILABLE, 0
+                    reason = "missing from the yearly archive"
+            elif (missing_cache is not None and
+                  missing_cache.is_missing(location_WMO, location_WBAN, year)):
+                source, nbytes = UNAVAILABLE, 0
+                reason = "recorded missing on the data source"
+            elif internet_connected:
+                filepath += ".gz"
+                source, nbytes = REMOTE, ESTIMATED_REMOTE_FILE_SIZE
+            else:
+                source, nbytes = UNAVAILABLE, 0
+                reason = "not available locally"
+            entries.append(PlannedFile(year, location_WMO, location_WBAN,
+                                       source, filepath, archive, nbytes,
+                                       parsed, reason))
+    return CollectionPlan(list(years), stations, entries)
@@ -0,0 +1,351 @@
+""" Incremental downsampling of the GSOD data as new days arrive.
+
+Instead of downsampling the whole history again every time new daily data is
+appended, running aggregates of each bucket (period of time of an offset, see
+extend_pandas.time_bucket_keys) are kept for each station and measurement:
+the sum, number, minimum, maximum and sum of squares of their values. New
+rows only update the buckets they fall in, and the 'average', 'std', 'min'
+and 'max' downsamplings are read from the aggregates, without going through
+the daily data again.
+
+The buckets are grouped in chunks of consecutive buckets (about a year of
+data, see BUCKETS_PER_CHUNK), allocated as they are needed and stored in
+separate files: appending new days only updates and writes the chunks of
+their buckets. The last day appended of each station is recorded, and the
+days up to it are ignored when they are appended again, so that the data of
+the current year can be collected and appended again every day.
+
+The aggregates of an offset are held by a DownsampleAggregates, and those
+of several offsets stored on disk by an AggregateStore:
+
+    store = AggregateStore()
+    store.append(new_days_cube)
+    monthly_average = store.downsample("average", "unique_month")
+"""
+
+import json
+import os
+
+import numpy as np
+
+from station_cube import StationCube, to_day
+from file_sys_util import atomic_write
+from extend_pandas import time_bucket_keys, bucket_label, bucket_starts
+
+# Location of the stored aggregates
+AGGREGATES_FOLDER = os.path.join("Data", "GSOD", "aggregates")
+
+# Offsets maintained by default by an AggregateStore
+DEFAULT_OFFSETS = ["unique_week", "unique_month", "year"]
+
+# Methods that can be read from the aggregates
+AGGREGATE_METHODS = ["average", "std", "min", "max"]
+
+# Number of consecutive buckets stored together, by offset (int offsets:
+# a year of days)
+BUCKETS_PER_CHUNK = {"unique_week": 52, "month": 12, "unique_month": 12,
+                     "year": 1}
+
+# Aggregates of a chunk and the value of an empty bucket
+AGGREGATE_FILLS = [("count", 0), ("total", 0.), ("squares", 0.),
+                   ("minimum", np.nan), ("maximum", np.nan)]
+
+# Last day appended of the stations without data yet
+NO_DAY = np.iinfo(np.int64).min
+
+def buckets_per_chunk(offset):
+    if isinstance(offset, int):
+        return max(1, 365 // offset)
+    return BUCKETS_PER_CHUNK[offset]
+
+class DownsampleAggregates(object):
+    """ Running aggregates of the values of stations and measurements over
+    the buckets of an offset. Each chunk of buckets holds arrays (station x
+    bucket of the chunk x measurement) and the buckets of the chunk that
+    received data. Chunks are loaded from folder as they are needed if the
+    aggregates were stored.
+
+    For 'unique_week' and int offsets, the buckets are counted from origin,
+    the first date appended by default: the results match the ones of
+    downsample on data starting at that date. The data of each station must
+    be appended in chronological order: the days up to the last day with
+    values appended for a station are ignored.
+    """
+    def __init__(self, offset = "unique_week", origin = None, folder = None):
+        self.offset = offset
+        self.origin = origin
+        self.folder = folder
+        self.chunk_size = buckets_per_chunk(offset)
+        self.stations = []
+        self.measurements = []
+        # Last day appended for each station, as a number of days since 1970
+        self.last_days = np.array([], dtype = np.int64)
+        # Chunk id -> dict of arrays: the aggregates and "present"
+        self.chunks = {}
+        # Ids of all the chunks, in memory or stored
+        self.chunk_ids = set()
+        self._modified_chunks = set()
+
+    def __repr__(self):
+        return ("<%s %r: %s stations x %s chunks of %s buckets x %s "
+                "measurements>" % (self.__class__.__name__, self.offset,
+                                   len(self.stations), len(self.chunk_ids),
+                                   self.chunk_size, len(self.measurements)))
+
+    def append(self, data, station = None):
+        """ Update the aggregates with new daily data: a StationCube, or a
+        DataFrame (date x measurement) of the station station. Only the
+        chunks of the buckets of the new dates are updated. The days already
+        appended for a station are ignored.
+
+        Returns whether any new day was aggregated.
+        """
+        if not isinstance(data, StationCube):
+            data = StationCube.from_frames({station: data})
+        if not data.daily:
+            raise ValueError("Only daily data can be aggregated.")
+        # The int measurements are aggregated as floats
+        data = data.as_float()
+        if len(data.dates) == 0 or len(data.stations) == 0:
+            return False
+        rows = self._positions("stations", data.stations.tolist())
+        layers = self._positions("measurements", data.measurements)
+        if len(self.last_days) < len(self.stations):
+            self.last_days = np.concatenate((self.last_days,
+                np.repeat(NO_DAY, len(self.stations) - len(self.last_days))))
+
+        # Days not appended yet for each station
+        days = data.dates.astype(np.int64)
+        new = days[np.newaxis, :] > self.last_days[rows][:, np.newaxis]
+        new_days = new.any(axis = 0)
+        if not new_days.any():
+            return False
+        dates = data.dates[new_days]
+        values = np.where(new[:, new_days, np.newaxis],
+                          data.values[:, new_days], np.nan)
+        with_values = new[:, new_days] & ~np.isnan(values).all(axis = 2)
+        last_days = np.where(with_values, days[new_days], NO_DAY).max(axis = 1)
+        self.last_days[rows] = np.maximum(self.last_days[rows], last_days)
+
+        if self.origin is None:
+            self.origin = dates[0]
+        keys = time_bucket_keys(dates, self.offset, self.origin)
+        if np.any(keys[1:] < keys[:-1]):
+            # The months of all years: the dates of a bucket are gathered
+            order = np.argsort(keys, kind = "mergesort")
+            keys = keys[order]
+            values = values.take(order, axis = 1)
+        starts = bucket_starts(keys)
+
+        # Aggregates of the new data, over the buckets it covers
+        missing = np.isnan(values)
+        filled = np.where(missing, 0, values).astype(np.float64)
+        new_aggregates = {
+            "count": np.add.reduceat(~missing, starts, axis = 1,
+                                     dtype = np.int64),
+            "total": np.add.reduceat(filled, starts, axis = 1),
+            "squares": np.add.reduceat(filled**2, starts, axis = 1),
+            "minimum": np.fmin.reduceat(values, starts, axis = 1),
+            "maximum": np.fmax.reduceat(values, starts, axis = 1)}
+
+        bucket_keys = keys[starts]
+        bucket_chunks = bucket_keys // self.chunk_size
+        for chunk_id in np.unique(bucket_chunks).tolist():
+            buckets = np.flatnonzero(bucket_chunks == chunk_id)
+            positions = bucket_keys[buckets] - chunk_id * self.chunk_size
+            chunk = self._chunk(chunk_id)
+            index = np.ix_(rows, positions, layers)
+            for name in ["count", "total", "squares"]:
+                chunk[name][index] += new_aggregates[name][:, buckets]
+            for name, reduction in [("minimum", np.fmin),
+                                    ("maximum", np.fmax)]:
+                chunk[name][index] = reduction(chunk[name][index],
+                                               new_aggregates[name][:, buckets])
+            chunk["present"][positions] = True
+            self._modified_chunks.add(chunk_id)
+        return True
+
+    def _positions(self, axis, names):
+        """ Positions of the stations or measurements names, adding the ones
+        not aggregated yet (as "stations" or "measurements").
+        """
+        known = getattr(self, axis)
+        positions = dict((name, i) for i, name in enumerate(known))
+        for name in names:
+            if name not in positions:
+                positions[name] = len(known)
+                known.append(name)
+        return [positions[name] for name in names]
+
+    def _chunk_filepath(self, folder, chunk_id):
+        return os.path.join(folder, "chunk_%s.npz" % chunk_id)
+
+    def _chunk(self, chunk_id):
+        """ Aggregates of a chunk of buckets, covering all the stations and
+        measurements. Loaded from the folder of the aggregates if stored,
+        created empty if new.
+        """
+        chunk = self.chunks.get(chunk_id)
+        if chunk is None:
+            chunk = {}
+            if chunk_id in self.chunk_ids and self.folder is not None:
+                content = np.load(self._chunk_filepath(self.folder, chunk_id))
+                try:
+                    for name in content.files:
+                        chunk[name] = content[name]
+                finally:
+                    content.close()
+            else:
+                chunk["present"] = np.zeros(self.chunk_size, dtype = bool)
+                for name, fill in AGGREGATE_FILLS:
+                    dtype = np.int64 if name == "count" else np.float64
+                    chunk[name] = np.zeros((0, self.chunk_size, 0),
+                                           dtype = dtype)
+            self.chunks[chunk_id] = chunk
+            self.chunk_ids.add(chunk_id)
+        # Stations and measurements added since the chunk was created
+        shape = (len(self.stations), self.chunk_size, len(self.measurements))
+        if chunk["count"].shape != shape:
+            num_stations, _, num_measurements = chunk["count"].shape
+            for name, fill in AGGREGATE_FILLS:
+                extended = np.empty(shape, dtype = chunk[name].dtype)
+                extended.fill(fill)
+                extended[:num_stations, :, :num_measurements] = chunk[name]
+                chunk[name] = extended
+        return chunk
+
+    def aggregates(self):
+        """ Aggregates of all the buckets that received data, sorted by key:
+        the keys of the buckets, and a dict of arrays (station x bucket x
+        measurement) for "count", "total", "squares", "minimum" and
+        "maximum".
+        """
+        keys = []
+        parts = dict((name, []) for name, fill in AGGREGATE_FILLS)
+        for chunk_id in sorted(self.chunk_ids):
+            chunk = self._chunk(chunk_id)
+            present = np.flatnonzero(chunk["present"])
+            keys.append(chunk_id * self.chunk_size + present)
+            for name in parts:
+                parts[name].append(chunk[name][:, present])
+        if not keys:
+            shape = (len(self.stations), 0, len(self.measurements))
+            return (np.array([], dtype = np.int64),
+                    dict((name, np.zeros(shape)) for name in parts))
+        return (np.concatenate(keys),
+                dict((name, np.concatenate(arrays, axis = 1))
+                     for name, arrays in parts.items()))
+
+    def downsample(self, method = "average"):
+        """ Downsampled values read from the aggregates, as a StationCube
+        (station x bucket x measurement), with the bucket labels of
+        downsample. method is one of AGGREGATE_METHODS. Buckets without
+        values give NaN, as well as buckets with less than 2 values for the
+        (unbiased) std.
+        """
+        keys, aggregates = self.aggregates()
+        if method == "min":
+            values = aggregates["minimum"]
+        elif method == "max":
+            values = aggregates["maximum"]
+        elif method in ["average", "std"]:
+            count, total = aggregates["count"], aggregates["total"]
+            with np.errstate(invalid = "ignore", divide = "ignore"):
+                values = total / count
+                if method == "std":
+                    variances = ((aggregates["squares"] - total * values)
+                                 / (count - 1))
+                    variances[count < 2] = np.nan
+                    # Rounding errors of the sums can make them negative
+                    values = np.sqrt(np.maximum(variances, 0))
+        else:
+            raise NotImplementedError("This downsampling method (%s) can't be"
+                                      " computed from the aggregates."
+                                      % method)
+        labels = [bucket_label(key, self.offset) for key in keys.tolist()]
+        return StationCube(values, self.stations, labels, self.measurements)
+
+    def save(self, folder):
+        """ Store the aggregates in folder: the chunks modified since they
+        were loaded or last stored (one binary file each), then the
+        description of the aggregates referencing them.
+        """
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        if folder != self.folder:
+            # All the chunks are stored in the new folder
+            for chunk_id in self.chunk_ids:
+                self._chunk(chunk_id)
+            self._modified_chunks = set(self.chunk_ids)
+        for chunk_id in sorted(self._modified_chunks):
+            with atomic_write(self._chunk_filepath(folder, chunk_id)) as f_out:
+                np.savez(f_out, **self._chunk(chunk_id))
+        origin = None if self.origin is None else str(to_day(self.origin))
+        info = {"offset": self.offset, "origin": origin,
+                "stations": self.stations, "measurements": self.measurements,
+                "last_days": self.last_days.tolist(),
+                "chunks": sorted(self.chunk_ids)}
+        filepath = os.path.join(folder, "aggregates.json")
+        with atomic_write(filepath, "w") as f_out:
+            json.dump(info, f_out)
+        self.folder = folder
+        self._modified_chunks = set()
+
+    @classmethod
+    def load(cls, folder):
+        """ Load aggregates stored with save. Their chunks are only read
+        when they are needed.
+        """
+        with open(os.path.join(folder, "aggregates.json")) as f_in:
+            info = json.load(f_in)
+        offset = info["offset"]
+        if not isinstance(offset, int):
+            offset = str(offset)
+        origin = info["origin"]
+        if origin is not None:
+            origin = np.datetime64(str(origin), "D")
+        aggregates = cls(offset, origin, folder)
+        aggregates.stations = [str(name) for name in info["stations"]]
+        aggregates.measurements = [str(name) for name in info["measurements"]]
+        aggregates.last_days = np.array(info["last_days"], dtype = np.int64)
+        aggregates.chunk_ids = set(info["chunks"])
+        return aggregates
+
+class AggregateStore(object):
+    """ Aggregates of several offsets, stored in folder (one sub-folder per
+    offset) and updated together.
+    """
+    def __init__(self, folder = None, offsets = DEFAULT_OFFSETS):
+        if folder is None:
+            folder = AGGREGATES_FOLDER
+        self.folder = folder
+        self.aggregates = {}
+        for offset in offsets:
+            offset_folder = self._folder(offset)
+            if os.path.isfile(os.path.join(offset_folder, "aggregates.json")):
+                self.aggregates[offset] = \
+                    DownsampleAggregates.load(offset_folder)
+            else:
+                self.aggregates[offset] = DownsampleAggregates(offset)
+
+    def _folder(self, offset):
+        return os.path.join(self.folder, "aggregates_%s" % offset)
+
+    def append(self, data, station = None):
+        """ Update the aggregates of all the offsets with new daily data (see
+        DownsampleAggregates.append) and store the chunks updated. Nothing is
+        stored if there is no new day.
+        """
+        for offset, aggregates in self.aggregates.items():
+            if aggregates.append(data, station):
+                aggregates.save(self._folder(offset))
+
+    def downsample(self, method = "average", offset = "unique_week"):
+        """ Same as downsample(data, method, offset) on all the data
+        appended, read from the aggregates.
+        """
+        if offset not in self.aggregates:
+            raise ValueError("The offset %s is not aggregated. Available "
+                             "offsets are %s." % (offset,
+                                                  self.aggregates.keys()))
+        return self.aggregates[offset].downsample(method)
@@ -1,6 +1,5 @@
 """ General functionalities on pandas.
 
-TODO: Implement downsampling of panels
 TODO: Contribute that to pandas project?
 """
 import datetime
@@ -8,127 +7,177 @@ import types
 import pandas
 import numpy as np
 import warnings
-from numpy.random import randint
+
+from station_cube import StationCube, concat_cubes
+from aggregators import get_aggregator
+from gsod_dataset import GSODDataset
+from gsod_parser import GSOD_MEASUREMENT_COLS
 
 GSOD_DATA_FILE_COLS = ['STN---', 'WBAN', 'YEARMODA', 'TEMP', 'TEMP-count',
                       'DEWP', 'DEWP-count', 'SLP', 'SLP-count', 'STP',
                       'STP-count', 'VISIB', 'VISIB-count', 'WDSP',
                       'WDSP-count', 'MXSPD', 'GUST', 'MAX', 'MIN', 'PRCP',
                       'SNDP', 'FRSHTT']
+
+# Flags split from the MAX, MIN and PRCP values when parsing the data files
+GSOD_FLAG_COLS = ['MAX-flag', 'MIN-flag', 'PRCP-flag']
                       
 NUM2STR_MONTH = {1: "01-Jan", 2: "02-Feb", 3: "03-Mar", 4: "04-Apr", 5: "05-May", 6: "06-Jun",
                  7: "07-Jul", 8: "08-Aug", 9: "09-Sep", 10: "10-Oct", 11: "11-Nov", 12: "12-Dec"}
 
-def rand_sample(arr):
-    """ Select a random value inside an array
+def time_bucket_keys(dates, offset = "unique_week", origin = None):
+    """ Integer key of the period of time (bucket) of each date of a sorted
+    array of dates, for the offsets of _downsample_df: number of periods of
+    offset days (7 for 'unique_week') since origin (the first date by
+    default), month of the year (0-11) for 'month', months since 1970 for
+    'unique_month', year for 'year'. The keys are non-decreasing except for
+    'month'.
+    """
+    days = np.asarray(dates).astype("M8[D]")
+    if isinstance(offset, int) or offset == "unique_week":
+        if offset == "unique_week":
+            offset = 7
+        if origin is None:
+            if not len(days):
+                return np.zeros(0, dtype = np.int64)
+            origin = days[0]
+        return (days - np.datetime64(origin, "D")).astype(np.int64) // offset
+    months = days.astype("M8[M]").astype(np.int64)
+    if offset == "month":
+        return months % 12
+    elif offset == "unique_month":
+        return months
+    elif offset == "year":
+        return days.astype("M8[Y]").astype(np.int64) + 1970
+    raise ValueError("The offset %s is not supported: it should be an int or "
+                     "in ['unique_week', 'month', 'unique_month', 'year']."
+                     % offset)
+
+def bucket_label(key, offset = "unique_week"):
+    """ Label of the downsampled values of a bucket key: the number of
+    periods or the year, '01-Jan' for a month, '2012-01-Jan' for a unique
+    month.
     """
-    ind = randint(0,len(arr))
-    return arr[ind]
+    if offset == "month":
+        return NUM2STR_MONTH[key+1]
+    elif offset == "unique_month":
+        return "%s-%s" % (key // 12 + 1970, NUM2STR_MONTH[key % 12 + 1])
+    return key
 
-def select_first(arr):
-    """ Select a random value inside an array
+def bucket_starts(keys):
+    """ Positions where each run of equal keys starts (none if there is no
+    key).
     """
-    return arr[0]
+    if not len(keys):
+        return np.zeros(0, dtype = np.int64)
+    return np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+
+def downsample_values(values, dates, aggregator, offset = "unique_week",
+                      axis = 0):
+    """ Downsample an array along its time axis (of labels dates) with an
+    Aggregator (see the aggregators module). The buckets are computed once
+    for all the other dimensions, and reduced all at once.
 
-def select_last(arr):
-    """ Select a random value inside an array
+    Returns the downsampled values and the labels of their buckets (no
+    bucket if there is no date).
     """
-    return arr[-1]
+    keys = time_bucket_keys(dates, offset)
+    if not len(keys):
+        values = np.asarray(values)
+        if values.dtype.kind != "f":
+            values = values.astype(np.float64)
+        return values.take(bucket_starts(keys), axis = axis), []
+    if np.any(keys[1:] < keys[:-1]):
+        # The months of all years: the dates of a bucket are gathered
+        order = np.argsort(keys, kind = "mergesort")
+        keys = keys[order]
+        values = np.asarray(values).take(order, axis = axis)
+    starts = bucket_starts(keys)
+    labels = [bucket_label(key, offset) for key in keys[starts].tolist()]
+    return aggregator.reduce(values, starts, axis), labels
 
 def _downsample_df(df, method = "average", offset = "unique_week"):
     """ Downsample the DF provided along the time dimension.
     Inputs:
-    - method, str or callable. Method to downsample the timeseries. Must be in
-    ['average', 'std', 'min', 'max', 'first', 'last', 'rand_sample']. It can also be a custom callable.
+    - method, str, Aggregator or callable. Method to downsample the
+    timeseries. Must be in ['average', 'std', 'min', 'max', 'first', 'last',
+    'rand_sample', 'count', 'median'] or an Aggregator (such as
+    WeightedAverage, Quantile or RandomSample, see the aggregators module).
+    It can also be a custom callable.
     - offset, str or int. Describes over what period of time the dates should
     be grouped for downsampling. Must be an int (for the number of days) or a
     string in ['unique_week', 'month', 'unique_month', 'year']. If 'month' is
     chosen, all january values are grouped together ignoring the year. If
     'unique_month', Jan 2012 is treated as a different month from Jan 2011.
 
-    TODO: improve the groupby method of a DF to pass arguments to the function
-    used to group (see get_unique_week). 
+    The dates are grouped by the integer keys of their periods (see
+    time_bucket_keys), computed at once from the index, and the built-in
+    methods and Aggregators reduce all the groups at once. A custom callable
+    is applied to each group.
     """
-    date_start = df.index[0]
     if type(offset) not in [int, str]:
         raise ValueError("The offset key word should be a string or an int but"
                          " %s of type %s was passed." % (offset, type(offset)))
-
-    # Parameters to group dates
-    if offset == "unique_week":
-        num_day_grouped = 7
-    elif isinstance(offset, int):
-        num_day_grouped = offset
-        offset = "unique_week"
-        
-    def get_unique_week(date):    
-        """ Compute the number of weeks since start.
-
-        FIXME: I would want to pass num_day_grouped and date_start to the
-        function instead of using global vars tricks. 
-        """ 
-        diff_days =  (date - date_start).days
-        return diff_days / num_day_grouped
-
-    def get_month(date):
-        """ Group dates by month, ignoring years
-        """
-        return NUM2STR_MONTH[date.month]
-    
-    def get_unique_month(date):
-        """ Group dates by month, not ignoring years: january 2012 is treated
-        as a different month as january 2011. 
-        """
-        return "%s-%s" % (date.year, NUM2STR_MONTH[date.month])
-        
-    def get_year(date):
-        """ Group dates by month, ignoring years
-        """
-        return date.year
-
-    # Grouping the dates
-    group_by_func = eval("get_"+offset)
-    grouped = df.groupby(group_by_func)
-
-    # Applying the aggregation function
-    if method == "average":
-        new_df = grouped.mean()
-    elif method == "std":
-        new_df = grouped.std()
-    elif method == "min":
-        new_df = grouped.aggregate(np.min)
-    elif method == "max":
-        new_df = grouped.aggregate(np.max)
-    elif method == "first":
-        new_df = grouped.aggregate(select_first)
-    elif method == "last":
-        new_df = grouped.aggregate(select_last)
-    elif method == "rand_sample":
-        new_df = grouped.aggregate(rand_sample)
+    aggregator = get_aggregator(method)
+    if aggregator is not None:
+        values, labels = downsample_values(df.values, df.index.values,
+                                           aggregator, offset)
+        return pandas.DataFrame(values, index = pandas.Index(labels),
+                                columns = df.columns)
     elif isinstance(method, types.FunctionType):
+        # Applying the aggregation function to each group
+        grouped = df.groupby(time_bucket_keys(df.index.values, offset))
         new_df = grouped.aggregate(method)
     else:
         raise NotImplementedError("This downsampling method (%s) is not yet "
                                   "implemented." % method)
+    new_df.index = pandas.Index([bucket_label(key, offset)
+                                 for key in new_df.index.tolist()])
     return new_df
 
 def _downsample_panel(panel, method = "average", offset = "unique_week"):
-    """ Downsample the panel provided in the time dimension (major axis).
-
-    TODO: Is there a more efficient way to do this?
+    """ Downsample the panel provided in the time dimension (major axis). The
+    built-in methods and Aggregators reduce all the items at once.
     """
+    aggregator = get_aggregator(method)
+    if aggregator is not None:
+        values, labels = downsample_values(panel.values,
+                                           panel.major_axis.values, aggregator,
+                                           offset, axis = 1)
+        return pandas.Panel(values, items = panel.items, major_axis = labels,
+                            minor_axis = panel.minor_axis)
     data = {}
     for item_name, df in panel.iteritems():
         data[item_name] = _downsample_df(df, method, offset)
     return pandas.Panel(data)
 
+def _downsample_cube(cube, method = "average", offset = "unique_week"):
+    """ Downsample the StationCube provided in the time dimension. The
+    built-in methods and Aggregators reduce all the stations and
+    measurements at once. The int measurements are downsampled as floats.
+    """
+    cube = cube.as_float()
+    aggregator = get_aggregator(method)
+    if aggregator is not None:
+        values, labels = downsample_values(cube.values, cube.dates, aggregator,
+                                           offset, axis = 1)
+        return StationCube(values, cube.stations, labels, cube.measurements)
+    data = {}
+    for station, df in cube.iterstations():
+        data[station] = _downsample_df(df, method, offset)
+    return StationCube.from_frames(data, measurements = cube.measurements)
+
 def downsample(obj, method = "average", offset = "unique_week"):
     """ Format the object content to floats and dispatch to the appropriate
     function based on the type of pandas. 
     """
-    # Formating the result
-    if obj.values.dtype != np.float:
-        obj = obj.astype(float)
+    if isinstance(obj, StationCube):
+        return _downsample_cube(obj, method, offset)
+
+    # Formating the result: the GSOD measurements are single precision floats
+    # and are kept as such
+    if obj.values.dtype.kind != "f":
+        obj = obj.astype(np.float32)
     
     if isinstance(obj, pandas.DataFrame):
         return _downsample_df(obj, method, offset)
@@ -142,24 +191,31 @@ def downsample(obj, method = "average", offset = "unique_week"):
 def filter_data(panel, locations = [], measurements = [],
                 date_start = None, date_end = None,
                 offset = None, downsampling_method = ""):
-    """ Extract specific data from a panel: reduce the minor axis to only the
-    type of data listed in data_list, reduce the major axis to a smaller range
-    of dates or reduce the number of items to a list of locations.
+    """ Extract specific data from a GSODDataset, a StationCube or a panel:
+    reduce the measurements (minor axis) to only the type of data listed in
+    data_list, reduce the dates (major axis) to a smaller range or reduce the
+    stations (items) to a list of locations.
 
     Inputs:
     - measurements, list(str).  List of column names to select (must be in
-    GSOD_DATA_FILE_COLS)
+    GSOD_MEASUREMENT_COLS or GSOD_FLAG_COLS)
     - date_start, date_end. start and end dates for slicing in the time
     dimension. Can be a datetime object or a string in the format YYYY/MM/DD.
     - offset. Used to disseminate data or to downsample data if a
     downsampling_method is given. Can be 'unique_week', 'month',
     'unique_month', 'year'. 
-    - downsampling_method, str. Method to downsample the dataset. Can be
-    'average', 'std', 'min', 'max', 'first', 'last', 'rand_sample'.
+    - downsampling_method, str, Aggregator or callable. Method to downsample
+    the dataset. Can be 'average', 'std', 'min', 'max', 'first', 'last',
+    'rand_sample', 'count', 'median', an Aggregator or a custom callable (see
+    _downsample_df).
+
+    From a GSODDataset, the locations, dates and measurements are selected
+    when reading it: only the data requested is loaded from disk.
 
     Outputs:
-    - slice/sub-part of the original panel. If only one measurement is 
-    requested, returns a DF with the locations as the columns.
+    - slice/sub-part of the original cube or panel (StationCube for a
+    dataset). If only one measurement is requested, returns a DF with the
+    locations as the columns.
     """
     #####################
     # Rationalize inputs
@@ -168,10 +224,16 @@ def filter_data(panel, locations = [], measurements = [],
         measurements = [measurements]
     if isinstance(locations, str):
         locations = [locations]
-    if date_end and not date_start:
-        date_start = panel.major_axis[0]
-    if date_start and not date_end:
-        date_end = panel.major_axis[-1]
+    # Open-ended ranges of dates are resolved by the dataset itself
+    if not isinstance(panel, GSODDataset):
+        if isinstance(panel, StationCube):
+            time_axis = panel.dates
+        else:
+            time_axis = panel.major_axis
+        if date_end and not date_start:
+            date_start = time_axis[0]
+        if date_start and not date_end:
+            date_end = time_axis[-1]
 
     if isinstance(date_start, str):
         date_start = datetime.datetime.strptime(date_start, '%Y/%m/%d')
@@ -189,22 +251,42 @@ def filter_data(panel, locations = [], measurements = [],
     #########
     # FILTERS
     #########
-    # filter items
-    if locations:
-        panel = panel.filter(locations)
-
-    # Filter major and minor axis
-    if not set(measurements).issubset(set(GSOD_DATA_FILE_COLS)):
+    # The station codes and dates are not columns of the parsed data
+    allowed_measurements = GSOD_MEASUREMENT_COLS + \
+        [name for name in GSOD_FLAG_COLS if name not in GSOD_MEASUREMENT_COLS]
+    if not set(measurements).issubset(set(allowed_measurements)):
         raise ValueError("%s is not a valid data type. Allowed values are %s."
-                         % (set(measurements)-set(GSOD_DATA_FILE_COLS), GSOD_DATA_FILE_COLS))
-    if len(measurements) > 1:
-        result = panel.ix[:,date_start:date_end, measurements]
-    elif len(measurements) == 1:
-        # This will automatically convert result to a DF. Passing measurements
-        # directly will result in a Panel with length 1 minor_axis
-        result = panel.ix[:,date_start:date_end, measurements[0]]
+                         % (set(measurements)-set(allowed_measurements), allowed_measurements))
+    if isinstance(panel, GSODDataset):
+        # Pushed down to the storage: only the data selected is read
+        panel = panel.read(locations or None, date_start, date_end,
+                           measurements or None)
+        locations = []
+    if isinstance(panel, StationCube):
+        # The ranges of labels selected are views of the cube
+        if locations:
+            stations = set(panel.stations.tolist())
+            locations = [location for location in locations
+                         if location in stations]
+        else:
+            locations = None
+        result = panel.sel(locations, date_start, date_end,
+                           measurements or None)
+        if len(measurements) == 1:
+            result = result.measurement(measurements[0])
     else:
-        result = panel.ix[:,date_start:date_end,:]
+        # filter items
+        if locations:
+            panel = panel.filter(locations)
+        if len(measurements) > 1:
+            result = panel.ix[:,date_start:date_end, measurements]
+        elif len(measurements) == 1:
+            # This will automatically convert result to a DF. Passing
+            # measurements directly will result in a Panel with length 1
+            # minor_axis
+            result = panel.ix[:,date_start:date_end, measurements[0]]
+        else:
+            result = panel.ix[:,date_start:date_end,:]
 
     if offset and downsampling_method:
         result = downsample(result, downsampling_method, offset)
@@ -229,8 +311,61 @@ def store_pandas(pandas_dict, filename, complevel = 9 , complib = "blosc"):
     store = pandas.HDFStore(filename, mode = "a", complevel = complevel, 
                             complib = complib)
     for name,panda in pandas_dict.items():
+        if isinstance(panda, StationCube):
+            panda = panda.to_panel()
         store[name] = panda
     store.close()
+
+
+class HDFStoreHandle(object):
+    """ Lazy handle to a table stored in an HDF5 file through the pandas'
+    HDFStore. Nothing is read from the file until data is selected from it, 
+    and it can be read chunk by chunk to keep the memory used bounded.
+    """
+    def __init__(self, filename, key):
+        self.filename = filename
+        self.key = key
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.filename, 
+                               self.key)
+
+    def _open(self):
+        return pandas.HDFStore(self.filename, mode = "r")
+
+    @property
+    def nrows(self):
+        store = self._open()
+        try:
+            return store.get_storer(self.key).nrows
+        finally:
+            store.close()
+
+    @property
+    def shape(self):
+        return (self.nrows, len(self.select(start = 0, stop = 1).columns))
+
+    def select(self, where = None, columns = None, start = None, stop = None):
+        """ Load the rows and columns requested as a DataFrame.
+        """
+        store = self._open()
+        try:
+            return store.select(self.key, where = where, columns = columns,
+                                start = start, stop = stop)
+        finally:
+            store.close()
+
+    def iterchunks(self, chunksize = 100000, columns = None):
+        """ Iterate over the table chunksize rows at a time.
+        """
+        for start in xrange(0, self.nrows, chunksize):
+            yield self.select(columns = columns, start = start, 
+                              stop = start+chunksize)
+
+    def load(self):
+        """ Load the entire table into memory.
+        """
+        return self.select()
     
     
 def append_panels(p1,p2):
@@ -261,4 +396,92 @@ def append_panels(p1,p2):
 
     return pandas.Panel(p3, items=result_items, major_axis=result_major_axis, 
                         minor_axis=result_minor_axis)
- 
\ No newline at end of file
+ 
+def _concat_index(indexes):
+    """ Concatenate the values of several indexes into a single index.
+    """
+    return pandas.Index(np.concatenate([index.values for index in indexes]))
+
+def _allocate(shape, dtype, buffer_filepath = None):
+    """ Allocate an array, memory mapped to buffer_filepath if provided.
+    """
+    if buffer_filepath is None:
+        return np.empty(shape, dtype = dtype)
+    return np.memmap(buffer_filepath, dtype = dtype, mode = "w+", shape = shape)
+
+def concat_frames(frames, buffer_filepath = None):
+    """ Concatenate dataframes with the same columns along the index (time)
+    dimension. Each column of the result is allocated once and each frame is
+    copied once into it, so the cost is linear in the total size.
+
+    If buffer_filepath is provided, the values are written in a 2D array
+    memory mapped to that file (all the columns are then stored with their
+    common type), to assemble results larger than the memory.
+    """
+    columns = frames[0].columns
+    for df in frames[1:]:
+        if not np.all(df.columns.values == columns.values):
+            raise ValueError("The columns are not the same in all dataframes.")
+    index = _concat_index([df.index for df in frames])
+    bounds = np.cumsum([0] + [len(df) for df in frames])
+    if buffer_filepath is not None:
+        dtype = np.result_type(*[df[col].values.dtype for df in frames 
+                                 for col in columns])
+        values = _allocate((len(index), len(columns)), dtype, buffer_filepath)
+        for df, start, end in zip(frames, bounds[:-1], bounds[1:]):
+            for j, col in enumerate(columns):
+                values[start:end, j] = df[col].values
+        return pandas.DataFrame(values, index = index, columns = columns)
+    data = {}
+    for col in columns:
+        dtype = np.result_type(*[df[col].values.dtype for df in frames])
+        data[col] = _allocate(len(index), dtype)
+        for df, start, end in zip(frames, bounds[:-1], bounds[1:]):
+            data[col][start:end] = df[col].values
+    return pandas.DataFrame(data, index = index, columns = columns)
+
+def concat_panels(panels, buffer_filepath = None):
+    """ Concatenate panels along the major axis (time). The items of the
+    result are the union of the items of all the panels: the values of the
+    items missing from a panel are NaN. The minor axis must be the same.
+    The values are allocated once (memory mapped to buffer_filepath if
+    provided) and each panel is copied once into it.
+    """
+    minor_axis = panels[0].minor_axis
+    for panel in panels[1:]:
+        if not np.all(panel.minor_axis.values == minor_axis.values):
+            raise ValueError("The elements of the minor axis dimension are not"
+                             " the same in all panels.")
+    items = panels[0].items
+    for panel in panels[1:]:
+        if not np.all(panel.items.values == items.values):
+            items = items.union(panel.items)
+    major_axis = _concat_index([panel.major_axis for panel in panels])
+    # Float at least, for the NaN values
+    dtype = np.result_type(np.float64, *[panel.values.dtype 
+                                         for panel in panels])
+    values = _allocate((len(items), len(major_axis), len(minor_axis)), dtype,
+                       buffer_filepath)
+    start = 0
+    for panel in panels:
+        end = start + len(panel.major_axis)
+        if len(panel.items) == len(items) and np.all(panel.items.values == 
+                                                     items.values):
+            values[:, start:end] = panel.values
+        else:
+            positions = items.get_indexer(panel.items)
+            values[:, start:end] = np.nan
+            values[positions, start:end] = panel.values
+        start = end
+    return pandas.Panel(values, items = items, major_axis = major_axis,
+                        minor_axis = minor_axis)
+
+def concat_pandas(pieces, buffer_filepath = None):
+    """ Concatenate dataframes, StationCubes or panels along the time
+    dimension with concat_frames, concat_cubes or concat_panels.
+    """
+    if isinstance(pieces[0], StationCube):
+        return concat_cubes(pieces, buffer_filepath)
+    if isinstance(pieces[0], pandas.DataFrame):
+        return concat_frames(pieces, buffer_filepath)
+    return concat_panels(pieces, buffer_filepath)
@@ -1,4 +1,7 @@
+from cStringIO import StringIO
+from contextlib import contextmanager
 import gzip
+import json
 import tarfile
 import os
 
@@ -15,6 +18,41 @@ def unzip(zipped_filepath):
     f_in.close()
     os.remove(zipped_filepath)
 
+def replace_file(src, dst):
+    """ Move src to dst, replacing dst atomically where the platform allows.
+    """
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # Windows doesn't replace existing files
+        os.remove(dst)
+        os.rename(src, dst)
+
+@contextmanager
+def atomic_write(filepath, mode = "wb"):
+    """ Context manager opening a temporary file next to filepath for
+    writing. It replaces filepath once written without error (it is removed
+    otherwise), so that filepath is never seen partially written.
+    """
+    tmp_filepath = filepath + ".tmp"
+    f_out = open(tmp_filepath, mode)
+    try:
+        yield f_out
+    except:
+        f_out.close()
+        os.remove(tmp_filepath)
+        raise
+    f_out.close()
+    replace_file(tmp_filepath, filepath)
+
+def open_data_file(filepath):
+    """ Open a data file for reading, decompressing it on the fly if it is a
+    gzip file so that it never needs to be unzipped on disk.
+    """
+    if filepath.endswith(".gz"):
+        return gzip.open(filepath, 'rb')
+    return open(filepath, 'rb')
+
 def untar(filepath):
     """ Untar a tar file in its present location.
     FIXME: add inspection of data before untaring everything onto local disk...?
@@ -25,3 +63,78 @@ def untar(filepath):
     arch.extractall(path = target_folder)
     arch.close()
 
+
+# Tar member indexes already loaded, by tar filepath
+_TAR_INDEXES = {}
+
+def file_signature(filepath):
+    """ Size and modification time of a file, used to detect changes.
+    """
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime]
+
+def tar_member_index(tar_filepath):
+    """ Index of the members of a tar file: maps the filename of each member
+    to the offset and size of its data inside the archive. 
+
+    The index is built the first time it is requested, and stored next to
+    the archive (.idx file) for later sessions. It is rebuilt if the size or
+    the modification time of the archive changes.
+    """
+    signature = file_signature(tar_filepath)
+    cached = _TAR_INDEXES.get(tar_filepath)
+    if cached is not None and cached["signature"] == signature:
+        return cached["members"]
+
+    index_filepath = tar_filepath + ".idx"
+    index = None
+    if os.path.isfile(index_filepath):
+        try:
+            with open(index_filepath) as f_in:
+                index = json.load(f_in)
+        except ValueError:
+            index = None
+        if index is not None and index["signature"] != signature:
+            index = None
+    if index is None:
+        print "Indexing tar archive %s..." % tar_filepath
+        members = {}
+        arch = tarfile.open(tar_filepath)
+        for member in arch:
+            if member.isfile():
+                members[os.path.basename(member.name)] = [member.offset_data,
+                                                          member.size]
+        arch.close()
+        index = {"signature": signature, "members": members}
+        try:
+            with atomic_write(index_filepath, "w") as f_out:
+                json.dump(index, f_out)
+        except IOError:
+            # Read-only location: the index will be rebuilt next session
+            pass
+    _TAR_INDEXES[tar_filepath] = index
+    return index["members"]
+
+def read_tar_member(tar_filepath, member_name):
+    """ Read the content of a single member of a tar file with one seek,
+    using the index of the archive. Returns None if it is not in the archive.
+    """
+    location = tar_member_index(tar_filepath).get(member_name)
+    if location is None:
+        return None
+    offset, size = location
+    with open(tar_filepath, 'rb') as f_in:
+        f_in.seek(offset)
+        return f_in.read(size)
+
+def open_tar_member(tar_filepath, member_name):
+    """ Open a data file stored inside a tar file for reading, decompressing
+    it on the fly if it is a gzip file. Returns None if it is not in the
+    archive.
+    """
+    content = read_tar_member(tar_filepath, member_name)
+    if content is None:
+        return None
+    if member_name.endswith(".gz"):
+        return gzip.GzipFile(fileobj = StringIO(content), mode = 'rb')
+    return StringIO(content)
@@ -22,10 +22,6 @@ location code.
 TO DO LIST:
 ###############################################################################
 
-TODO: Add possibility to store the collected data into a file at collection. 
-Implement it with the possibility to write to the file piece by piece.
-TODO: Add caching to list the non-existing files. Prepopulate it from the database 
-files that contain the range of data existance.
 TODO: Refactor the content that is pure NOAA's NCDC related into its own module
 TODO: Add other data sources such as weather underground, arm.gov, data.gov,
 ECMWF, ... and allow merging of data.
@@ -38,26 +34,37 @@ TODO: Allow for custom ftp and opeDAP retrieval.
 TODO: Build a UI on top of all of this. A simple one just to search and store
 the files locally. Another one integrating an ipython prompt to load the data
 and be able to play with them afterwards.
-TODO: Add/explore memory mapping (with pytables?) when collecting VERY large
-amounts of data.
 """
 
 # Std lib imports
 import datetime
+import ftplib
+import multiprocessing
 import os
+import re
 import warnings
+from urlparse import urlparse
 
 # General imports
 import numpy as np
 import pandas
 
 # ETS imports
-from traits.api import HasTraits, Instance, Enum, Array, Dict, Str
+from traits.api import HasTraits, Instance, Enum, Array, Dict, Str, Int, Bool, \
+    Property, Any
 
 # Local imports
-from retrieve_remote import retrieve_file, info2filepath
-from file_sys_util import untar, unzip
-from extend_pandas import append_panels, downsample, GSOD_DATA_FILE_COLS
+from retrieve_remote import retrieve_file, retrieve_files, info2filepath, \
+    filepath2info, ftp_session, remote_url, PARTIAL_SUFFIX
+from file_sys_util import untar, open_tar_member
+from local_cache import MissingFileCache, ParsedRecordCache, DownloadManifest, \
+    ListingCache, CACHE_FOLDER, load_cached_array, store_cached_array
+from extend_pandas import concat_pandas, downsample, HDFStoreHandle
+from gsod_parser import read_gsod_file, records2pandas, GSOD_MEASUREMENT_COLS
+from station_index import StationIndex, SpatialIndex
+from collection_plan import plan_collection, LOCAL, ARCHIVE
+from station_cube import StationCube, daily_dates
+from gsod_query import GSODQuery
 
 ###############################################################################
 
@@ -67,43 +74,94 @@ OUT_LS_SUCCESS = '226 Transfer complete'
 
 ###############################################################################
             
-def list_yearly_data(year, ftp_connection):
+def parse_listing_line(line):
+    """ Parse a line of a unix style FTP directory listing (LIST command).
+
+    Returns (filename, size in bytes, modification date as listed) or None
+    if the line doesn't describe a file.
+    """
+    fields = line.split(None, 8)
+    if len(fields) < 9 or not fields[0].startswith("-"):
+        return None
+    return fields[8], int(fields[4]), " ".join(fields[5:8])
+
+def list_yearly_files(year, ftp_connection = None, missing_cache = None,
+                      url_base = None):
+    """ List the GSOD data files available for a specified year on the
+    server, with their size and modification date. If an ftp connection is
+    provided, it assumes that it is already open and will be closed
+    externally. If not, a session is borrowed from the pool of FTP sessions
+    to NCDC (or to the server of url_base).
+
+    If a MissingFileCache is provided, the stations absent from the listing
+    (or the entire year if it can't be listed) are recorded as missing.
+
+    Returns a dict mapping the filenames to (size, modification date).
+    """
+    if ftp_connection is None:
+        with ftp_session("NCDC", url_base) as ftp_connection:
+            return list_yearly_files(year, ftp_connection, missing_cache,
+                                     url_base)
+
+    folder_location = urlparse(remote_url("NCDC", str(year), url_base)).path
+    try:
+        out_cwd = ftp_connection.cwd(folder_location)
+    except ftplib.error_perm:
+        out_cwd = None
+    if out_cwd is None or not out_cwd.startswith(OUT_CWD_SUCCESS[:3]):
+        if missing_cache is not None:
+            missing_cache.record_missing_year(year)
+        raise OSError("Unable to change to directory %s. Is the ftp connection open?"
+                      % folder_location)
+    listing = {}
+
+    def identify_file(line):
+        entry = parse_listing_line(line)
+        if entry is not None:
+            listing[entry[0]] = entry[1:]
+
+    out_ls = ftp_connection.retrlines('LIST', callback = identify_file)
+    if not out_ls.startswith(OUT_LS_SUCCESS[:3]):
+        raise OSError("Failed listing the content of %s" % folder_location)
+    if missing_cache is not None:
+        missing_cache.record_listing(year, [filepath2info(filename)[:2] 
+                                            for filename in listing
+                                            if filename.find("-") != -1])
+    return listing
+
+def list_yearly_data(year, ftp_connection = None, missing_cache = None,
+                     url_base = None):
     """ List the GSOD data file available for a specified year on the server.
-    It assumes that an ftp connection is already open and will be close
-    externally.
+    See list_yearly_files.
 
     Returns:
     - list of filenames for the corresponding year
     - list of location tuple (WMO code, WBAN code)
     """
-    file_list = []
-    location_list = []
-    
-    def identify_file_location(line):
-        filename = line.split()[-1]
-        file_list.append(filename)
-        if filename.find("-") != -1:
-            location_list.append(tuple(filename.split("-")))
-        return
-    
-    folder_location = os.path.join('/pub/data/gsod',str(year))
-    out_cwd = ftp_connection.cwd(folder_location)
-    if out_cwd != OUT_CWD_SUCCESS:
-        raise OSError("Unable to change to directory %s. Is the ftp connection open?"
-                      % folder_location)
-    out_ls = ftp_connection.retrlines('LIST', callback = identify_file_location)
-    if out_ls != OUT_LS_SUCCESS:
-        raise OSError("Failed listing the content of %s" % folder_location)
-    return file_list, location_list.sort()
+    file_list = sorted(list_yearly_files(year, ftp_connection, missing_cache,
+                                         url_base))
+    location_list = sorted(filepath2info(filename)[:2] 
+                           for filename in file_list
+                           if filename.find("-") != -1)
+    return file_list, location_list
 
-def read_ish_history():
+def read_ish_history(use_cache = True):
     """ Read the ish-history.TXT metadata file: it connects the WMO location to 
     the WBAN location, location name, the country codes, the lattitude, 
     longitude elevation, and range of dates.
 
+    The parsed content is cached in a binary file, and the text file is only
+    parsed again when it changes (or if use_cache is False).
+
     Returns a structured array
     """
     ish_filepath = os.path.join("Data", 'GSOD', 'ish-history.TXT')
+    cache_filepath = os.path.join(CACHE_FOLDER, 'ish-history.npz')
+    if use_cache:
+        data = load_cached_array(cache_filepath, ish_filepath)
+        if data is not None:
+            return data
+
     col_names = ["USAF", "WBAN", "STATION_NAME", "CTRY_WMO", "CTRY_FIPS", "ST",
                  "CALL", "LAT", "LON", "ELEV", "BEGIN", "END"]
     starts = np.array([0,7,13,43,46,49,52,58,65,73,83,92])
@@ -127,6 +185,8 @@ def read_ish_history():
     data = np.genfromtxt(ish_filepath, delimiter = widths,
                          skiprows = 22, dtype = dtypes, autostrip = True, 
                          converters = converters)
+    if use_cache:
+        store_cached_array(cache_filepath, ish_filepath, data)
     return data
 
 def initialize_location_dict(ishdata = None):
@@ -135,105 +195,392 @@ def initialize_location_dict(ishdata = None):
     Inputs:
     - ishdata: pandas dataframe containing the data from the ish-history.TXT file
     """
-    location_dict = {}
     if ishdata is None:
         ishdata = read_ish_history()
 
-    for i in xrange(ishdata.shape[0]):
-        if ishdata[i][2]:
-            # There is a station name. Store its location codes
-            location_dict[ishdata[i][2]] = (ishdata[i][0], ishdata[i][1])
-    return location_dict
+    # Only the stations with a name. For duplicate names, the last station
+    # wins.
+    named = ishdata["STATION_NAME"] != ""
+    codes = zip(ishdata["USAF"][named].tolist(), ishdata["WBAN"][named].tolist())
+    return dict(zip(ishdata["STATION_NAME"][named].tolist(), codes))
     
 def datafile2pandas(filepath):
-    """ Read a NCDC GSOD file into a pandas dataframe
+    """ Read a NCDC GSOD file (.op or .op.gz) into a pandas dataframe. Gzip
+    files are decompressed on the fly as they are parsed. An already opened
+    file object can also be passed.
+
+    The flags attached to the MAX, MIN and PRCP values are returned in
+    separate columns (see gsod_parser).
     """
-    df = pandas.read_table(filepath, sep="\s*", index_col=2, parse_dates = True,
-                           names = GSOD_DATA_FILE_COLS, skiprows = [0])
-    return df
+    return records2pandas(read_gsod_file(filepath))
 
-def datafolder2pandas(folderpath):
-    """ Read a NCDC GSOD folder into a pandas panel
+def read_station_records(filepath, record_cache = None, tar_filepath = None):
+    """ Read the records of a station file (.op or .op.gz), possibly stored
+    inside the yearly tar file tar_filepath. If a ParsedRecordCache is 
+    provided, the records are taken from it when the file hasn't changed
+    since it was parsed, and stored in it otherwise.
     """
-    data = {}
+    source_filepath = tar_filepath or filepath
+    if record_cache is not None:
+        location_WMO, location_WBAN, year = filepath2info(filepath)
+        records = record_cache.get(location_WMO, location_WBAN, year,
+                                   source_filepath)
+        if records is not None:
+            return records
+    if tar_filepath is None:
+        records = read_gsod_file(filepath)
+    else:
+        records = read_gsod_file(open_tar_member(tar_filepath, 
+                                                 os.path.basename(filepath)))
+    if record_cache is not None:
+        record_cache.put(location_WMO, location_WBAN, year, source_filepath,
+                         records)
+    return records
+
+def _parse_file_chunk(filepaths):
+    """ Parse a chunk of GSOD files in a worker process. The records of all
+    the files are returned concatenated in a single array, along with the
+    number of records of each file, so that they are sent back as one buffer.
+    """
+    records = [read_gsod_file(filepath) for filepath in filepaths]
+    return np.concatenate(records), np.array([len(rec) for rec in records])
+
+def datafolder2pandas(folderpath, num_workers = 1, chunk_size = 64,
+                      record_cache = None):
+    """ Read a NCDC GSOD folder into a StationCube (one station per file,
+    keyed by "WMO-WBAN" whether the file is gzipped or not)
+
+    Inputs:
+    - num_workers, int. Number of processes parsing the files. If larger than
+      1, the files are sharded in chunks of chunk_size files across a process
+      pool.
+    - record_cache, ParsedRecordCache. Cache of the parsed files to use. Only
+      the files not in it (or modified since) are parsed.
+    """
+    keys = []
+    files2load = []
     print "Loading all op files in %s ..." % folderpath
     for filename in os.listdir(folderpath):
-        if os.path.splitext(filename)[1] == ".op":
-            file2load = os.path.join(folderpath, filename)
-            key = filename[:13]
-            data[key] = datafile2pandas(file2load)
-        elif filename.endswith(".op.gz"):
-            unzip(os.path.join(folderpath, filename))
-            file2load = os.path.join(folderpath, os.path.splitext(filename)[0])
-            key = filename[:17]
-            data[key] = datafile2pandas(file2load)
-    return pandas.Panel(data)
+        if filename.endswith(".op") or filename.endswith(".op.gz"):
+            # Same "WMO-WBAN" keys as collect_planned_records
+            location_WMO, location_WBAN, year = filepath2info(filename)
+            keys.append("%s-%s" % (location_WMO, location_WBAN))
+            files2load.append(os.path.join(folderpath, filename))
+
+    data = {}
+    if record_cache is not None:
+        keys2parse = []
+        files2parse = []
+        for key, file2load in zip(keys, files2load):
+            records = record_cache.get(*(filepath2info(file2load)
+                                         + (file2load,)))
+            if records is None:
+                keys2parse.append(key)
+                files2parse.append(file2load)
+            else:
+                data[key] = records
+        keys, files2load = keys2parse, files2parse
+
+    def store(key, file2load, records):
+        if record_cache is not None:
+            record_cache.put(*(filepath2info(file2load) + (file2load, records)))
+        data[key] = records
+
+    if num_workers > 1 and len(files2load) > chunk_size:
+        chunks = [files2load[i:i+chunk_size] 
+                  for i in range(0, len(files2load), chunk_size)]
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            parsed_chunks = pool.imap(_parse_file_chunk, chunks)
+            file_iter = iter(zip(keys, files2load))
+            for records, counts in parsed_chunks:
+                for file_records in np.split(records, np.cumsum(counts)[:-1]):
+                    key, file2load = file_iter.next()
+                    store(key, file2load, file_records)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for key, file2load in zip(keys, files2load):
+            store(key, file2load, read_gsod_file(file2load))
+    if record_cache is not None:
+        record_cache.save()
+    return StationCube.from_records(data, measurements = GSOD_MEASUREMENT_COLS)
  
-def collect_year_at_loc(year, location_WMO, location_WBAN, data_source = 'NCDC', 
-                        internet_connected = True):
-    """ Collect the data GSOD data file for specified location and specified
-    year. Look locally for the file first. If it is not there, and its gzip
-    version is not either, untar the file if it is present and has not been
-    untared, or use the ftp connection to retrieve it from data source.
+def datafolder2store(folderpath, store_filepath, key, complevel = 9, 
+                     complib = "blosc"):
+    """ Stream a NCDC GSOD folder into a table of an HDF5 file: the files are
+    parsed and appended to the compressed table one station at a time, so
+    that the memory used doesn't depend on the amount of data in the folder.
+    Any previous table stored under key is replaced. The rows of the table
+    contain the codes of their station (STN--- and WBAN columns).
+
+    Returns a HDFStoreHandle to the table.
+    """
+    print "Streaming all op files in %s into %s ..." % (folderpath, 
+                                                       store_filepath)
+    store = pandas.HDFStore(store_filepath, mode = "a", complevel = complevel,
+                            complib = complib)
+    try:
+        if key in store:
+            store.remove(key)
+        for filename in sorted(os.listdir(folderpath)):
+            if filename.endswith(".op") or filename.endswith(".op.gz"):
+                df = datafile2pandas(os.path.join(folderpath, filename))
+                if len(df):
+                    # The records don't contain the station codes: they
+                    # identify the rows of each station in the table
+                    location_WMO, location_WBAN, year = filepath2info(filename)
+                    df['STN---'] = np.repeat(np.int32(location_WMO), len(df))
+                    df['WBAN'] = np.repeat(np.int32(location_WBAN), len(df))
+                    store.append(key, df)
+    finally:
+        store.close()
+    return HDFStoreHandle(store_filepath, key)
+
+def record_missing_target(missing_cache):
+    """ Build a callback recording in missing_cache the remote targets
+    (YEAR/WMO-WBAN-YEAR.op.gz) that the server reports as non-existent.
+    """
+    def on_missing(remote_target):
+        missing_cache.record_missing(*filepath2info(remote_target))
+    return on_missing
+
+def files_to_sync(year, listing, manifest):
+    """ Compare the listing of a year on the server with the local files.
+
+    Inputs:
+    - listing, dict. Filename -> (size, modification date), as returned by
+      list_yearly_files.
+    - manifest, DownloadManifest. Record of the files retrieved. Local files
+      not recorded in it but of the size listed (extracted from the yearly
+      archive for example) are adopted into it.
+
+    Returns a list of (filename, size, modification date, changed) for the
+    station files to retrieve, where changed is True if a different version
+    of the file is present locally.
     """
-    filename = info2filepath(year, location_WMO, location_WBAN)
     folder_location = os.path.join("Data", "GSOD", "gsod_"+str(year))
-    filepath = os.path.join(folder_location, filename)
-    print "Attempting to collect %s..." % filepath
-    filepath_found = True
-    
-    if not os.path.exists(filepath):
-        zipped_filepath = filepath+".gz"
-        if os.path.exists(zipped_filepath):
-            unzip(zipped_filepath)
-        elif os.path.exists(os.path.join(folder_location,
-                                         "gsod_"+str(year)+".tar")):
-            # Possible not to rely on outside servers: untar the file if there
-            # are no op.gz or op files. If not it means that the file is
-            # missing.
-            there_are_op_files = False
-            for filename in os.listdir(folder_location):
-                if os.path.splitext(filename)[1] in [".op", ".op.gz"]:
-                    there_are_op_files = True
-                    break
-            if not there_are_op_files:
-                untar(os.path.join(folder_location, "gsod_"+str(year)+".tar"))
-            if os.path.isfile(zipped_filepath):
-                unzip(zipped_filepath)
-            else:
-                warnings.warn("File %s is missing from the dataset: skipping "
-                              "this location." % zipped_filepath)
-                filepath_found = False
-        elif internet_connected:
-            target_folder = "Data/GSOD/gsod_"+str(year)
-            if not os.path.exists(target_folder):
-                print "Creating locally the folder %s." % target_folder
-                os.mkdir(target_folder)
-            # Download the file from NCDC
-            if data_source == 'NCDC':
-                remote_location = str(year)
-            remote_target = os.path.join(remote_location, filename+".gz")
-            retrieve_file(data_source, remote_target, zipped_filepath)
-            if os.path.isfile(zipped_filepath):
-                unzip(zipped_filepath)
-            else:
-                filepath_found = False
+    to_sync = []
+    for filename, (size, remote_date) in sorted(listing.items()):
+        if filename == info2filepath(year):
+            # Station files are mirrored individually
+            continue
+        local_filepath = os.path.join(folder_location, filename)
+        entry = manifest.get(local_filepath)
+        if entry is None:
+            if (manifest.is_present(local_filepath) and
+                os.path.getsize(local_filepath) == size):
+                manifest.record(local_filepath, size, remote_date)
+                continue
+            changed = os.path.exists(local_filepath)
+        elif entry["size"] == size and entry["remote_date"] in [None,
+                                                                remote_date]:
+            if manifest.is_complete(local_filepath):
+                if entry["remote_date"] is None:
+                    manifest.record(local_filepath, size, remote_date)
+                continue
+            # Interrupted retrieval: resumed
+            changed = False
         else:
-            filepath_found = False
-        
-    if filepath_found:
-        return datafile2pandas(filepath)
+            changed = True
+        to_sync.append((filename, size, remote_date, changed))
+    return to_sync
+
+def sync_mirror(years, listing_cache, manifest, data_source = 'NCDC',
+                url_base = None, num_workers = 8, max_per_host = 4,
+                missing_cache = None, dry_run = False):
+    """ Bring the local station files of a range of years up to date with the
+    data source: retrieve the ones that are new or changed since they were
+    retrieved, num_workers at a time (at most max_per_host connections to
+    the server). A year that can't be listed is skipped with a warning.
+
+    Inputs:
+    - years, list(int). Years to synchronize.
+    - listing_cache, ListingCache. Listings of the server reused while they
+      are fresh.
+    - manifest, DownloadManifest. Record of the files retrieved, updated with
+      the files synchronized.
+    - missing_cache, MissingFileCache. Updated with the content of the
+      listings.
+    - dry_run, bool. Only list the files that would be retrieved.
+
+    Returns a dict mapping each year to the list of local filepaths retrieved
+    (to retrieve if dry_run).
+    """
+    on_missing = None
+    if missing_cache is not None:
+        on_missing = record_missing_target(missing_cache)
+    synced = {}
+    try:
+        for year in years:
+            listing = listing_cache.get(year)
+            if listing is None:
+                try:
+                    listing = list_yearly_files(year, missing_cache = missing_cache,
+                                                url_base = url_base)
+                except (OSError,) + ftplib.all_errors as e:
+                    # Connection failures and temporary errors (421) too
+                    warnings.warn("Skipping year %s: %s" % (year, e))
+                    continue
+                listing_cache.put(year, listing)
+            to_sync = files_to_sync(year, listing, manifest)
+            folder_location = os.path.join("Data", "GSOD", "gsod_"+str(year))
+            file_list = [(os.path.join(str(year), filename),
+                          os.path.join(folder_location, filename))
+                         for filename, size, remote_date, changed in to_sync]
+            print("%s: %s files listed, %s to retrieve."
+                  % (year, len(listing), len(to_sync)))
+            if dry_run or not to_sync:
+                synced[year] = [local_filepath for remote_target, local_filepath
+                                in file_list]
+                continue
+            if not os.path.isdir(folder_location):
+                os.makedirs(folder_location)
+            expected_sizes = {}
+            for (remote_target, local_filepath), (filename, size, remote_date,
+                                                  changed) in zip(file_list,
+                                                                  to_sync):
+                expected_sizes[remote_target] = size
+                if changed:
+                    # Changed on the server: the local content can't be
+                    # resumed
+                    manifest.forget(local_filepath)
+                    for filepath in [local_filepath, 
+                                     local_filepath+PARTIAL_SUFFIX]:
+                        if os.path.exists(filepath):
+                            os.remove(filepath)
+            retrieved = set(retrieve_files(data_source, file_list,
+                                           num_workers = num_workers,
+                                           max_per_host = max_per_host,
+                                           url_base = url_base,
+                                           on_missing = on_missing,
+                                           expected_sizes = expected_sizes,
+                                           manifest = manifest))
+            for (remote_target, local_filepath), (filename, size, remote_date,
+                                                  changed) in zip(file_list,
+                                                                  to_sync):
+                if local_filepath in retrieved:
+                    manifest.record(local_filepath, size, remote_date)
+            synced[year] = [local_filepath for remote_target, local_filepath
+                            in file_list if local_filepath in retrieved]
+    finally:
+        listing_cache.save()
+        manifest.save()
+        if missing_cache is not None:
+            missing_cache.save()
+    return synced
 
+def collect_planned_records(plan, year, data_source = 'NCDC', num_workers = 1,
+                            max_per_host = 4, url_base = None,
+                            missing_cache = None, record_cache = None,
+                            manifest = None):
+    """ Read the records of a year of a CollectionPlan: retrieve the remote
+    files of the year (num_workers at a time), and read only the files
+    available. The files retrieved are recorded in manifest.
+
+    Output:
+    - dict mapping the "WMO-WBAN" key of the stations with data to their
+    records.
+    """
+    retrieved = set()
+    remote_files = plan.remote_files(year)
+    if remote_files:
+        target_folder = os.path.join("Data", "GSOD", "gsod_"+str(year))
+        if not os.path.exists(target_folder):
+            print "Creating locally the folder %s." % target_folder
+            os.mkdir(target_folder)
+        print("Retrieving %s station files for %s with %s workers..."
+              % (len(remote_files), year, num_workers))
+        on_missing = None
+        if missing_cache is not None:
+            on_missing = record_missing_target(missing_cache)
+        retrieved.update(retrieve_files(data_source, remote_files,
+                                        num_workers = num_workers,
+                                        max_per_host = max_per_host,
+                                        url_base = url_base,
+                                        on_missing = on_missing,
+                                        manifest = manifest))
+    data = {}
+    for entry in plan.select(year):
+        if entry.source in [LOCAL, ARCHIVE] or entry.filepath in retrieved:
+            records = read_station_records(entry.filepath, record_cache,
+                                           entry.tar_filepath)
+            key = "%s-%s" % (entry.location_WMO, entry.location_WBAN)
+            data[key] = records
+    return data
+
+def collect_planned_year(plan, year, data_source = 'NCDC', num_workers = 1,
+                         max_per_host = 4, url_base = None,
+                         missing_cache = None, record_cache = None,
+                         manifest = None):
+    """ Collect the data of a year of a CollectionPlan (see
+    collect_planned_records).
+
+    Output:
+    - DataFrame if the plan contains only one station (None if there is no
+    data for it), StationCube over all the days of the year otherwise.
+    """
+    data = collect_planned_records(plan, year, data_source, num_workers,
+                                   max_per_host, url_base, missing_cache,
+                                   record_cache, manifest)
+    if len(plan.stations) == 1:
+        return records2pandas(data.values()[0]) if data else None
+    # All stations aligned at once over the entire year, in case there are
+    # missing values
+    dates = daily_dates(datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+    return StationCube.from_records(data, dates = dates,
+                                    measurements = GSOD_MEASUREMENT_COLS)
+
+def collect_year_at_loc(year, location_WMO, location_WBAN, data_source = 'NCDC', 
+                        internet_connected = True, url_base = None,
+                        missing_cache = None, record_cache = None,
+                        manifest = None):
+    """ Collect the data GSOD data file for specified location and specified
+    year, through a plan of that single station-year (see plan_collection
+    and collect_planned_year): the local file, the yearly tar file or the data
+    source, unless the file is known not to exist.
+
+    Output:
+    - DataFrame, None if there is no data for that location and year.
+    """
+    # The range of years of data of the station is unknown: only the caches
+    # can rule the file out
+    station = np.array([(location_WMO, location_WBAN, "", "")],
+                       dtype = [("USAF", int), ("WBAN", int), ("BEGIN", "S8"),
+                                ("END", "S8")])
+    plan = plan_collection([year], station,
+                           internet_connected = internet_connected,
+                           missing_cache = missing_cache,
+                           record_cache = record_cache, manifest = manifest)
+    return collect_planned_year(plan, year, data_source, url_base = url_base,
+                                missing_cache = missing_cache,
+                                record_cache = record_cache,
+                                manifest = manifest)
 
 def count_op_files(folder):
     return len([filename for filename in os.listdir(folder) 
                 if os.path.splitext(filename)[1] in [".op", ".gz"]])
 
-def collect_year(year, data_source = 'NCDC'):
+def collect_year(year, data_source = 'NCDC', url_base = None, num_workers = 1,
+                 chunk_size = 64, out_of_core = False, store_filepath = None,
+                 record_cache = None, manifest = None):
     """ Collect the GSOD data file for all locations for the specified
     year. Look locally for the tar file first. If it is not there, and its gzip
     version is not either, use the ftp connection to retrieve it from data
-    source.
+    source. num_workers, chunk_size and record_cache control the parsing of
+    the files (see datafolder2pandas).
+
+    If out_of_core is True, or if the year doesn't fit in memory, the data is
+    streamed into a table of the HDF5 file store_filepath (by default
+    Data/GSOD/gsod_<year>.h5) and a HDFStoreHandle to it is returned instead
+    of a StationCube.
+
+    If a DownloadManifest is passed, a tar file recorded in it is only
+    extracted if it is complete, and one it doesn't know only if no partial
+    retrieval of it is pending (see DownloadManifest.is_present). Otherwise
+    the tar file is retrieved again, resuming the pending retrieval if the
+    remote file hasn't changed since.
     """
     filename = info2filepath(year)
     local_folderpath = os.path.join("Data", "GSOD", "gsod_"+str(year))
@@ -243,69 +590,105 @@ def collect_year(year, data_source = 'NCDC'):
         os.mkdir(local_folderpath)
     if count_op_files(local_folderpath) < 10:
         # probably not all the data files are present
-        if not os.path.exists(local_filepath):
+        if manifest is None:
+            complete = os.path.exists(local_filepath)
+        else:
+            complete = manifest.is_present(local_filepath)
+        if not complete:
             # tar file not present either: download it!
             if data_source == 'NCDC':
                 remote_location = str(year)
             print("Retrieving archive %s... This may take several minutes." 
                   % local_filepath)
             remote_target = os.path.join(remote_location, filename)
-            retrieve_file(data_source, remote_target, local_filepath)
+            if not retrieve_file(data_source, remote_target, local_filepath,
+                                 url_base = url_base, manifest = manifest):
+                raise IOError("Unable to retrieve the archive %s." 
+                              % local_filepath)
         untar(local_filepath)
+    if store_filepath is None:
+        store_filepath = os.path.join("Data", "GSOD", "gsod_%s.h5" % year)
+    store_key = "gsod_%s" % year
+    if out_of_core:
+        return datafolder2store(local_folderpath, store_filepath, store_key)
     try:
-        panda = datafolder2pandas(local_folderpath)
+        panda = datafolder2pandas(local_folderpath, num_workers, chunk_size,
+                                  record_cache)
     except MemoryError:
         # For years where there is a large amount of data, it is not possible to
-        # load everything in memory
-        # FIXME: load the data in a memory mapped/pytable stored pandas in this
-        # case? Clarify because the memory error is thrown by mmap. It may be
-        # doing this already, but be running into mmap limitations?
+        # load everything in memory: stream it to disk instead
         warnings.warn("The year %s contains too much data to be loaded into a "
-                      "single object in memory")
-        panda = None
+                      "single object in memory: storing it in %s" 
+                      % (year, store_filepath))
+        panda = datafolder2store(local_folderpath, store_filepath, store_key)
     return panda
 
-def search_station_codes(part_station_name, location_dict):
+def search_station_codes(part_station_name, location_dict, station_index = None,
+                         regex = False):
     """ Search for all station names that contain the string part_station_name
-    and return their location codes. 
-    FIXME: Add regex support
+    (or match it as a regular expression if regex is True) and return their
+    location codes. The search is served by the StationIndex if provided.
     """
-    return [(key, location_dict[key]) for key in location_dict.keys()
-            if key.lower().find(part_station_name.lower()) != -1]
+    if station_index is None:
+        if regex:
+            pattern = re.compile(part_station_name, re.IGNORECASE)
+            return [(key, location_dict[key]) for key in location_dict.keys()
+                    if pattern.search(key)]
+        return [(key, location_dict[key]) for key in location_dict.keys()
+                if key.lower().find(part_station_name.lower()) != -1]
+    if regex:
+        positions = station_index.name_regex(part_station_name)
+    else:
+        positions = station_index.name_contains(part_station_name)
+    names = np.unique(station_index.names[positions]).tolist()
+    return [(name, location_dict[name]) for name in names 
+            if name in location_dict]
 
 def search_station(location_db, location_dict, station_name = None, 
                    exact_station = False, WMO_location = None,
-                   WBAN_location = None, country_code = None, state_code = None):
+                   WBAN_location = None, country_code = None, state_code = None,
+                   name_match = "substring", station_index = None):
     """ Search for a station from part of its name, its location, its country code and/or its state.
     Inputs:
     - location_db, struct array: database of locations and all its metadata (location codes,
       country, state, coord, elevation, ...). It is generated from the function
       read_ish_history() for the NCDC data source. 
+    - name_match, str. How station_name is matched against the station names
+      (ignoring case) if exact_station is False: 'substring', 'prefix' or
+      'regex'.
+    - station_index, StationIndex. Index over location_db serving the search.
+      Pass it when searching repeatedly: if not provided, the stations are
+      scanned, which is cheaper than building an index for a single search.
     """
-    L = len(location_db)
-    mask = np.ones(L, dtype = np.bool)
+    if name_match not in ["substring", "prefix", "regex"]:
+        raise ValueError("Unknown station name matching %s: must be "
+                         "'substring', 'prefix' or 'regex'." % name_match)
+    if station_index is not None:
+        positions = station_index.search(station_name, exact_station,
+                                         name_match, WMO_location,
+                                         WBAN_location, country_code,
+                                         state_code)
+        return location_db[positions]
+    mask = np.ones(len(location_db), dtype = bool)
     if station_name:
+        names = location_db['STATION_NAME']
         if exact_station:
-            match_station = location_db['STATION_NAME'] == station_name
+            match_station = names == station_name
+        elif name_match == "regex":
+            pattern = re.compile(station_name, re.IGNORECASE)
+            match_station = np.array([pattern.search(name) is not None
+                                      for name in names], dtype = bool)
+        elif name_match == "prefix":
+            match_station = np.char.startswith(np.char.lower(names),
+                                               station_name.lower())
         else:
-            # Allow for partial station name
-            match_station_idx = [idx for idx,name in enumerate(location_db['STATION_NAME'])
-                                 if station_name.lower() in name.lower()]
-            match_station = np.zeros(L, dtype = np.bool)
-            match_station[match_station_idx] = True
-        mask = mask & match_station
-    if WMO_location:
-        match_wmo = location_db['USAF'] == WMO_location
-        mask = mask & match_wmo
-    if WBAN_location:
-        match_wban = location_db['WBAN'] == WBAN_location
-        mask = mask & match_wban
-    if country_code:
-        match_country = location_db['CTRY_WMO'] == country_code
-        mask = mask & match_country
-    if state_code:
-        match_state = location_db['ST'] == state_code
-        mask = mask & match_state
+            match_station = np.char.find(np.char.lower(names),
+                                         station_name.lower()) != -1
+        mask &= match_station
+    for column, value in [("USAF", WMO_location), ("WBAN", WBAN_location),
+                          ("CTRY_WMO", country_code), ("ST", state_code)]:
+        if value:
+            mask &= location_db[column] == value
     return location_db[mask]
 
 class GSODDataReader(HasTraits):
@@ -313,29 +696,263 @@ class GSODDataReader(HasTraits):
     """
     data_source = Enum("All", "NCDC")
     
-    # Metadata
-    location_db = Array()
-    location_dict = Dict()
+    # Metadata, loaded the first time they are needed
+    location_db = Property(Array)
+    location_dict = Property(Dict)
+    _location_db = Any
+    _location_dict = Any
+    # Index serving the station searches, built the first time it is needed
+    station_index = Property(Instance(StationIndex))
+    _station_index = Any
+    # Index over the station coordinates, built the first time it is needed
+    spatial_index = Property(Instance(SpatialIndex))
+    _spatial_index = Any
+
+    # Number of station files retrieved concurrently when collecting multiple
+    # locations (at most max_connections_per_host to a single server). 1
+    # retrieves them one after the other.
+    download_workers = Int(8)
+    # Maximum number of simultaneous connections to a single server (size of
+    # the pool of FTP sessions to it)
+    max_connections_per_host = Int(4)
+    # Root URL of the remote data tree if not the data source's default server
+    # (mirror, local test server). Empty string for the default.
+    url_base = Str()
+
+    # Number of processes parsing the station files when collecting a whole
+    # year, and number of files handed to a process at a time
+    parse_workers = Int(1)
+    parse_chunk_size = Int(64)
 
-    def __init__(self, data_source = 'NCDC'):
+    # Stream the whole years collected into HDF5 files instead of loading
+    # them in memory
+    out_of_core = Bool(False)
+
+    # Negative cache of the station files that don't exist on the data source
+    missing_cache = Instance(MissingFileCache)
+    # Cache of the parsed station files
+    record_cache = Instance(ParsedRecordCache)
+    # Record of the files completely retrieved from the data source
+    download_manifest = Instance(DownloadManifest)
+    # Cache of the listings of the data source used to synchronize the
+    # local files
+    listing_cache = Instance(ListingCache)
+
+    def __init__(self, data_source = 'NCDC', **traits):
         """ Initialization of the reader
         """
-        self.location_db = read_ish_history()
-        self.location_dict = initialize_location_dict(self.location_db)
+        super(GSODDataReader, self).__init__(**traits)
+        if self.missing_cache is None:
+            self.missing_cache = MissingFileCache()
+        if self.record_cache is None:
+            self.record_cache = ParsedRecordCache()
+        if self.download_manifest is None:
+            self.download_manifest = DownloadManifest()
+        if self.listing_cache is None:
+            self.listing_cache = ListingCache()
+
+    def _get_location_db(self):
+        if self._location_db is None:
+            self.location_db = read_ish_history()
+        return self._location_db
+
+    def _set_location_db(self, location_db):
+        self._location_db = location_db
+        self._location_dict = None
+        self._station_index = None
+        self._spatial_index = None
+        # The traits passed to the constructor can be set before the caches
+        # exist: the missing_cache is seeded when it is assigned then
+        if self.missing_cache is not None:
+            self.missing_cache.seed_from_ish_history(location_db)
+
+    def _missing_cache_changed(self, missing_cache):
+        if missing_cache is not None and self._location_db is not None:
+            missing_cache.seed_from_ish_history(self._location_db)
+
+    def _get_location_dict(self):
+        if self._location_dict is None:
+            self._location_dict = initialize_location_dict(self.location_db)
+        return self._location_dict
+
+    def _set_location_dict(self, location_dict):
+        self._location_dict = location_dict
         
-    def search_station_codes(self, part_station_name):
-        return search_station_codes(part_station_name, self.location_dict)
+    def _get_station_index(self):
+        if self._station_index is None:
+            self._station_index = StationIndex(self.location_db)
+        return self._station_index
+
+    def _get_spatial_index(self):
+        if self._spatial_index is None:
+            self._spatial_index = SpatialIndex(self.location_db)
+        return self._spatial_index
+
+    def search_station_codes(self, part_station_name, regex = False):
+        return search_station_codes(part_station_name, self.location_dict,
+                                    self.station_index, regex)
 
     def search_station(self, station_name = None, exact_station = False, 
                        location_WMO = None, location_WBAN = None, 
-                       country = None, state = None):
+                       country = None, state = None, name_match = "substring"):
         return search_station(self.location_db, self.location_dict,
                               station_name, exact_station, location_WMO, 
-                              location_WBAN, country, state)
+                              location_WBAN, country, state, name_match,
+                              self.station_index)
+
+    def stations_near(self, latitude, longitude, num_stations = 1,
+                      year_start = None, year_end = None):
+        """ Search for the stations closest to a point.
+
+        Inputs:
+        - latitude, longitude, float, float. Coordinates of the point in
+          degrees (North and East positive).
+        - num_stations, int. Number of stations to return.
+        - year_start, year_end, int, int. If provided, only consider the
+          stations that have data between these years (included) according
+          to the ish-history data.
+
+        Output:
+        - struct array of the metadata of the stations, closest first.
+        """
+        positions, distances = self.spatial_index.nearest(latitude, longitude,
+                                                          num_stations,
+                                                          year_start, year_end)
+        return self.location_db[positions]
+
+    def stations_within(self, latitude, longitude, radius, year_start = None,
+                        year_end = None):
+        """ Search for the stations less than radius km away from a point.
+        See stations_near for the other inputs.
+
+        Output:
+        - struct array of the metadata of the stations, closest first.
+        """
+        positions, distances = self.spatial_index.within_radius(latitude,
+                                                                longitude,
+                                                                radius,
+                                                                year_start,
+                                                                year_end)
+        return self.location_db[positions]
+
+    def stations_in_box(self, lat_min, lat_max, lon_min, lon_max,
+                        year_start = None, year_end = None):
+        """ Search for the stations inside a latitude/longitude box, in
+        degrees. If lon_min is larger than lon_max, the box crosses the 180th
+        meridian. See stations_near for the other inputs.
+
+        Output:
+        - struct array of the metadata of the stations.
+        """
+        positions = self.spatial_index.in_box(lat_min, lat_max, lon_min,
+                                              lon_max, year_start, year_end)
+        return self.location_db[positions]
+
+    def sync_mirror(self, year_list = [], year_start = None, year_end = None,
+                    dry_run = False):
+        """ Bring the local station files of the years requested up to date
+        with the data source: only the files new or changed on the server are
+        retrieved, download_workers at a time. The listings of the server are
+        cached (see listing_cache), so repeated synchronizations are cheap.
+
+        Inputs:
+        - year_list, list(int). The list of years to synchronize.
+        - year_start, year_end, int, int. Fed to range if year_list is empty.
+        - dry_run, bool. Only list the files that would be retrieved.
+
+        Output:
+        - dict mapping each year to the list of local filepaths retrieved (to
+          retrieve if dry_run).
+        """
+        if len(year_list) == 0:
+            year_list = range(year_start, year_end, 1)
+        return sync_mirror(sorted(year_list), self.listing_cache,
+                           self.download_manifest,
+                           url_base = self.url_base or None,
+                           num_workers = max(self.download_workers, 1),
+                           max_per_host = self.max_connections_per_host,
+                           missing_cache = self.missing_cache,
+                           dry_run = dry_run)
+
+    def plan_collection(self, year_list = [], year_start = None,
+                        year_end = None, station_name = None,
+                        exact_station = False, location_WMO = None,
+                        location_WBAN = None, country = None, state = None,
+                        internet_connected = True):
+        """ Work out which station-years of a request exist and where each one
+        will come from (local file, yearly archive, data source), from the
+        station metadata, the local files and the caches, without reading or
+        retrieving anything. The plan returned can be inspected (its summary
+        gives the counts and expected bytes per source) and then executed by
+        collect_data.
+
+        Inputs are identical to the collect_data method.
+
+        Output:
+        - CollectionPlan
+        """
+        if len(year_list) == 0:
+            year_list = range(year_start, year_end, 1)
+        stations = self.search_station(station_name, exact_station,
+                                       location_WMO, location_WBAN,
+                                       country, state)
+        return plan_collection(sorted(year_list), stations,
+                               internet_connected = internet_connected,
+                               missing_cache = self.missing_cache,
+                               record_cache = self.record_cache,
+                               manifest = self.download_manifest)
+
+    def _collect_planned_year(self, plan, year):
+        return collect_planned_year(plan, year,
+                                    num_workers = self.download_workers,
+                                    max_per_host = self.max_connections_per_host,
+                                    url_base = self.url_base or None,
+                                    missing_cache = self.missing_cache,
+                                    record_cache = self.record_cache,
+                                    manifest = self.download_manifest)
+
+    def collect_planned_records(self, plan, year_list = None):
+        """ Read the records of the station files of a CollectionPlan over a
+        list of years (all the years of the plan by default). Only the files
+        of the plan that exist are read or retrieved.
+
+        Output:
+        - dict mapping the "WMO-WBAN" key of the stations with data to their
+        records, all years concatenated.
+        """
+        if year_list is None:
+            year_list = plan.years
+        data = {}
+        try:
+            for year in year_list:
+                year_data = collect_planned_records(plan, year,
+                                num_workers = self.download_workers,
+                                max_per_host = self.max_connections_per_host,
+                                url_base = self.url_base or None,
+                                missing_cache = self.missing_cache,
+                                record_cache = self.record_cache,
+                                manifest = self.download_manifest)
+                for key, records in year_data.items():
+                    data.setdefault(key, []).append(records)
+        finally:
+            self._save_caches()
+        return dict((key, np.concatenate(records))
+                    for key, records in data.items())
+
+    def query(self):
+        """ Start a lazy query on the GSOD data: see GSODQuery. Nothing is
+        collected until it is executed.
+        """
+        return GSODQuery(self)
+
+    def _save_caches(self):
+        self.missing_cache.save()
+        self.record_cache.save()
+        self.download_manifest.save()
 
     def collect_year(self, year=None, station_name=None, exact_station = False, 
                     location_WMO=None, location_WBAN=None, country=None, 
-                    state=None, internet_connected = True):
+                    state=None, internet_connected = True, out_of_core = None):
         """ Process a request for data for a given year at a given location 
         optionaly.
 
@@ -348,11 +965,19 @@ class GSODDataReader(HasTraits):
           ones containing the string station_name are selected.
         - location WMO code and/or WBAN code, int, int. If no location is selected,
         collect the yearly data for all locations.
+        - out_of_core, bool. Whether the yearly data for all locations is
+          stored in an HDF5 file. Defaults to self.out_of_core.
+
+        The station files are planned first (see plan_collection): only the
+        ones that exist are read or retrieved, download_workers at a time.
 
         Output:
-        - pandas data structure: 2D (DataFrame) if only one location is
-        requested, 3D (panel) if multiple locations are requested
+        - DataFrame if only one location is requested, StationCube
+        (station x date x measurement) if multiple locations are requested,
+        HDFStoreHandle if the yearly data is stored out of core
         """
+        if out_of_core is None:
+            out_of_core = self.out_of_core
         if year is None:
             year = datetime.datetime.today().year
             warnings.warn("No year was provided: using the current one (%s)" 
@@ -363,78 +988,108 @@ class GSODDataReader(HasTraits):
                        state is None)
         if no_location:
             # Requested all data for the year that is at all locations. Returns
-            # a panel if it can fit in memory, and None if not. In the latter
-            # case, the data files are still stored locally. 
-            return collect_year(year)
+            # a StationCube if it can fit in memory, and a handle to the data
+            # streamed into an HDF5 file if not (or if out_of_core is set).
+            try:
+                return collect_year(year, url_base = self.url_base or None,
+                                    num_workers = self.parse_workers,
+                                    chunk_size = self.parse_chunk_size,
+                                    record_cache = self.record_cache,
+                                    out_of_core = out_of_core,
+                                    manifest = self.download_manifest)
+            finally:
+                self._save_caches()
         else:
-            filtered = search_station(self.location_db, self.location_dict,
-                                      station_name, exact_station, location_WMO, location_WBAN,
-                                      country, state)
-            if len(filtered) == 1:
-                result = collect_year_at_loc(year, location_WMO = filtered['USAF'][0],
-                                             location_WBAN = filtered['WBAN'][0], 
-                                             internet_connected = internet_connected)
-            else:
-                data = {}
-                for layer in filtered:
-                    df = collect_year_at_loc(year, layer['USAF'], layer['WBAN'], 
-                                             internet_connected = internet_connected)
-                    # reindex over the entire year in case there are missing values
-                    if df is None:
-                        continue
-                    df = df.reindex(pandas.DateRange(start = '1/1/%s' % year,
-                                                     end = '31/12/%s' % year,
-                                                     offset = pandas.datetools.day))
-                    key = "%s-%s" % (layer['USAF'], layer['WBAN'])
-                    data[key] = df
-                result = pandas.Panel(data)
+            plan = self.plan_collection([year], station_name = station_name,
+                                        exact_station = exact_station,
+                                        location_WMO = location_WMO,
+                                        location_WBAN = location_WBAN,
+                                        country = country, state = state,
+                                        internet_connected = internet_connected)
+            result = self._collect_planned_year(plan, year)
+            self._save_caches()
             return result
                 
     def collect_data(self, year_list=[], year_start = None, year_end = None, 
                 station_name=None, exact_station = False, location_WMO=None,
                 location_WBAN=None, country=None, state=None, 
-                internet_connected = True):
+                internet_connected = True, plan = None, buffer_filepath = None):
         """ Process a request for data possibly over multiple years. If the list
         is empty, 
 
         Inputs:
         - year_list, list(int). The list of years the data should be collected.
         - year_start, year_end, int, int. Fed to range if year_list is empty. 
+        - plan, CollectionPlan. Plan returned by plan_collection to execute.
+          If provided, the other inputs are ignored. If not, one is built for
+          the request when locations are selected.
+        - buffer_filepath, str. If provided, the years collected are
+          assembled in an array memory mapped to that file instead of in
+          memory, for results larger than the memory.
         - other inputs are identical to collect_year method
 
         Output:
-        - pandas data structure: 2D (DataFrame) if only one location is
-        requested, 3D (panel) if multiple locations are requested
+        - DataFrame if only one location is requested, StationCube
+        (station x date x measurement) if multiple locations are requested.
+        If a year is stored out of core (out_of_core is set or it doesn't fit
+        in memory), all the years are: the list of HDFStoreHandle to them is
+        returned, in the order of the years.
         """
-        if len(year_list) == 0:
+        no_location = (location_WMO is None and location_WBAN is None
+                       and station_name is None and country is None and
+                       state is None)
+        if plan is None and not no_location:
+            plan = self.plan_collection(year_list, year_start, year_end,
+                                        station_name, exact_station,
+                                        location_WMO, location_WBAN, country,
+                                        state, internet_connected)
+        if plan is not None:
+            year_list = plan.years
+            print plan.summary()
+        elif len(year_list) == 0:
             year_list = range(year_start, year_end, 1)
         else:
             year_list.sort()
 
         result = None
+        pieces = []
+        piece_years = []
+        stored_years = []
         print "Collecting data for years %s." % year_list
         for year in year_list:
-            year_data = self.collect_year(year, station_name, exact_station,
-                                          location_WMO, location_WBAN, country,
-                                          state, internet_connected = internet_connected)
+            if plan is None:
+                # Once a year is stored out of core, the next ones are too
+                year_data = self.collect_year(year,
+                                              internet_connected = internet_connected,
+                                              out_of_core = bool(stored_years) or None)
+            else:
+                year_data = self._collect_planned_year(plan, year)
             if year_data is None:
                 continue
+            elif isinstance(year_data, HDFStoreHandle):
+                # The years already collected in memory are stored too, so
+                # that all the years are returned the same way
+                for piece_year in piece_years:
+                    stored_years.append(self.collect_year(piece_year,
+                                        internet_connected = internet_connected,
+                                        out_of_core = True))
+                pieces, piece_years = [], []
+                stored_years.append(year_data)
+                continue
             else:
                 print("%s found with shape %s." % (type(year_data), 
                                                    year_data.shape))
-            if result:
-                if isinstance(year_data, pandas.DataFrame):
-                    result = result.append(year_data)
-                elif isinstance(year_data, pandas.Panel):
-                    try:
-                        result = pandas.concat([result, year_data], axis = 1)
-                    except AttributeError as e:
-                        warnings.warn("Attribute error raised: is pandas"
-                                      " up-to-date (version > 0.7)? Doing it"
-                                      " manually")
-                        result = append_panels(result, year_data)
-            else:
-                result = year_data
+            pieces.append(year_data)
+            piece_years.append(year)
+        # All years are assembled at once, into a single allocation
+        if len(pieces) == 1 and buffer_filepath is None:
+            result = pieces[0]
+        elif pieces:
+            result = concat_pandas(pieces, buffer_filepath)
+        if plan is not None:
+            self._save_caches()
+        if stored_years:
+            return stored_years
         return result
             
 if __name__ == "__main__":
@@ -443,20 +1098,21 @@ if __name__ == "__main__":
     dr = GSODDataReader()
     dr.search_station("austin", country = "US", state = "TX")
     dr.search_station("pari", country = "FR")
-    paris_data =  dr.collect_data([2007, 2008], station_name = "PARIS", country = "FR")
+    dr.stations_within(48.86, 2.35, 200, year_start = 2007, year_end = 2008)
+    paris_plan = dr.plan_collection([2007, 2008], station_name = "PARIS",
+                                    country = "FR")
+    print paris_plan
+    paris_data =  dr.collect_data(plan = paris_plan)
     
     # Pandas manipulation
     from extend_pandas import filter_data
     paris_data_temp = filter_data(paris_data, measurements = "TEMP")    
     paris_data_temp_downsampled = downsample(paris_data_temp, method = "average", offset = "unique_month")
 
-    # Custom filtration
-    def weighted_average(arr):
-        weights = np.array([1,2,3,4,3,2,1])
-        if len(arr) == 7:
-            return (arr*weights).sum()/weights.sum()
-        else:
-            return arr.mean()
+    # Custom filtration: weighted average of the full weeks (plain average of
+    # the incomplete ones)
+    from aggregators import WeightedAverage
+    weighted_average = WeightedAverage([1,2,3,4,3,2,1])
             
     filtered = filter_data(paris_data, measurements = ["TEMP", "WDSP"],
                            date_start = "2007/1/2", date_end = "2008/12/15",
@@ -465,6 +1121,20 @@ if __name__ == "__main__":
                            date_start = "2007/1/2", date_end = "2008/12/15",
                            downsampling_method = "average", offset = "unique_week")
 
+    # Same selection as a lazy query: only the data selected is collected
+    paris_query = (dr.query().stations(station_name = "PARIS", country = "FR")
+                   .dates("2007/1/2", "2008/12/15")
+                   .measurements(["TEMP", "WDSP"])
+                   .downsample("average", "unique_week"))
+    filtered3 = paris_query.execute()
+
+    # Persistent dataset: the queries on it only read the data they select
+    from gsod_dataset import GSODDataset
+    dataset = GSODDataset()
+    dataset.write(paris_data)
+    paris_temp_2008 = filter_data(dataset, measurements = "TEMP",
+                                  date_start = 2008, date_end = "2008/12/31")
+
     # Storage
     from extend_pandas import store_pandas
     data_dict = {"fil1": filtered, "fil2": filtered2}
@@ -0,0 +1,217 @@
+""" Persistent GSOD dataset, partitioned on disk so that queries only read
+the data they select.
+
+The dataset is partitioned by year, and each year is chunked by measurement:
+Data/GSOD/dataset/<year>/
+    partition.json    stations (rows), first day and measurements stored
+    TEMP.npy          float32 array (station x day of the year)
+    TEMP-count.npy    uint8 array for the int measurements of the cubes
+    ...
+The rows of the stations are sorted, and every year covers all its days. A
+query for some stations, dates and measurements (see GSODDataset.read) only
+opens the years and measurement files requested, memory mapped, and copies
+the rows of the stations and the range of days selected: the other stations,
+days and measurements are never read from disk.
+"""
+
+import datetime
+import json
+import os
+
+import numpy as np
+
+from station_cube import StationCube, daily_dates, to_day, is_int_type
+from file_sys_util import atomic_write
+
+# Location of the dataset
+DATASET_FOLDER = os.path.join("Data", "GSOD", "dataset")
+
+class GSODDataset(object):
+    """ GSOD data stored on disk, partitioned by year and chunked by
+    measurement. Written from StationCubes, read back into StationCubes.
+    """
+    def __init__(self, folder = None):
+        if folder is None:
+            folder = DATASET_FOLDER
+        self.folder = folder
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.folder)
+
+    def _partition_folder(self, year):
+        return os.path.join(self.folder, str(year))
+
+    def _info_filepath(self, year):
+        return os.path.join(self._partition_folder(year), "partition.json")
+
+    def _column_filepath(self, year, measurement):
+        return os.path.join(self._partition_folder(year), measurement+".npy")
+
+    def years(self):
+        """ Years stored, sorted.
+        """
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(int(name) for name in os.listdir(self.folder)
+                      if name.isdigit() and
+                         os.path.isfile(self._info_filepath(name)))
+
+    def partition_info(self, year):
+        """ Content of a year: dict with the list of "stations" (rows), the
+        "date_start" (first day, ISO format) and the list of "measurements".
+        None if the year is not stored.
+        """
+        filepath = self._info_filepath(year)
+        if not os.path.isfile(filepath):
+            return None
+        with open(filepath) as f_in:
+            return json.load(f_in)
+
+    def read_column(self, year, measurement):
+        """ Values of a measurement over a year (station x day), memory
+        mapped: nothing is read until they are accessed.
+        """
+        return np.load(self._column_filepath(year, measurement),
+                       mmap_mode = "r")
+
+    def write(self, cube):
+        """ Store a StationCube of daily data. The stations and measurements
+        of the years already stored are kept: the values of the cube
+        replace theirs on the days it covers.
+        """
+        if not cube.daily:
+            raise ValueError("Only daily data can be stored in the dataset.")
+        years = np.unique(cube.dates.astype("M8[Y]").astype(int) + 1970)
+        for year in years.tolist():
+            year_cube = cube.sel(date_start = datetime.date(year, 1, 1),
+                                 date_end = datetime.date(year, 12, 31))
+            self._write_year(year, year_cube)
+
+    def _write_year(self, year, cube):
+        dates = daily_dates(datetime.date(year, 1, 1),
+                            datetime.date(year, 12, 31))
+        stations = cube.stations
+        measurements = cube.columns
+        info = self.partition_info(year)
+        if info is not None:
+            stations = np.union1d(np.array(info["stations"]), stations)
+            measurements = info["measurements"] + \
+                [name for name in measurements
+                 if name not in info["measurements"]]
+        else:
+            stations = np.sort(stations)
+        positions = dict((station, i) for i, station
+                         in enumerate(stations.tolist()))
+        rows = [positions[station] for station in cube.stations.tolist()]
+        days = (cube.dates - dates[0]).astype(np.int64)
+
+        folder = self._partition_folder(year)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # The columns are written one at a time (in the type of the values
+        # of the cube), then the description of the partition that
+        # references them
+        for name in measurements:
+            if info is not None and name in info["measurements"]:
+                stored = self.read_column(year, name)
+            else:
+                stored = None
+            if name in cube.columns:
+                dtype = cube.column(name).dtype
+            else:
+                dtype = stored.dtype
+            column = np.empty((len(stations), len(dates)), dtype = dtype)
+            column.fill(0 if is_int_type(dtype) else np.nan)
+            if stored is not None:
+                column[[positions[station] for station in info["stations"]]] \
+                    = stored
+            if name in cube.columns:
+                column[np.ix_(rows, days)] = cube.column(name)
+            del stored
+            with atomic_write(self._column_filepath(year, name)) as f_out:
+                np.save(f_out, column)
+        info = {"stations": stations.tolist(),
+                "date_start": str(dates[0]),
+                "measurements": measurements}
+        with atomic_write(self._info_filepath(year), "w") as f_out:
+            json.dump(info, f_out)
+
+    def read(self, stations = None, date_start = None, date_end = None,
+             measurements = None, buffer_filepath = None):
+        """ Load the data of a list of stations, over a range of dates
+        (included) and for a list of measurements into a StationCube. None
+        selects all the stations, dates or measurements stored. The
+        selection is pushed down to the storage: only the years overlapping
+        the range of dates, the files of the measurements requested and in
+        them the rows of the stations and the days requested are read.
+
+        The stations requested that are not stored are ignored. The cube
+        is memory mapped to buffer_filepath if provided. The measurements
+        stored as uint8 or booleans are read as int measurements.
+        """
+        years = self.years()
+        if date_start is not None:
+            date_start = to_day(date_start)
+            first_year = date_start.astype("M8[Y]").astype(int) + 1970
+            years = [year for year in years if year >= first_year]
+        if date_end is not None:
+            date_end = to_day(date_end)
+            last_year = date_end.astype("M8[Y]").astype(int) + 1970
+            years = [year for year in years if year <= last_year]
+        infos = [self.partition_info(year) for year in years]
+
+        stored = set()
+        for info in infos:
+            stored.update(info["stations"])
+        if stations is None:
+            stations = sorted(stored)
+        else:
+            stations = [station for station in stations if station in stored]
+        if measurements is None:
+            measurements = infos[0]["measurements"] if infos else []
+        if years:
+            if date_start is None:
+                date_start = datetime.date(years[0], 1, 1)
+            if date_end is None:
+                date_end = datetime.date(years[-1], 12, 31)
+            dates = daily_dates(date_start, date_end)
+        else:
+            dates = np.array([], dtype = "M8[D]")
+        int_measurements = []
+        for name in measurements:
+            for year, info in zip(years, infos):
+                if name in info["measurements"]:
+                    if is_int_type(self.read_column(year, name).dtype):
+                        int_measurements.append(name)
+                    break
+        result = StationCube.empty(stations, dates,
+                                   [name for name in measurements
+                                    if name not in int_measurements],
+                                   buffer_filepath = buffer_filepath,
+                                   int_measurements = int_measurements)
+
+        for year, info in zip(years, infos):
+            positions = dict((station, i) for i, station
+                             in enumerate(info["stations"]))
+            targets = [i for i, station in enumerate(stations)
+                       if station in positions]
+            rows = [positions[stations[i]] for i in targets]
+            if not rows:
+                continue
+            partition_dates = daily_dates(datetime.date(year, 1, 1),
+                                          datetime.date(year, 12, 31))
+            days = result.date_positions(partition_dates)
+            inside = np.nonzero(days >= 0)[0]
+            if not len(inside):
+                continue
+            # Contiguous ranges of days, in the partition and in the result
+            day_start, day_end = inside[0], inside[-1]+1
+            target_days = slice(days[day_start],
+                                days[day_start] + day_end - day_start)
+            for name in measurements:
+                if name not in info["measurements"]:
+                    continue
+                column = self.read_column(year, name)
+                result.column(name)[targets, target_days] = \
+                    column[rows, day_start:day_end]
+        return result
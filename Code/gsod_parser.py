@@ -0,0 +1,265 @@
+""" Vectorized parser for the NCDC GSOD station files (.op, .op.gz).
+
+The GSOD files have a fixed column layout: every value sits at the same
+position on every line. Instead of splitting each line on whitespace, the
+whole file is loaded into a byte buffer, viewed as a (lines x characters)
+array, and each column is converted at once from its slice of characters.
+
+The flags attached to some of the values are split into their own columns:
+- MAX-flag, MIN-flag: True if the max/min temperature was derived from the
+  hourly data ('*' in the file) instead of being explicitly reported.
+- PRCP-flag: ASCII code of the letter (A to I) describing how the
+  precipitation was measured, 0 if there is none.
+
+The records use a compact layout:
+- measurements are stored in single precision. Missing values keep the GSOD
+  sentinels (9999.9, 999.9, 99.99) and must be compared with their single
+  precision value (np.float32(9999.9)).
+- counts of observations are stored as uint8.
+- the station codes (STN---, WBAN), identical on every line of a file, are
+  not stored: they are given by the filename (see filepath2info).
+- the 6 indicators of FRSHTT (fog, rain/drizzle, snow/ice pellets, hail,
+  thunder, tornado/funnel cloud) are packed into the bits of a uint8, read
+  like the digits in the file: fog is the most significant (32), tornado the
+  least significant (1). See unpack_frshtt.
+"""
+
+import numpy as np
+import pandas
+
+from file_sys_util import open_data_file
+
+# Position of each column on a line (0 based, end excluded) and type
+GSOD_COL_SPECS = [('STN---', 0, 6, np.int32),
+                  ('WBAN', 7, 12, np.int32),
+                  ('YEARMODA', 14, 22, 'M8[D]'),
+                  ('TEMP', 24, 30, np.float32),
+                  ('TEMP-count', 31, 33, np.uint8),
+                  ('DEWP', 35, 41, np.float32),
+                  ('DEWP-count', 42, 44, np.uint8),
+                  ('SLP', 46, 52, np.float32),
+                  ('SLP-count', 53, 55, np.uint8),
+                  ('STP', 57, 63, np.float32),
+                  ('STP-count', 64, 66, np.uint8),
+                  ('VISIB', 68, 73, np.float32),
+                  ('VISIB-count', 74, 76, np.uint8),
+                  ('WDSP', 78, 83, np.float32),
+                  ('WDSP-count', 84, 86, np.uint8),
+                  ('MXSPD', 88, 93, np.float32),
+                  ('GUST', 95, 100, np.float32),
+                  ('MAX', 102, 108, np.float32),
+                  ('MIN', 110, 116, np.float32),
+                  ('PRCP', 118, 123, np.float32),
+                  ('SNDP', 125, 130, np.float32),
+                  ('FRSHTT', 132, 138, np.uint8)]
+
+# Position of the flag characters
+GSOD_FLAG_SPECS = [('MAX-flag', 108, np.bool_),
+                   ('MIN-flag', 116, np.bool_),
+                   ('PRCP-flag', 123, np.uint8)]
+
+GSOD_LINE_WIDTH = 138
+
+# Indicators packed in FRSHTT, from the most significant bit
+FRSHTT_INDICATORS = ['Fog', 'Rain', 'Snow', 'Hail', 'Thunder', 'Tornado']
+
+# Columns of the parsed records, flags following the value they qualify
+GSOD_RECORD_COLS = ['YEARMODA', 'TEMP', 'TEMP-count',
+                    'DEWP', 'DEWP-count', 'SLP', 'SLP-count', 'STP',
+                    'STP-count', 'VISIB', 'VISIB-count', 'WDSP', 'WDSP-count',
+                    'MXSPD', 'GUST', 'MAX', 'MAX-flag', 'MIN', 'MIN-flag',
+                    'PRCP', 'PRCP-flag', 'SNDP', 'FRSHTT']
+
+# Columns of the records holding the measurements, indexed by YEARMODA
+GSOD_MEASUREMENT_COLS = [name for name in GSOD_RECORD_COLS if name != 'YEARMODA']
+
+_TYPES = dict([(name, col_type) for name, start, end, col_type in GSOD_COL_SPECS]
+              + [(name, col_type) for name, pos, col_type in GSOD_FLAG_SPECS])
+GSOD_RECORD_DTYPE = np.dtype([(name, _TYPES[name]) for name in GSOD_RECORD_COLS])
+
+# Columns converted from their digits
+_NUMBER_SPECS = [spec for spec in GSOD_COL_SPECS 
+                 if spec[0] in GSOD_RECORD_COLS and spec[0] != 'FRSHTT']
+
+SPACE = ord(" ")
+NEWLINE = ord("\n")
+POINT = ord(".")
+MINUS = ord("-")
+
+def _line_matrix(buf):
+    """ View a buffer of lines as a 2D array of characters, one line per row,
+    line ends included. Lines shorter than the longest one are padded with
+    spaces.
+    """
+    if len(buf) and buf[-1] != NEWLINE:
+        buf = np.append(buf, np.uint8(NEWLINE))
+    line_ends = np.flatnonzero(buf == NEWLINE)
+    if len(line_ends) == 0:
+        return np.empty((0, GSOD_LINE_WIDTH+1), dtype = np.uint8)
+    line_starts = np.hstack(([0], line_ends[:-1]+1))
+    lengths = line_ends - line_starts
+    width = max(lengths.max(), GSOD_LINE_WIDTH)
+    if np.all(lengths == width):
+        # All lines have the same length: no copy needed
+        return buf.reshape(len(line_ends), width+1)
+    padded = np.append(buf, np.zeros(width+1, dtype = np.uint8)+SPACE)
+    positions = np.arange(width+1)
+    matrix = padded[line_starts[:, np.newaxis] + positions]
+    matrix[positions >= lengths[:, np.newaxis]] = SPACE
+    return matrix
+
+def parse_numbers(chars):
+    """ Convert a 2D array of characters, one number per row, padded with
+    spaces, into an array of floats. Any layout of the numbers is supported.
+    """
+    num_rows, width = chars.shape
+    mantissa = np.zeros(num_rows, dtype = np.int64)
+    num_decimals = np.zeros(num_rows, dtype = np.int64)
+    after_point = np.zeros(num_rows, dtype = np.bool_)
+    for j in range(width):
+        digits = chars[:, j].astype(np.int64) - ord("0")
+        is_digit = (digits >= 0) & (digits <= 9)
+        mantissa = np.where(is_digit, mantissa*10 + digits, mantissa)
+        num_decimals += is_digit & after_point
+        after_point |= chars[:, j] == POINT
+    values = mantissa / 10.**num_decimals
+    values[(chars == MINUS).any(axis = 1)] *= -1
+    return values
+
+# Number of digits whose weighted sum is exact in single precision
+MAX_EXACT_DIGITS = 7
+
+def parse_columns(lines, col_specs):
+    """ Convert the numbers stored in fixed position columns of a 2D array of
+    characters (one line per row) into a 2D array of floats, one column per
+    (name, start, end, type) entry of col_specs.
+
+    When the decimal point of a column is at the same position on every line
+    (always the case for well formed GSOD files), each digit has a fixed
+    weight, and the integer mantissas of all the columns are computed at once
+    with a single matrix product of the digits with the weights. The other
+    columns are converted with parse_numbers.
+    """
+    num_rows, width = lines.shape
+    digits = lines - np.uint8(ord("0"))
+    digits *= digits <= 9
+    # Mantissas are summed in single precision by chunks of MAX_EXACT_DIGITS
+    # digits to stay exact
+    digits = digits.astype(np.float32)
+    points = lines == POINT
+    any_point = points.any(axis = 0)
+    all_point = points.all(axis = 0)
+    any_minus = (lines == MINUS).any(axis = 0)
+    weights = []
+    # (column index, scale) of each chunk of digits
+    chunks = []
+    num_decimals = np.zeros(len(col_specs))
+    irregular = []
+    for i, (name, start, end, col_type) in enumerate(col_specs):
+        point_positions = start + np.flatnonzero(any_point[start:end])
+        if len(point_positions) > 1 or not all_point[point_positions].all():
+            irregular.append(i)
+            continue
+        if len(point_positions):
+            num_decimals[i] = end-point_positions[0]-1
+        # Digit positions, from the least significant one
+        positions = [pos for pos in range(end-1, start-1, -1) 
+                     if pos not in point_positions]
+        for first in range(0, len(positions), MAX_EXACT_DIGITS):
+            chunk_positions = positions[first:first+MAX_EXACT_DIGITS]
+            chunk_weights = np.zeros(width, dtype = np.float32)
+            chunk_weights[chunk_positions] = 10.**np.arange(len(chunk_positions))
+            weights.append(chunk_weights)
+            chunks.append((i, 10.**first))
+    values = np.zeros((num_rows, len(col_specs)))
+    if chunks:
+        mantissas = np.dot(digits, np.array(weights).T).astype(np.float64)
+        for j, (i, scale) in enumerate(chunks):
+            values[:, i] += mantissas[:, j] * scale
+    # Mantissas are exact integers: dividing them gives correctly rounded values
+    values /= 10.**num_decimals
+    for i, (name, start, end, col_type) in enumerate(col_specs):
+        if i in irregular:
+            values[:, i] = parse_numbers(lines[:, start:end])
+        elif any_minus[start:end].any():
+            negative = (lines[:, start:end] == MINUS).any(axis = 1)
+            values[negative, i] *= -1
+    return values
+
+def parse_dates(digits):
+    """ Convert an array of YYYYMMDD numbers into datetime64 days.
+    """
+    years, month_days = divmod(digits.astype(np.int64), 10000)
+    months, days = divmod(month_days, 100)
+    months = ((years-1970)*12 + months-1).astype('M8[M]')
+    return months.astype('M8[D]') + (days-1).astype('m8[D]')
+
+def pack_frshtt(chars):
+    """ Pack the 6 characters ('0' or '1') of each row of a 2D array of
+    characters into the bits of a uint8, the first character being the most
+    significant bit.
+    """
+    bits = (chars == ord("1")).astype(np.uint8)
+    return np.dot(bits, 1 << np.arange(chars.shape[1]-1, -1, -1)).astype(np.uint8)
+
+def unpack_frshtt(values):
+    """ Unpack FRSHTT values into a 2D array of booleans, one column per
+    indicator of FRSHTT_INDICATORS.
+    """
+    values = np.asarray(values, dtype = np.uint8)
+    shifts = np.arange(len(FRSHTT_INDICATORS)-1, -1, -1)
+    return (values[:, np.newaxis] >> shifts) & 1 == 1
+
+def parse_gsod_buffer(content):
+    """ Parse the content of a GSOD file (header line included) into a
+    structured array of dtype GSOD_RECORD_DTYPE, one record per day.
+    """
+    if content.startswith("STN"):
+        # Skip the header line
+        content = content[content.find("\n")+1:]
+    buf = np.frombuffer(content, dtype = np.uint8)
+    lines = _line_matrix(buf)
+    # Drop blank lines: data lines always start with the station code
+    blank = (lines[:, 0] == SPACE) | (lines[:, 0] == NEWLINE)
+    if blank.any():
+        lines = lines[~blank]
+
+    records = np.empty(len(lines), dtype = GSOD_RECORD_DTYPE)
+    values = parse_columns(lines, _NUMBER_SPECS)
+    for i, (name, start, end, col_type) in enumerate(_NUMBER_SPECS):
+        if name == 'YEARMODA':
+            records[name] = parse_dates(values[:, i])
+        else:
+            records[name] = values[:, i]
+    for name, start, end, col_type in GSOD_COL_SPECS:
+        if name == 'FRSHTT':
+            records[name] = pack_frshtt(lines[:, start:end])
+    for name, pos, col_type in GSOD_FLAG_SPECS:
+        flags = lines[:, pos]
+        if col_type is np.bool_:
+            records[name] = flags == ord("*")
+        else:
+            records[name] = np.where(flags == SPACE, 0, flags)
+    return records
+
+def read_gsod_file(filepath):
+    """ Read a GSOD file (.op or .op.gz, or an opened file object) into a
+    structured array of dtype GSOD_RECORD_DTYPE.
+    """
+    if hasattr(filepath, "read"):
+        f_in = filepath
+    else:
+        f_in = open_data_file(filepath)
+    try:
+        content = f_in.read()
+    finally:
+        f_in.close()
+    return parse_gsod_buffer(content)
+
+def records2pandas(records):
+    """ Convert parsed GSOD records into a dataframe indexed by date.
+    """
+    index = pandas.DatetimeIndex(records['YEARMODA'].astype('M8[ns]'),
+                                 name = 'YEARMODA')
+    data = dict((name, records[name]) for name in GSOD_MEASUREMENT_COLS)
+    return pandas.DataFrame(data, index = index, columns = GSOD_MEASUREMENT_COLS)
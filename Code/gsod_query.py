@@ -0,0 +1,222 @@
+""" Lazy queries on the GSOD data.
+
+A GSODQuery (see GSODDataReader.query) records a selection of stations,
+years, range of dates, measurements and downsampling without collecting
+anything:
+
+    query = (reader.query().stations(station_name = "PARIS", country = "FR")
+             .dates("2007/01/02", "2008/12/15").measurements(["TEMP", "WDSP"])
+             .downsample("average", "unique_week"))
+    result = query.execute()
+
+When executed, the query is resolved as a whole: only the years overlapping
+the range of dates are planned, only the station files of the plan that
+exist are read or retrieved, and only the measurements and days selected
+are assembled, before downsampling. The result is the same as the one of
+collect_data followed by filter_data and downsample.
+"""
+
+import datetime
+
+import numpy as np
+
+from station_cube import StationCube, daily_dates, to_day
+from gsod_parser import GSOD_MEASUREMENT_COLS, records2pandas
+from extend_pandas import downsample, filter_data
+
+def to_query_day(date):
+    """ Convert a date accepted by filter_data (datetime, string in the
+    format YYYY/MM/DD, year for its first day, datetime64) to a datetime64
+    day. None is kept.
+    """
+    if date is None:
+        return None
+    if isinstance(date, basestring):
+        date = datetime.datetime.strptime(date, '%Y/%m/%d')
+    elif isinstance(date, (int, long, np.integer)) and date > 1800:
+        date = datetime.date(date, 1, 1)
+    return to_day(date)
+
+def day_year(day):
+    return int(day.astype("M8[Y]").astype(int)) + 1970
+
+class GSODQuery(object):
+    """ Lazy query on the data collected by a GSODDataReader. Each method
+    returns a new query with the selection updated: the query it is called
+    on is left unchanged.
+    """
+    def __init__(self, reader, **selection):
+        self.reader = reader
+        self.selection = dict(station_name = None, exact_station = False,
+                              location_WMO = None, location_WBAN = None,
+                              country = None, state = None, year_list = None,
+                              date_start = None, date_end = None,
+                              measurements = None, method = None,
+                              offset = None)
+        self.selection.update(selection)
+
+    def __repr__(self):
+        selected = ["%s=%r" % (key, value) for key, value
+                    in sorted(self.selection.items())
+                    if value not in [None, False]]
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(selected))
+
+    def _update(self, **selection):
+        query_selection = dict(self.selection)
+        query_selection.update(selection)
+        return GSODQuery(self.reader, **query_selection)
+
+    def stations(self, station_name = None, exact_station = False,
+                 location_WMO = None, location_WBAN = None, country = None,
+                 state = None):
+        """ Select the stations, as in GSODDataReader.search_station.
+        """
+        return self._update(station_name = station_name,
+                            exact_station = exact_station,
+                            location_WMO = location_WMO,
+                            location_WBAN = location_WBAN,
+                            country = country, state = state)
+
+    def years(self, year_list = [], year_start = None, year_end = None):
+        """ Select a list of years, or the years range(year_start, year_end)
+        as in collect_data.
+        """
+        if len(year_list) == 0:
+            if year_start is None or year_end is None:
+                raise ValueError("A list of years or both year_start and "
+                                 "year_end must be provided.")
+            year_list = range(year_start, year_end, 1)
+        return self._update(year_list = sorted(year_list))
+
+    def dates(self, date_start = None, date_end = None):
+        """ Select a range of dates (included). They can be given as in
+        filter_data: datetime objects, strings in the format YYYY/MM/DD,
+        years (for their first day) or datetime64.
+        """
+        return self._update(date_start = to_query_day(date_start),
+                            date_end = to_query_day(date_end))
+
+    def measurements(self, measurements):
+        """ Select the measurements (column names of the records).
+        """
+        if isinstance(measurements, str):
+            measurements = [measurements]
+        if not set(measurements).issubset(set(GSOD_MEASUREMENT_COLS)):
+            raise ValueError("%s is not a valid data type. Allowed values are "
+                             "%s." % (set(measurements) -
+                                      set(GSOD_MEASUREMENT_COLS),
+                                      GSOD_MEASUREMENT_COLS))
+        return self._update(measurements = list(measurements))
+
+    def downsample(self, method = "average", offset = "unique_week"):
+        """ Downsample the result (see extend_pandas.downsample).
+        """
+        return self._update(method = method, offset = offset)
+
+    def _year_list(self):
+        """ Years to collect: the years selected overlapping the range of
+        dates selected.
+        """
+        selection = self.selection
+        year_list = selection["year_list"]
+        if year_list is None:
+            if selection["date_start"] is None or selection["date_end"] is None:
+                raise ValueError("The years or the range of dates of the "
+                                 "query must be selected.")
+            year_list = range(day_year(selection["date_start"]),
+                              day_year(selection["date_end"])+1)
+        if selection["date_start"] is not None:
+            year_list = [year for year in year_list
+                         if year >= day_year(selection["date_start"])]
+        if selection["date_end"] is not None:
+            year_list = [year for year in year_list
+                         if year <= day_year(selection["date_end"])]
+        return year_list
+
+    def _no_location(self):
+        selection = self.selection
+        return (selection["location_WMO"] is None and
+                selection["location_WBAN"] is None and
+                selection["station_name"] is None and
+                selection["country"] is None and selection["state"] is None)
+
+    def plan(self, internet_connected = True):
+        """ CollectionPlan of the station files the query needs.
+        """
+        selection = self.selection
+        return self.reader.plan_collection(self._year_list(),
+                    station_name = selection["station_name"],
+                    exact_station = selection["exact_station"],
+                    location_WMO = selection["location_WMO"],
+                    location_WBAN = selection["location_WBAN"],
+                    country = selection["country"], state = selection["state"],
+                    internet_connected = internet_connected)
+
+    def execute(self, internet_connected = True, buffer_filepath = None):
+        """ Collect the data selected.
+
+        Output:
+        - DataFrame if only one station is selected, StationCube otherwise
+        (memory mapped to buffer_filepath if provided) or DataFrame with the
+        stations as columns if only one measurement is selected. The time
+        axis holds the keys of the periods of time if downsampled. None if
+        there is no data. If all the stations are selected and the years are
+        stored out of core, the list of HDFStoreHandle to them, unfiltered
+        (see GSODDataReader.collect_data).
+        """
+        selection = self.selection
+        year_list = self._year_list()
+        if not year_list:
+            return None
+        measurements = selection["measurements"] or GSOD_MEASUREMENT_COLS
+        date_start = to_day(datetime.date(year_list[0], 1, 1))
+        if selection["date_start"] is not None:
+            date_start = max(date_start, selection["date_start"])
+        date_end = to_day(datetime.date(year_list[-1], 12, 31))
+        if selection["date_end"] is not None:
+            date_end = min(date_end, selection["date_end"])
+
+        if self._no_location():
+            # All the stations of the years: collected from the yearly
+            # archives, then filtered
+            data = self.reader.collect_data(year_list,
+                            internet_connected = internet_connected,
+                            buffer_filepath = buffer_filepath)
+            if data is None or isinstance(data, list):
+                return data
+            return filter_data(data, measurements = selection["measurements"]
+                               or [], date_start = date_start,
+                               date_end = date_end,
+                               offset = selection["offset"],
+                               downsampling_method = selection["method"] or "")
+
+        plan = self.plan(internet_connected)
+        print plan.summary()
+        records = self.reader.collect_planned_records(plan, year_list)
+        if len(plan.stations) == 1:
+            if not records:
+                return None
+            records = records.values()[0]
+            days = records["YEARMODA"]
+            records = records[(days >= date_start) & (days <= date_end)]
+            result = records2pandas(records)
+            if selection["measurements"]:
+                result = result[selection["measurements"]]
+        else:
+            # Only the measurements and the days selected are assembled, over
+            # the years selected
+            year_dates = []
+            for year in year_list:
+                first_day = max(date_start, to_day(datetime.date(year, 1, 1)))
+                last_day = min(date_end, to_day(datetime.date(year, 12, 31)))
+                year_dates.append(daily_dates(first_day, last_day))
+            dates = np.concatenate(year_dates)
+            result = StationCube.from_records(records, dates = dates,
+                                              measurements = measurements,
+                                              buffer_filepath = buffer_filepath)
+            if len(measurements) == 1:
+                result = result.measurement(measurements[0])
+        if selection["method"] and selection["offset"]:
+            result = downsample(result, selection["method"],
+                                selection["offset"])
+        return result
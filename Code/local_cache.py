@@ -0,0 +1,463 @@
+""" Supporting module dealing with the local caches kept next to the GSOD data
+files to avoid repeating work across collections.
+"""
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from file_sys_util import file_signature, atomic_write
+from retrieve_remote import PARTIAL_SUFFIX
+from gsod_parser import GSOD_RECORD_DTYPE
+
+# Location of the caches
+CACHE_FOLDER = os.path.join("Data", "GSOD", "cache")
+
+# Default time to live of the observed missing files: 30 days
+MISSING_FILES_TTL = 30 * 24 * 3600
+
+# Default maximum size of the cache of parsed records: 2GB
+RECORD_CACHE_MAX_BYTES = 2 * 1024**3
+
+# Default time to live of the listings of the remote years: 12 hours
+LISTINGS_TTL = 12 * 3600
+
+def ish_year_range(location_db):
+    """ Extract the first and last year of data of each station from the BEGIN
+    and END columns of the ish-history data. Unknown years are set to -1.
+
+    Returns 2 int arrays.
+    """
+    def to_year(dates):
+        years = np.asarray(dates).astype("S4")
+        years = np.where(years == "", "-1", years)
+        return years.astype(np.int32)
+    return to_year(location_db["BEGIN"]), to_year(location_db["END"])
+
+def outside_year_range(year, begin, end, history_end):
+    """ Is year outside of the years of data of stations with data from
+    begin to end (ish-history BEGIN and END years, -1 if unknown)? The END
+    year of the ish-history data is the last year it covers (history_end,
+    the latest END year, None if unknown), not the end of the station: the
+    years from history_end on are never excluded. Works on scalars and
+    arrays.
+    """
+    known = (begin > 0) & (end > 0)
+    if history_end is None:
+        after_end = False
+    else:
+        after_end = (end < year) & (year < history_end)
+    return known & ((year < begin) | after_end)
+
+def load_cached_array(cache_filepath, source_filepath):
+    """ Load an array cached by store_cached_array, if the source file it was
+    built from hasn't changed since. Returns None otherwise.
+    """
+    if not os.path.isfile(cache_filepath):
+        return None
+    try:
+        content = np.load(cache_filepath)
+        try:
+            signature = content["signature"].tolist()
+            data = content["data"]
+        finally:
+            content.close()
+    except (IOError, KeyError, ValueError):
+        return None
+    if signature != file_signature(source_filepath):
+        return None
+    return data
+
+def store_cached_array(cache_filepath, source_filepath, data):
+    """ Store an array built from the content of source_filepath in a binary
+    file, along with the size and modification time of the source file.
+    """
+    folder = os.path.dirname(cache_filepath)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    with atomic_write(cache_filepath) as f_out:
+        np.savez(f_out, data = data, 
+                 signature = np.array(file_signature(source_filepath)))
+
+class MissingFileCache(object):
+    """ Persistent negative cache of the station-year files that don't exist
+    on the remote data source, keyed by (WMO code, WBAN code, year).
+
+    It combines:
+    - the range of years of data of each station, seeded from the BEGIN/END
+      columns of the ish-history file. Years before that range are always
+      considered missing, and so are the years after it that the file
+      covers: the years before the last END year of all its stations (the
+      year it was produced). Later years are not, since the file may be
+      older than the data.
+    - missing files observed when retrieving or listing files on the server.
+      These are stored on disk and expire after ttl seconds since the data
+      source may add them later.
+    """
+    def __init__(self, filepath = None, ttl = MISSING_FILES_TTL):
+        if filepath is None:
+            filepath = os.path.join(CACHE_FOLDER, "missing_files.json")
+        self.filepath = filepath
+        self.ttl = ttl
+        # Observed missing files: "WMO-WBAN-YEAR" -> time it was observed
+        self.missing = {}
+        # Observed missing years: "YEAR" -> time it was observed
+        self.missing_years = {}
+        # Range of data availability: (WMO, WBAN) -> (first year, last year)
+        self.year_ranges = {}
+        # Last year of data of the ish-history file: the years from it on
+        # are not covered entirely
+        self.history_end = None
+        self._lock = threading.Lock()
+        self._modified = False
+        self.load()
+
+    def load(self):
+        """ Load the observed missing files from disk, dropping the expired
+        ones.
+        """
+        if not os.path.isfile(self.filepath):
+            return
+        with open(self.filepath) as f_in:
+            content = json.load(f_in)
+        now = time.time()
+        self.missing = dict((key, observed) for key, observed 
+                            in content.get("missing", {}).items()
+                            if now - observed < self.ttl)
+        self.missing_years = dict((key, observed) for key, observed 
+                                  in content.get("missing_years", {}).items()
+                                  if now - observed < self.ttl)
+
+    def save(self):
+        """ Store the observed missing files on disk if they changed.
+        """
+        with self._lock:
+            if not self._modified:
+                return
+            content = {"missing": self.missing, 
+                       "missing_years": self.missing_years}
+            self._modified = False
+        folder = os.path.dirname(self.filepath)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with atomic_write(self.filepath, "w") as f_out:
+            json.dump(content, f_out)
+
+    def seed_from_ish_history(self, location_db):
+        """ Store the range of years of data of each station described in the
+        ish-history data (as returned by read_ish_history).
+        """
+        begin, end = ish_year_range(location_db)
+        known = (begin > 0) & (end > 0)
+        self.year_ranges = dict(zip(zip(location_db["USAF"][known], 
+                                        location_db["WBAN"][known]),
+                                    zip(begin[known], end[known])))
+        self.history_end = end[known].max() if known.any() else None
+
+    def _is_expired(self, observed):
+        return time.time() - observed >= self.ttl
+
+    def is_missing(self, location_WMO, location_WBAN, year):
+        """ Is the file for that location and year known not to exist?
+        """
+        year_range = self.year_ranges.get((location_WMO, location_WBAN))
+        if year_range is not None:
+            first_year, last_year = year_range
+            if outside_year_range(year, first_year, last_year,
+                                  self.history_end):
+                return True
+        for table, key in [(self.missing_years, str(year)), 
+                           (self.missing, "%s-%s-%s" % (location_WMO, 
+                                                        location_WBAN, year))]:
+            observed = table.get(key)
+            if observed is not None:
+                if not self._is_expired(observed):
+                    return True
+                with self._lock:
+                    table.pop(key, None)
+                    self._modified = True
+        return False
+
+    def record_missing(self, location_WMO, location_WBAN, year):
+        """ Record that the file for that location and year doesn't exist.
+        """
+        key = "%s-%s-%s" % (location_WMO, location_WBAN, year)
+        with self._lock:
+            self.missing[key] = time.time()
+            self._modified = True
+
+    def record_missing_year(self, year):
+        """ Record that no file exists for that year.
+        """
+        with self._lock:
+            self.missing_years[str(year)] = time.time()
+            self._modified = True
+
+    def record_listing(self, year, locations):
+        """ Record the content of the listing of a year on the server: all the
+        stations expected to have data that year and absent from the listing
+        are missing.
+
+        Inputs:
+        - locations, list((int, int)). (WMO code, WBAN code) listed.
+        """
+        listed = set(locations)
+        for location, (first_year, last_year) in self.year_ranges.items():
+            if first_year <= year <= last_year and location not in listed:
+                self.record_missing(location[0], location[1], year)
+
+class DownloadManifest(object):
+    """ Persistent record of the files completely retrieved from the data
+    sources, with their size. A retrieved file is only trusted if it is in
+    the manifest with the same size: a truncated file is never mistaken for
+    a complete one.
+
+    Files the manifest doesn't know (extracted from a yearly archive, or
+    retrieved before the manifest existed) are trusted if no partial download
+    of them is pending.
+    """
+    def __init__(self, filepath = None):
+        if filepath is None:
+            filepath = os.path.join(CACHE_FOLDER, "downloads.json")
+        self.filepath = filepath
+        # Local filepath -> {"size": size in bytes, "retrieved": time,
+        # "remote_date": modification date listed on the server if known}
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._modified = False
+        self.load()
+
+    def _key(self, local_filepath):
+        return os.path.normpath(local_filepath)
+
+    def load(self):
+        if os.path.isfile(self.filepath):
+            with open(self.filepath) as f_in:
+                self.entries = json.load(f_in)
+
+    def save(self):
+        """ Store the manifest on disk if it changed.
+        """
+        with self._lock:
+            if not self._modified:
+                return
+            content = json.dumps(self.entries)
+            self._modified = False
+        folder = os.path.dirname(self.filepath)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with atomic_write(self.filepath, "w") as f_out:
+            f_out.write(content)
+
+    def record(self, local_filepath, size, remote_date = None):
+        """ Record that local_filepath was completely retrieved, and the
+        modification date of the remote file if known.
+        """
+        with self._lock:
+            self.entries[self._key(local_filepath)] = {"size": size,
+                                                       "retrieved": time.time(),
+                                                       "remote_date": remote_date}
+            self._modified = True
+
+    def get(self, local_filepath):
+        """ Entry of local_filepath in the manifest, None if not recorded.
+        """
+        return self.entries.get(self._key(local_filepath))
+
+    def forget(self, local_filepath):
+        with self._lock:
+            if self.entries.pop(self._key(local_filepath), None) is not None:
+                self._modified = True
+
+    def is_complete(self, local_filepath):
+        """ Was local_filepath completely retrieved, and not modified since?
+        """
+        entry = self.entries.get(self._key(local_filepath))
+        return (entry is not None and os.path.isfile(local_filepath) and
+                os.path.getsize(local_filepath) == entry["size"])
+
+    def is_present(self, local_filepath):
+        """ Can local_filepath be used? Files in the manifest must be
+        complete. Other files must exist with no partial download pending.
+        """
+        if self._key(local_filepath) in self.entries:
+            return self.is_complete(local_filepath)
+        return (os.path.isfile(local_filepath) and
+                not os.path.exists(local_filepath + PARTIAL_SUFFIX))
+
+class ListingCache(object):
+    """ Persistent cache of the listings of the yearly folders of the data
+    source (filename -> (size, modification date)), which expire after ttl
+    seconds.
+    """
+    def __init__(self, filepath = None, ttl = LISTINGS_TTL):
+        if filepath is None:
+            filepath = os.path.join(CACHE_FOLDER, "listings.json")
+        self.filepath = filepath
+        self.ttl = ttl
+        # "YEAR" -> {"listed": time, "files": listing}
+        self.listings = {}
+        self._modified = False
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.filepath):
+            return
+        with open(self.filepath) as f_in:
+            self.listings = json.load(f_in)
+
+    def save(self):
+        """ Store the listings on disk if they changed.
+        """
+        if not self._modified:
+            return
+        folder = os.path.dirname(self.filepath)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with atomic_write(self.filepath, "w") as f_out:
+            json.dump(self.listings, f_out)
+        self._modified = False
+
+    def get(self, year):
+        """ Listing of the year if it has not expired, None otherwise.
+        """
+        entry = self.listings.get(str(year))
+        if entry is None or time.time() - entry["listed"] >= self.ttl:
+            return None
+        return dict((filename, tuple(info)) 
+                    for filename, info in entry["files"].items())
+
+    def put(self, year, listing):
+        self.listings[str(year)] = {"listed": time.time(), "files": listing}
+        self._modified = True
+
+class ParsedRecordCache(object):
+    """ Persistent cache of the parsed records of the station files, keyed by
+    (WMO code, WBAN code, year). 
+
+    The records are stored as .npy files of dtype GSOD_RECORD_DTYPE and
+    loaded memory mapped, so a hit costs neither parsing nor copying. An
+    entry is invalid as soon as the size or modification time of the file it
+    was parsed from changes. The cache is limited to max_bytes: the least
+    recently used entries are evicted first.
+    """
+    def __init__(self, folder = None, max_bytes = RECORD_CACHE_MAX_BYTES):
+        if folder is None:
+            folder = os.path.join(CACHE_FOLDER, "records")
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.index_filepath = os.path.join(folder, "index.json")
+        # "WMO-WBAN-YEAR" -> {"source": signature of the source file,
+        # "nbytes": size of the cache file, "last_access": time}
+        self.entries = {}
+        self.nbytes = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def _key(self, location_WMO, location_WBAN, year):
+        return "%06d-%05d-%s" % (location_WMO, location_WBAN, year)
+
+    def _filepath(self, key):
+        return os.path.join(self.folder, key+".npy")
+
+    def load(self):
+        """ Load the index of the cache, dropping the files it doesn't know.
+        """
+        if os.path.isfile(self.index_filepath):
+            with open(self.index_filepath) as f_in:
+                self.entries = json.load(f_in)
+        if not os.path.isdir(self.folder):
+            return
+        known_files = set(key+".npy" for key in self.entries)
+        for filename in os.listdir(self.folder):
+            if filename.endswith(".npy") and filename not in known_files:
+                os.remove(os.path.join(self.folder, filename))
+        for key in self.entries.keys():
+            if not os.path.isfile(self._filepath(key)):
+                del self.entries[key]
+        self.nbytes = sum(entry["nbytes"] for entry in self.entries.values())
+
+    def save(self):
+        """ Store the index of the cache on disk.
+        """
+        if not os.path.isdir(self.folder):
+            return
+        with self._lock:
+            content = json.dumps(self.entries)
+        with atomic_write(self.index_filepath, "w") as f_out:
+            f_out.write(content)
+
+    def has(self, location_WMO, location_WBAN, year):
+        """ Are records cached for that location and year? They may still be
+        invalid if the file they were parsed from changed.
+        """
+        return self._key(location_WMO, location_WBAN, year) in self.entries
+
+    def get(self, location_WMO, location_WBAN, year, source_filepath):
+        """ Get the records parsed from source_filepath for that location and
+        year, memory mapped. Returns None if they are not cached or if the
+        source file changed since.
+        """
+        key = self._key(location_WMO, location_WBAN, year)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry["source"] != file_signature(source_filepath):
+            self._remove(key)
+            return None
+        try:
+            records = np.load(self._filepath(key), mmap_mode = "r")
+        except (IOError, ValueError):
+            records = None
+        if records is None or records.dtype != GSOD_RECORD_DTYPE:
+            # Corrupted or from an older version of the parser
+            self._remove(key)
+            return None
+        with self._lock:
+            entry["last_access"] = time.time()
+        return records
+
+    def put(self, location_WMO, location_WBAN, year, source_filepath, records):
+        """ Store the records parsed from source_filepath for that location
+        and year, evicting the least recently used entries if needed.
+        """
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        key = self._key(location_WMO, location_WBAN, year)
+        filepath = self._filepath(key)
+        with atomic_write(filepath) as f_out:
+            np.save(f_out, np.ascontiguousarray(records))
+        with self._lock:
+            previous = self.entries.get(key)
+            if previous is not None:
+                self.nbytes -= previous["nbytes"]
+            self.entries[key] = {"source": file_signature(source_filepath),
+                                 "nbytes": os.path.getsize(filepath),
+                                 "last_access": time.time()}
+            self.nbytes += self.entries[key]["nbytes"]
+        self.evict()
+
+    def _remove(self, key):
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry["nbytes"]
+        filepath = self._filepath(key)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits in
+        max_bytes.
+        """
+        if self.nbytes <= self.max_bytes:
+            return
+        by_last_access = sorted(self.entries.items(), 
+                                key = lambda item: item[1]["last_access"])
+        for key, entry in by_last_access:
+            if self.nbytes <= self.max_bytes:
+                break
+            self._remove(key)
@@ -1,10 +1,323 @@
 """ Supporting module dealing with retrieving remote files from data sources. 
 """
 
-from urllib import urlretrieve
-import os.path
+from urllib2 import urlopen, Request, HTTPError
+from urlparse import urlparse
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import atexit
+import ftplib
+import json
+import os
+import shutil
+import threading
+import time
 import warnings
 
+from file_sys_util import replace_file
+
+# Root of the remote GSOD data tree for each supported data source
+DATA_SOURCE_URLS = {"NCDC": "ftp://ftp.ncdc.noaa.gov/pub/data/gsod"}
+
+# Default cap on the number of FTP sessions opened to a single server
+MAX_FTP_SESSIONS = 4
+# Number of seconds after which an idle FTP session is pinged to keep it alive
+FTP_KEEPALIVE = 60
+# Number of seconds after which a connection to a server that doesn't
+# respond is given up
+REMOTE_TIMEOUT = 60
+
+# Suffix of the files being retrieved: a file is only moved to its final
+# path once completely retrieved
+PARTIAL_SUFFIX = ".part"
+# Suffix of the description of the remote file (size and modification time)
+# kept next to a partial file: a retrieval is only resumed if the remote file
+# still matches it
+REMOTE_INFO_SUFFIX = ".remote"
+
+class RemoteFileNotFound(IOError):
+    """ The server reported that the requested file doesn't exist.
+    """
+    pass
+
+class FTPSessionPool(object):
+    """ Pool of reusable logged-in ftplib sessions to a single FTP server.
+
+    Sessions are opened on demand up to max_sessions, handed back to the pool
+    after use and reused by the next request, which saves the connect and
+    login round trips. Idle sessions are pinged every keepalive seconds so
+    that the server doesn't drop them, and a session that fails is replaced
+    by a new one.
+    """
+    def __init__(self, host, port = 21, user = "", passwd = "", 
+                 max_sessions = MAX_FTP_SESSIONS, keepalive = FTP_KEEPALIVE,
+                 timeout = REMOTE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.max_sessions = max_sessions
+        self.keepalive = keepalive
+        self.timeout = timeout
+        # Stack of (session, time of last use)
+        self._idle = []
+        self._lock = threading.Lock()
+        # Number of sessions in use or being pinged, at most max_sessions
+        self._in_use = 0
+        self._slot_freed = threading.Condition(self._lock)
+        self._closed = threading.Event()
+        if keepalive:
+            keepalive_thread = threading.Thread(target = self._keepalive_loop)
+            keepalive_thread.daemon = True
+            keepalive_thread.start()
+
+    def _connect(self):
+        session = ftplib.FTP()
+        session.connect(self.host, self.port, self.timeout)
+        if self.user:
+            session.login(self.user, self.passwd)
+        else:
+            session.login()
+        return session
+
+    def _discard(self, session):
+        try:
+            session.close()
+        except ftplib.all_errors:
+            pass
+
+    def _is_alive(self, session):
+        try:
+            session.voidcmd("NOOP")
+            return True
+        except ftplib.all_errors:
+            self._discard(session)
+            return False
+
+    def _release_slot(self):
+        with self._lock:
+            self._in_use -= 1
+            self._slot_freed.notify()
+
+    def resize(self, max_sessions):
+        """ Change the maximum number of sessions in use at once. A lower
+        maximum takes effect as the sessions in use are released.
+        """
+        with self._lock:
+            self.max_sessions = max_sessions
+            self._slot_freed.notify_all()
+
+    def _keepalive_loop(self):
+        while not self._closed.wait(self.keepalive):
+            self.ping_idle()
+
+    def ping_idle(self):
+        """ Ping the sessions idle for more than keepalive seconds and drop
+        the ones the server has closed. A session being pinged counts as a
+        session in use, so that acquire doesn't open new sessions beyond
+        max_sessions meanwhile: the sessions for which there is no free slot
+        are left to be checked by acquire.
+        """
+        now = time.time()
+        stale = []
+        with self._lock:
+            idle = []
+            for session, last_used in self._idle:
+                if (now - last_used >= self.keepalive and
+                    self._in_use < self.max_sessions):
+                    self._in_use += 1
+                    stale.append(session)
+                else:
+                    idle.append((session, last_used))
+            self._idle = idle
+        for session in stale:
+            try:
+                if self._is_alive(session):
+                    with self._lock:
+                        self._idle.append((session, time.time()))
+            finally:
+                self._release_slot()
+
+    def acquire(self):
+        """ Get a logged-in session, waiting if max_sessions are in use. It
+        must be given back with release().
+        """
+        with self._lock:
+            while self._in_use >= self.max_sessions:
+                self._slot_freed.wait()
+            self._in_use += 1
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    session, last_used = self._idle.pop()
+                if (time.time() - last_used < self.keepalive or 
+                    self._is_alive(session)):
+                    return session
+            return self._connect()
+        except:
+            self._release_slot()
+            raise
+
+    def release(self, session, broken = False):
+        """ Give a session back to the pool. Broken sessions are closed.
+        """
+        if broken or self._closed.is_set():
+            self._discard(session)
+        else:
+            with self._lock:
+                self._idle.append((session, time.time()))
+        self._release_slot()
+
+    @contextmanager
+    def session(self):
+        """ Context manager lending a session from the pool.
+        """
+        session = self.acquire()
+        try:
+            yield session
+        except ftplib.all_errors:
+            self.release(session, broken = True)
+            raise
+        except:
+            self.release(session)
+            raise
+        else:
+            self.release(session)
+
+    def remote_size(self, session, remote_path):
+        """ Size of a remote file, None if the server doesn't tell. Raises
+        RemoteFileNotFound if the file doesn't exist on the server.
+        """
+        try:
+            session.voidcmd("TYPE I")
+            return session.size(remote_path)
+        except ftplib.error_perm as e:
+            if str(e).startswith("550"):
+                raise RemoteFileNotFound("Unable to retrieve %s: %s" 
+                                         % (remote_path, e))
+            # SIZE not supported
+            return None
+
+    def remote_info(self, session, remote_path):
+        """ Size and modification time of a remote file, as a dict {"size",
+        "modified"} with None for what the server doesn't tell. Raises
+        RemoteFileNotFound if the file doesn't exist on the server.
+        """
+        size = self.remote_size(session, remote_path)
+        try:
+            modified = session.sendcmd("MDTM %s" % remote_path)[4:].strip()
+        except ftplib.error_perm:
+            # MDTM not supported
+            modified = None
+        return {"size": size, "modified": modified}
+
+    def retrieve(self, remote_path, local_filepath, retries = 1):
+        """ Download the file at remote_path (absolute) into local_filepath.
+        If local_filepath already contains the beginning of the file from an
+        interrupted transfer of the same version of the remote file (same
+        size and modification time, see resume_offset), the transfer resumes
+        after it (REST command). Otherwise it starts from scratch. The
+        transfer is retried on a new session, from where it stopped, if the
+        one used fails. Raises RemoteFileNotFound if the file doesn't exist
+        on the server.
+
+        Returns the size of the remote file reported by the server, None if
+        unknown.
+        """
+        for attempt in range(retries+1):
+            session = self.acquire()
+            offset = 0
+            try:
+                info = self.remote_info(session, remote_path)
+                size = info["size"]
+                offset = resume_offset(local_filepath, info)
+                if size is None or offset < size:
+                    write_remote_info(local_filepath, info)
+                    with open(local_filepath, "ab" if offset else "wb") as f_out:
+                        session.retrbinary("RETR %s" % remote_path, 
+                                           f_out.write, rest = offset or None)
+            except RemoteFileNotFound:
+                self.release(session)
+                raise
+            except ftplib.error_perm as e:
+                self.release(session)
+                if not offset:
+                    # The server refused the file: the session is still usable
+                    raise RemoteFileNotFound("Unable to retrieve %s: %s" 
+                                             % (remote_path, e))
+                # The server can't resume transfers: start over
+                os.remove(local_filepath)
+                if attempt == retries:
+                    raise
+            except ftplib.all_errors:
+                self.release(session, broken = True)
+                if attempt == retries:
+                    raise
+            else:
+                self.release(session)
+                return size
+
+    def close(self):
+        """ Close all idle sessions and stop the keepalive.
+        """
+        self._closed.set()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session, last_used in idle:
+            try:
+                session.quit()
+            except ftplib.all_errors:
+                self._discard(session)
+
+# Pools of FTP sessions shared by all retrievals, by (host, port, user)
+_FTP_POOLS = {}
+_FTP_POOLS_LOCK = threading.Lock()
+
+def get_ftp_pool(host, port = 21, user = "", passwd = "", 
+                 max_sessions = None):
+    """ Get the session pool for an FTP server, creating it the first time
+    with max_sessions sessions (MAX_FTP_SESSIONS by default). If
+    max_sessions is passed, the existing pool is resized to it.
+    """
+    key = (host, port, user)
+    with _FTP_POOLS_LOCK:
+        if key not in _FTP_POOLS:
+            _FTP_POOLS[key] = FTPSessionPool(host, port, user, passwd, 
+                max_sessions = max_sessions or MAX_FTP_SESSIONS)
+        elif max_sessions and _FTP_POOLS[key].max_sessions != max_sessions:
+            _FTP_POOLS[key].resize(max_sessions)
+        return _FTP_POOLS[key]
+
+def ftp_pool_for_url(url, max_sessions = None):
+    """ Get the session pool for the server of an ftp:// URL (see
+    get_ftp_pool).
+    """
+    parsed = urlparse(url)
+    return get_ftp_pool(parsed.hostname, parsed.port or 21, 
+                        parsed.username or "", parsed.password or "",
+                        max_sessions)
+
+@atexit.register
+def close_ftp_pools():
+    """ Log out of all pooled FTP sessions.
+    """
+    with _FTP_POOLS_LOCK:
+        pools = _FTP_POOLS.values()
+        _FTP_POOLS.clear()
+    for pool in pools:
+        pool.close()
+
+@contextmanager
+def ftp_session(data_source = "NCDC", url_base = None):
+    """ Context manager lending a logged-in ftplib session to the server of
+    the data source, taken from the shared session pool.
+    """
+    url = remote_url(data_source, "", url_base)
+    with ftp_pool_for_url(url).session() as session:
+        yield session
+
 def info2filepath(year, location_WMO = None, location_WBAN = None, data_source = 'NCDC'):
     """ Convert a year and location code to a filename where that data is
     stored. If no location is provided, convert the year to the tar file 
@@ -21,21 +334,212 @@ def info2filepath(year, location_WMO = None, location_WBAN = None, data_source =
     else:
         raise NotImplementedError("The data source %s is currently not supported" % data_source)
 
+def filepath2info(filepath):
+    """ Convert the filename of a station file (WMO-WBAN-YEAR.op[.gz]) back
+    into its (WMO code, WBAN code, year).
+    """
+    location_WMO, location_WBAN, year = \
+        os.path.basename(filepath).split(".")[0].split("-")
+    return int(location_WMO), int(location_WBAN), int(year)
 
-def retrieve_file(data_source, remote_target, local_filepath):
-    """ Retrieve a file from a data source. 
+def remote_url(data_source, remote_target, url_base = None):
+    """ Build the full URL of a file on a data source. url_base can be used to
+    point to a different server (a mirror or a local test server) exposing the
+    same tree.
+    """
+    if url_base is None:
+        if data_source not in DATA_SOURCE_URLS:
+            raise NotImplementedError("Unable to retrieve data from %s" % data_source)
+        url_base = DATA_SOURCE_URLS[data_source]
+    return url_base.rstrip("/") + "/" + remote_target
+
+def read_remote_info(local_filepath):
+    """ Description of the remote file stored next to the partial file
+    local_filepath by write_remote_info, None if there is none.
+    """
+    try:
+        with open(local_filepath + REMOTE_INFO_SUFFIX) as f_in:
+            return json.load(f_in)
+    except (IOError, ValueError):
+        return None
+
+def write_remote_info(local_filepath, info):
+    """ Store next to the partial file local_filepath the description of the
+    remote file it is retrieved from (dict {"size", "modified"}).
+    """
+    with open(local_filepath + REMOTE_INFO_SUFFIX, "w") as f_out:
+        json.dump(info, f_out)
+
+def resume_offset(local_filepath, info):
+    """ Number of bytes of the partial file local_filepath after which its
+    retrieval can resume: its size if it was retrieved from the same version
+    of the remote file as the one described by info, 0 otherwise (or if the
+    server doesn't tell enough to check it).
+    """
+    if not os.path.exists(local_filepath):
+        return 0
+    offset = os.path.getsize(local_filepath)
+    known = read_remote_info(local_filepath)
+    if (known is None or info["modified"] is None or known != info or
+        (info["size"] is not None and offset > info["size"])):
+        return 0
+    return offset
+
+def _retrieve_url(url, local_filepath, timeout = REMOTE_TIMEOUT):
+    """ Download a non FTP URL into local_filepath, resuming after its
+    current content if it was retrieved from the same version of the remote
+    file (If-Range on its ETag or Last-Modified date) and the server accepts
+    ranges. Returns the size of the remote file, None if unknown. A server
+    that doesn't respond for timeout seconds raises an IOError.
+    """
+    offset = 0
+    known = read_remote_info(local_filepath)
+    if (os.path.exists(local_filepath) and known is not None and
+        known["modified"] is not None):
+        offset = os.path.getsize(local_filepath)
+    request = Request(url)
+    if offset:
+        request.add_header("Range", "bytes=%s-" % offset)
+        # The range is ignored if the remote file changed since
+        request.add_header("If-Range", known["modified"])
+    try:
+        remote = urlopen(request, timeout = timeout)
+    except HTTPError as e:
+        if e.code == 404:
+            raise RemoteFileNotFound("Unable to retrieve %s: %s" % (url, e))
+        if e.code == 416 and offset:
+            # Nothing after the current content: the file is complete
+            return known["size"]
+        raise
+    try:
+        headers = remote.info()
+        if remote.getcode() != 206:
+            # Range ignored: the whole file is sent
+            offset = 0
+        length = headers.getheader("Content-Length")
+        modified = headers.getheader("ETag")
+        if modified is None or modified.startswith("W/"):
+            # Weak ETags can't be used with If-Range
+            modified = headers.getheader("Last-Modified")
+        size = None if length is None else offset + int(length)
+        write_remote_info(local_filepath, {"size": size,
+                                           "modified": modified})
+        with open(local_filepath, "ab" if offset else "wb") as f_out:
+            shutil.copyfileobj(remote, f_out)
+    finally:
+        remote.close()
+    return size
+
+def _remove_partial(part_filepath):
+    """ Remove a partial file and the description of its remote file.
+    """
+    for filepath in [part_filepath, part_filepath + REMOTE_INFO_SUFFIX]:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+def retrieve_file(data_source, remote_target, local_filepath, url_base = None,
+                  on_missing = None, expected_size = None, manifest = None,
+                  max_sessions = None):
+    """ Retrieve a file from a data source. FTP retrievals go through the
+    shared pool of sessions to the server, resized to max_sessions if
+    provided (see get_ftp_pool).
+
+    The file is retrieved into local_filepath + PARTIAL_SUFFIX and only moved
+    to local_filepath once complete, so local_filepath never holds a
+    truncated file. An interrupted retrieval is resumed by the next one if
+    the remote file hasn't changed since (same size and modification time),
+    and restarted from scratch otherwise. A file already at local_filepath
+    is never resumed: it is replaced by a new copy once it is complete.
+    The size received is checked against expected_size (from a listing of
+    the server) if provided, or against the size reported by the server.
+
+    Returns whether the file was received. If the server reports that the
+    file doesn't exist, on_missing (if provided) is called with
+    remote_target. If a DownloadManifest is passed, the files received are
+    recorded in it.
 
     ENH: Add sniffing capabilities to test what type of connection it is. Use Paramiko if SFTP.
     """
     print "Attempting to retrieve %s from the servers..." % remote_target
-    if data_source == "NCDC":
-        url_base = "ftp://ftp.ncdc.noaa.gov/pub/data/gsod"
-        url = os.path.join(url_base, remote_target)
-        try:
-            received = urlretrieve(url, local_filepath)
-        except IOError as e:
-            received = False
-        if not received:
-            warnings.warn("Failed receiving the file %s from the server." % url)
-    else:
-        raise NotImplementedError("Unable to retrieve data from %s" % data_source)
+    url = remote_url(data_source, remote_target, url_base)
+    part_filepath = local_filepath + PARTIAL_SUFFIX
+    if manifest is not None:
+        manifest.forget(local_filepath)
+    received = False
+    try:
+        if urlparse(url).scheme == "ftp":
+            pool = ftp_pool_for_url(url, max_sessions)
+            size = pool.retrieve(urlparse(url).path, part_filepath)
+        else:
+            size = _retrieve_url(url, part_filepath)
+        if expected_size is not None:
+            size = expected_size
+        received_size = os.path.getsize(part_filepath)
+        if size is None or received_size == size:
+            replace_file(part_filepath, local_filepath)
+            _remove_partial(part_filepath)
+            if manifest is not None:
+                manifest.record(local_filepath, received_size)
+            received = True
+        elif received_size > size:
+            # Corrupted: it will be retrieved from scratch next time
+            _remove_partial(part_filepath)
+        else:
+            warnings.warn("Received %s bytes out of %s for %s: the retrieval"
+                          " will be resumed next time." % (received_size, 
+                                                            size, url))
+    except ftplib.all_errors as e:
+        # Partial content is kept to resume from, unless there is no file
+        if isinstance(e, RemoteFileNotFound):
+            _remove_partial(part_filepath)
+            if on_missing is not None:
+                on_missing(remote_target)
+    if not received:
+        warnings.warn("Failed receiving the file %s from the server." % url)
+    return received
+
+def retrieve_files(data_source, file_list, num_workers = 8, max_per_host = 4,
+                   url_base = None, on_missing = None, expected_sizes = None,
+                   manifest = None):
+    """ Retrieve concurrently a list of files from a data source.
+
+    Inputs:
+    - file_list, list((str, str)). Pairs of (remote_target, local_filepath).
+    - num_workers, int. Maximum number of retrievals in flight.
+    - max_per_host, int. Maximum number of simultaneous connections opened to
+      any one server, whatever the number of workers. The pools of FTP
+      sessions to the servers are sized to it.
+    - expected_sizes, dict. Expected size of the files, by remote_target.
+    - url_base, on_missing, manifest. Same as for retrieve_file. on_missing
+      may be called from several threads at once.
+
+    Returns the list of local filepaths successfully retrieved, in the order
+    of file_list.
+    """
+    if not file_list:
+        return []
+    if expected_sizes is None:
+        expected_sizes = {}
+    host_semaphores = {}
+    lock = threading.Lock()
+
+    def retrieve(file_pair):
+        remote_target, local_filepath = file_pair
+        host = urlparse(remote_url(data_source, remote_target, url_base)).netloc
+        with lock:
+            if host not in host_semaphores:
+                host_semaphores[host] = threading.BoundedSemaphore(max_per_host)
+        with host_semaphores[host]:
+            return retrieve_file(data_source, remote_target, local_filepath,
+                                 url_base, on_missing, 
+                                 expected_sizes.get(remote_target),
+                                 manifest, max_per_host)
+
+    pool = ThreadPool(min(num_workers, len(file_list)))
+    try:
+        received = pool.map(retrieve, file_list)
+    finally:
+        pool.close()
+        pool.join()
+    return [local_filepath for (remote_target, local_filepath), success
+            in zip(file_list, received) if success]
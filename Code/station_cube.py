@@ -0,0 +1,431 @@
+""" Dense container for the data of many stations over a range of dates.
+
+A StationCube stores the values of all the stations in a single contiguous
+3D array (station x date x measurement), optionally memory mapped to a file,
+with the labels of each axis:
+- stations, as "WMO-WBAN" strings,
+- dates, as daily datetime64 values (or the keys of the periods of time
+  once downsampled),
+- measurements, as column names of the GSOD records.
+Missing values are NaN. The columns of the records holding small integers
+(counts of observations, flags and FRSHTT indicators, see gsod_parser) keep
+their compact type: they are stored in a second array of uint8
+(int_values, station x date x int measurement), 0 on the days without a
+record. Labels are converted to positions in constant time
+(dictionaries for stations and measurements, arithmetic for regularly
+spaced dates), and slicing along ranges of labels returns views of the
+values without copying them.
+"""
+
+import datetime
+import numpy as np
+import pandas
+
+from gsod_parser import GSOD_RECORD_DTYPE
+
+def to_day(date):
+    """ Convert a date (datetime, date, datetime64, pandas Timestamp or ISO
+    string) to a datetime64 day.
+    """
+    if hasattr(date, "to_datetime"):
+        date = date.to_datetime()
+    if hasattr(date, "date"):
+        date = date.date()
+    return np.datetime64(date, 'D')
+
+def to_time_labels(dates):
+    """ Convert the labels of the time axis to datetime64 days if they are
+    dates. Other labels (such as the keys of a downsampling) are kept.
+    """
+    dates = np.asarray(dates)
+    if (dates.dtype.kind == "O" and len(dates) and
+        isinstance(dates[0], datetime.date)):
+        dates = dates.astype("M8[us]")
+    if dates.dtype.kind == "M":
+        dates = dates.astype("M8[D]")
+    return dates
+
+def daily_dates(date_start, date_end):
+    """ All the days from date_start to date_end included.
+    """
+    start = to_day(date_start)
+    return start + np.arange((to_day(date_end) - start).astype(int) + 1)
+
+def is_int_type(dtype):
+    """ Are the values of a column of that type stored with the int
+    measurements (booleans and uint8)?
+    """
+    dtype = np.dtype(dtype)
+    return dtype.kind in "bu" and dtype.itemsize == 1
+
+class StationCube(object):
+    """ Values of a set of measurements at a set of stations over a range of
+    dates, stored in a 3D array (station x date x measurement), and of a set
+    of int measurements in a 3D array of uint8 (station x date x int
+    measurement).
+    """
+    def __init__(self, values, stations, dates, measurements,
+                 int_values = None, int_measurements = ()):
+        if values.shape != (len(stations), len(dates), len(measurements)):
+            raise ValueError("The shape of the values %s doesn't match the "
+                             "axes (%s, %s, %s)." % (values.shape,
+                             len(stations), len(dates), len(measurements)))
+        if int_values is None:
+            int_values = np.zeros((len(stations), len(dates),
+                                   len(int_measurements)), dtype = np.uint8)
+        if int_values.shape != (len(stations), len(dates),
+                                len(int_measurements)):
+            raise ValueError("The shape of the int values %s doesn't match "
+                             "the axes (%s, %s, %s)." % (int_values.shape,
+                             len(stations), len(dates), len(int_measurements)))
+        self.values = values
+        self.int_values = int_values
+        self.stations = np.asarray(stations)
+        self.dates = to_time_labels(dates)
+        self.measurements = list(measurements)
+        self.int_measurements = list(int_measurements)
+        self._station_positions = None
+        self._date_positions = None
+        self._measurement_positions = dict((name, j) for j, name
+                                           in enumerate(self.measurements))
+        self._int_positions = dict((name, j) for j, name
+                                   in enumerate(self.int_measurements))
+        # Days, and regularly spaced days: the position of a date is computed
+        self.daily = self.dates.dtype.kind == "M"
+        self._regular = self.daily and (len(self.dates) < 2 or
+                        np.all(np.diff(self.dates).astype(int) == 1))
+
+    @classmethod
+    def empty(cls, stations, dates, measurements, dtype = np.float32,
+              buffer_filepath = None, int_measurements = ()):
+        """ Create a cube filled with NaN (0 for the int measurements). If
+        buffer_filepath is provided, the values are memory mapped to that
+        file (and the int values to buffer_filepath + ".int").
+        """
+        blocks = []
+        for columns, block_dtype, fill, suffix in [
+                (measurements, dtype, np.nan, ""),
+                (int_measurements, np.uint8, 0, ".int")]:
+            shape = (len(stations), len(dates), len(columns))
+            if buffer_filepath is None or not len(columns):
+                block = np.empty(shape, dtype = block_dtype)
+            else:
+                block = np.memmap(buffer_filepath + suffix, mode = "w+",
+                                  dtype = block_dtype, shape = shape)
+            block.fill(fill)
+            blocks.append(block)
+        return cls(blocks[0], stations, dates, measurements, blocks[1],
+                   int_measurements)
+
+    @classmethod
+    def from_frames(cls, frames, dates = None, measurements = None,
+                    buffer_filepath = None):
+        """ Build a cube from a dict of dataframes indexed by date, one per
+        station. dates default to all the days covered by the frames (all the
+        labels of their index if they are not dates) and measurements to the
+        columns of the first frame. Values at dates outside of dates are
+        dropped. The columns of uint8 or booleans of the first frame are
+        stored as int measurements.
+        """
+        stations = sorted(frames.keys())
+        if measurements is None:
+            measurements = (list(frames[stations[0]].columns) if stations
+                            else [])
+        if dates is None:
+            dates = _time_axis([frames[key].index.values for key in stations])
+        int_measurements = [name for name in measurements if stations and
+                            is_int_type(frames[stations[0]][name].dtype)]
+        cube = cls.empty(stations, dates,
+                         [name for name in measurements
+                          if name not in int_measurements],
+                         buffer_filepath = buffer_filepath,
+                         int_measurements = int_measurements)
+        for i, key in enumerate(stations):
+            df = frames[key]
+            positions = cube.date_positions(df.index.values)
+            inside = positions >= 0
+            for name in measurements:
+                cube.column(name)[i, positions[inside]] = \
+                    df[name].values[inside]
+        return cube
+
+    @classmethod
+    def from_records(cls, records, dates = None, measurements = None,
+                     date_col = "YEARMODA", buffer_filepath = None,
+                     record_dtype = GSOD_RECORD_DTYPE):
+        """ Build a cube from a dict of struct arrays of records, one per
+        station, dated by their date_col field. dates default to all the days
+        covered by the records and measurements to the other fields. The
+        fields of uint8 or booleans are stored as int measurements.
+        record_dtype is the type of the records when there is none (GSOD
+        records by default), so that an empty cube has the same measurements
+        and int measurements as one with data.
+
+        All the stations are aligned on the dates in one pass: the position
+        of each record on the daily grid is computed from its date (leap
+        years and missing days included) and its values are scattered into
+        the cube, without building an index per station.
+        """
+        stations = sorted(records.keys())
+        if stations:
+            all_records = np.concatenate([records[key] for key in stations])
+        else:
+            all_records = np.zeros(0, dtype = record_dtype)
+        if measurements is None:
+            measurements = [name for name in all_records.dtype.names
+                            if name != date_col]
+        days = all_records[date_col].astype("M8[D]")
+        if dates is None:
+            if len(days):
+                dates = daily_dates(days.min(), days.max())
+            else:
+                dates = days
+        int_measurements = [name for name in measurements
+                            if name in all_records.dtype.names and
+                            is_int_type(all_records.dtype[name])]
+        cube = cls.empty(stations, dates,
+                         [name for name in measurements
+                          if name not in int_measurements],
+                         buffer_filepath = buffer_filepath,
+                         int_measurements = int_measurements)
+        station_positions = np.repeat(np.arange(len(stations)),
+                                      [len(records[key]) for key in stations])
+        date_positions = cube.date_positions(days)
+        inside = date_positions >= 0
+        station_positions = station_positions[inside]
+        date_positions = date_positions[inside]
+        for name in measurements:
+            if len(all_records):
+                cube.column(name)[station_positions, date_positions] = \
+                    all_records[name][inside]
+        return cube
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def __len__(self):
+        return len(self.stations)
+
+    def __repr__(self):
+        return ("<StationCube: %s stations x %s dates x %s measurements (%s "
+                "int)>" % (self.shape + (len(self.int_measurements),)))
+
+    @property
+    def columns(self):
+        """ Names of all the measurements, the int ones last.
+        """
+        return self.measurements + self.int_measurements
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.int_values.nbytes
+
+    @property
+    def date_index(self):
+        """ Time axis as a pandas index.
+        """
+        if self.daily:
+            return pandas.DatetimeIndex(self.dates.astype("M8[ns]"))
+        return pandas.Index(self.dates)
+
+    def station_position(self, station):
+        """ Position of a station (key "WMO-WBAN").
+        """
+        if self._station_positions is None:
+            self._station_positions = dict((key, i) for i, key
+                                           in enumerate(self.stations.tolist()))
+        return self._station_positions[station]
+
+    def measurement_position(self, measurement):
+        return self._measurement_positions[measurement]
+
+    def column(self, measurement):
+        """ Values of a measurement or int measurement (station x date), as a
+        view of the cube.
+        """
+        if measurement in self._int_positions:
+            return self.int_values[:, :, self._int_positions[measurement]]
+        return self.values[:, :, self._measurement_positions[measurement]]
+
+    def date_positions(self, dates):
+        """ Positions of an array of dates, -1 for the dates not in the cube.
+        """
+        dates = to_time_labels(dates)
+        if len(self.dates) == 0:
+            return np.zeros(len(dates), dtype = np.int64) - 1
+        if self._regular:
+            positions = (dates - self.dates[0]).astype(np.int64)
+            positions[(positions < 0) | (positions >= len(self.dates))] = -1
+            return positions
+        if not self.daily:
+            if self._date_positions is None:
+                self._date_positions = dict((label, i) for i, label
+                                            in enumerate(self.dates.tolist()))
+            return np.array([self._date_positions.get(label, -1)
+                             for label in dates.tolist()], dtype = np.int64)
+        positions = np.searchsorted(self.dates, dates)
+        found = positions < len(self.dates)
+        found[found] = self.dates[positions[found]] == dates[found]
+        return np.where(found, positions, -1)
+
+    def _date_slice(self, date_start = None, date_end = None):
+        """ Slice of the positions of the dates between date_start and
+        date_end included (the dates are sorted).
+        """
+        start, end = 0, len(self.dates)
+        if self.daily:
+            convert = to_day
+        else:
+            convert = lambda label: label
+        if date_start is not None:
+            start = np.searchsorted(self.dates, convert(date_start),
+                                    side = "left")
+        if date_end is not None:
+            end = np.searchsorted(self.dates, convert(date_end),
+                                  side = "right")
+        return slice(start, end)
+
+    def _positions(self, labels, position):
+        """ Index selecting the labels along an axis: a slice (view of the
+        values) when they are contiguous, an array of positions otherwise.
+        """
+        positions = np.array([position(label) for label in labels],
+                             dtype = np.int64)
+        if len(positions) and np.all(np.diff(positions) == 1):
+            return slice(positions[0], positions[-1]+1)
+        return positions
+
+    def sel(self, stations = None, date_start = None, date_end = None,
+            measurements = None):
+        """ Sub-cube for a list of stations, a range of dates (included) and
+        a list of measurements. None selects the whole axis. The values are a
+        view of the values of the cube when the selected labels are
+        contiguous.
+        """
+        if isinstance(stations, basestring):
+            stations = [stations]
+        if isinstance(measurements, basestring):
+            measurements = [measurements]
+        index = [slice(None), self._date_slice(date_start, date_end),
+                 slice(None)]
+        if stations is not None:
+            index[0] = self._positions(stations, self.station_position)
+        int_index = list(index)
+        if measurements is not None:
+            index[2] = self._positions([name for name in measurements
+                                        if name not in self._int_positions],
+                                       self.measurement_position)
+            int_index[2] = self._positions([name for name in measurements
+                                            if name in self._int_positions],
+                                           self._int_positions.__getitem__)
+        stations = self.stations[index[0]]
+        dates = self.dates[index[1]]
+        blocks = []
+        for block, block_index, names in [
+                (self.values, index, self.measurements),
+                (self.int_values, int_index, self.int_measurements)]:
+            names = np.array(names, dtype = object)[block_index[2]].tolist()
+            # Arrays of positions are applied one axis at a time (numpy
+            # would broadcast them together), slices in a single view
+            block_index = list(block_index)
+            for axis in [2, 0]:
+                if not isinstance(block_index[axis], slice):
+                    block = block.take(block_index[axis], axis = axis)
+                    block_index[axis] = slice(None)
+            blocks.append((block[tuple(block_index)], names))
+        (values, measurements), (int_values, int_measurements) = blocks
+        return StationCube(values, stations, dates, measurements, int_values,
+                           int_measurements)
+
+    def station(self, station):
+        """ Dataframe (date x measurement) of a station. Its values are a
+        view of the cube if there are no int measurements, which are
+        appended as uint8 or boolean columns.
+        """
+        i = self.station_position(station)
+        df = pandas.DataFrame(self.values[i], index = self.date_index,
+                              columns = self.measurements)
+        for j, name in enumerate(self.int_measurements):
+            df[name] = self.int_values[i, :, j]
+        return df
+
+    def measurement(self, measurement):
+        """ Dataframe (date x station) of a measurement.
+        """
+        return pandas.DataFrame(self.column(measurement).T,
+                                index = self.date_index,
+                                columns = self.stations)
+
+    def as_float(self):
+        """ Cube with all the measurements as floats, the int measurements
+        last (converted from uint8). The int measurements are NaN on the days
+        without a record, where all the measurements are NaN (the GSOD
+        records keep sentinels for their missing values). The cube itself if
+        it has no int measurements.
+        """
+        if not self.int_measurements:
+            return self
+        int_values = self.int_values.astype(self.values.dtype)
+        if self.measurements:
+            int_values[np.isnan(self.values).all(axis = 2)] = np.nan
+        values = np.concatenate((self.values, int_values), axis = 2)
+        return StationCube(values, self.stations, self.dates, self.columns)
+
+    def iterstations(self):
+        """ Iterate over the (station, dataframe) pairs.
+        """
+        for station in self.stations:
+            yield station, self.station(station)
+
+    def to_panel(self):
+        """ Convert to a pandas Panel (only in the versions of pandas that
+        have it), all the measurements as floats.
+        """
+        cube = self.as_float()
+        return pandas.Panel(cube.values, items = cube.stations,
+                            major_axis = cube.date_index,
+                            minor_axis = cube.measurements)
+
+def _time_axis(indexes):
+    """ Time axis covering a list of indexes: all the days between the first
+    and last dates, or the sorted union of the labels if they are not dates.
+    """
+    labels = [to_time_labels(index) for index in indexes if len(index)]
+    if not labels:
+        return np.array([], dtype = "M8[D]")
+    if labels[0].dtype.kind == "M":
+        return daily_dates(min(label.min() for label in labels),
+                           max(label.max() for label in labels))
+    return np.unique(np.concatenate(labels))
+
+def concat_cubes(cubes, buffer_filepath = None):
+    """ Concatenate cubes along the dates. The stations of the result are
+    the union of the stations of all cubes (NaN where a station is missing
+    from a cube). The measurements and int measurements must be the same.
+    The values are allocated once (memory mapped to buffer_filepath if
+    provided) and each cube is copied once into it.
+    """
+    measurements = cubes[0].measurements
+    int_measurements = cubes[0].int_measurements
+    for cube in cubes[1:]:
+        if (cube.measurements != measurements or
+            cube.int_measurements != int_measurements):
+            raise ValueError("The measurements are not the same in all cubes.")
+    stations = np.unique(np.concatenate([cube.stations for cube in cubes]))
+    dates = np.concatenate([cube.dates for cube in cubes])
+    dtype = np.result_type(*[cube.values.dtype for cube in cubes])
+    result = StationCube.empty(stations, dates, measurements, dtype,
+                               buffer_filepath, int_measurements)
+    start = 0
+    for cube in cubes:
+        end = start + len(cube.dates)
+        positions = np.searchsorted(stations, cube.stations)
+        for target, block in [(result.values, cube.values),
+                              (result.int_values, cube.int_values)]:
+            if len(positions) == len(stations):
+                target[:, start:end] = block
+            else:
+                target[positions, start:end] = block
+        start = end
+    return result
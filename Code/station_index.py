@@ -0,0 +1,355 @@
+""" Indexes over the station metadata (ish-history data) to answer station
+searches without scanning every station.
+
+- Station names are indexed by trigram (inverted index of the lowercase
+names: each sequence of 3 characters maps to the sorted positions of the
+stations whose name contains it) and by sorted order for prefix queries.
+- Code columns (USAF, WBAN, CTRY_WMO, ST, ...) are indexed by sorted order so
+that equality lookups are binary searches.
+- Station coordinates are bucketed into a grid of latitude/longitude cells
+for nearest neighbors, radius and bounding box queries.
+
+The name and code queries return sorted positions in the station table.
+"""
+
+import re
+import sre_constants
+import sre_parse
+
+import numpy as np
+
+from local_cache import ish_year_range
+
+def _required_literals(pattern):
+    """ Extract the strings that any match of a regular expression must
+    contain: the runs of literal characters of its top level sequence.
+    """
+    literals = []
+    current = []
+    for op, av in sre_parse.parse(pattern):
+        if op == sre_constants.LITERAL:
+            current.append(unichr(av) if av > 255 else chr(av))
+        else:
+            literals.append("".join(current))
+            current = []
+    literals.append("".join(current))
+    return [literal for literal in literals if literal]
+
+class StationIndex(object):
+    """ Index over a station table, as returned by read_ish_history.
+    """
+    def __init__(self, location_db):
+        self.location_db = location_db
+        self.names = location_db["STATION_NAME"]
+        self.names_lower = np.char.lower(self.names)
+        self._build_trigrams()
+        # Stations sorted by lowercase name, for prefix queries
+        self._name_order = np.argsort(self.names_lower, kind = "mergesort")
+        self._sorted_names = self.names_lower[self._name_order]
+        # Sorted code columns, built on first use: name -> (order, values)
+        self._sorted_columns = {}
+
+    def __len__(self):
+        return len(self.location_db)
+
+    def _build_trigrams(self):
+        """ Build the inverted index: for each trigram code (3 characters
+        packed in an int) the sorted positions of the names containing it.
+        """
+        num_names = len(self.names_lower)
+        width = self.names_lower.dtype.itemsize
+        if num_names == 0 or width < 3:
+            self._trigram_codes = np.zeros(0, dtype = np.int64)
+            self._trigram_starts = self._trigram_ends = self._trigram_codes
+            self._trigram_rows = np.zeros(0, dtype = np.int64)
+            return
+        chars = self.names_lower.view(np.uint8).reshape(num_names, width)
+        chars = chars.astype(np.int64)
+        codes = (chars[:, :-2] << 16) | (chars[:, 1:-1] << 8) | chars[:, 2:]
+        # Names are padded with null characters
+        valid = chars[:, 2:] != 0
+        rows = np.repeat(np.arange(num_names), width-2).reshape(codes.shape)
+        # Unique (trigram, row) pairs, sorted by trigram then by row
+        pairs = np.unique((codes[valid] << 32) | rows[valid])
+        codes = pairs >> 32
+        self._trigram_rows = pairs & 0xffffffff
+        self._trigram_codes, self._trigram_starts = np.unique(codes,
+                                                       return_index = True)
+        self._trigram_ends = np.append(self._trigram_starts[1:], len(pairs))
+
+    def _trigram_postings(self, text):
+        """ Positions of the names containing all the trigrams of text (3
+        characters or more, lowercase). It is a superset of the names
+        containing text.
+        """
+        codes = set((ord(text[i]) << 16) | (ord(text[i+1]) << 8) | ord(text[i+2])
+                    for i in range(len(text)-2))
+        postings = []
+        for code in codes:
+            i = np.searchsorted(self._trigram_codes, code)
+            if i == len(self._trigram_codes) or self._trigram_codes[i] != code:
+                return np.zeros(0, dtype = np.int64)
+            postings.append(self._trigram_rows[self._trigram_starts[i]:
+                                               self._trigram_ends[i]])
+        postings.sort(key = len)
+        result = postings[0]
+        for posting in postings[1:]:
+            result = np.intersect1d(result, posting, assume_unique = True)
+        return result
+
+    def name_exact(self, name):
+        """ Positions of the stations named exactly name.
+        """
+        return self.equal("STATION_NAME", name)
+
+    def name_contains(self, text):
+        """ Positions of the stations whose name contains text, ignoring
+        case.
+        """
+        text = text.lower()
+        if len(text) < 3:
+            return np.flatnonzero(np.char.find(self.names_lower, text) != -1)
+        candidates = self._trigram_postings(text)
+        found = np.char.find(self.names_lower[candidates], text) != -1
+        return candidates[found]
+
+    def name_prefix(self, prefix):
+        """ Positions of the stations whose name starts with prefix, ignoring
+        case.
+        """
+        prefix = prefix.lower()
+        start = np.searchsorted(self._sorted_names, prefix, side = "left")
+        end = np.searchsorted(self._sorted_names, prefix + "\xff", side = "left")
+        return np.sort(self._name_order[start:end])
+
+    def name_regex(self, pattern):
+        """ Positions of the stations whose name matches the regular
+        expression pattern (anywhere in the name), ignoring case. Only the
+        names containing the literal parts of the pattern are tested.
+        """
+        regex = re.compile(pattern, re.IGNORECASE)
+        candidates = None
+        for literal in _required_literals(pattern):
+            if len(literal) < 3:
+                continue
+            postings = self._trigram_postings(literal.lower())
+            if candidates is None:
+                candidates = postings
+            else:
+                candidates = np.intersect1d(candidates, postings,
+                                            assume_unique = True)
+        if candidates is None:
+            candidates = np.arange(len(self.names))
+        return np.array([i for i in candidates if regex.search(self.names[i])],
+                        dtype = np.int64)
+
+    def equal(self, column, value):
+        """ Positions of the stations whose column is equal to value.
+        """
+        if column not in self._sorted_columns:
+            order = np.argsort(self.location_db[column], kind = "mergesort")
+            self._sorted_columns[column] = (order, self.location_db[column][order])
+        order, sorted_values = self._sorted_columns[column]
+        start = np.searchsorted(sorted_values, value, side = "left")
+        end = np.searchsorted(sorted_values, value, side = "right")
+        return np.sort(order[start:end])
+
+    def search(self, station_name = None, exact_station = False,
+               name_match = "substring", WMO_location = None,
+               WBAN_location = None, country_code = None, state_code = None):
+        """ Positions of the stations matching all the criteria provided. See
+        search_station for the description of the inputs.
+        """
+        selections = []
+        if station_name:
+            if exact_station:
+                selections.append(self.name_exact(station_name))
+            elif name_match == "substring":
+                selections.append(self.name_contains(station_name))
+            elif name_match == "prefix":
+                selections.append(self.name_prefix(station_name))
+            elif name_match == "regex":
+                selections.append(self.name_regex(station_name))
+            else:
+                raise ValueError("Unknown station name matching %s: must be "
+                                 "'substring', 'prefix' or 'regex'."
+                                 % name_match)
+        for column, value in [("USAF", WMO_location), ("WBAN", WBAN_location),
+                              ("CTRY_WMO", country_code), ("ST", state_code)]:
+            if value:
+                selections.append(self.equal(column, value))
+        if not selections:
+            return np.arange(len(self))
+        selections.sort(key = len)
+        result = selections[0]
+        for selection in selections[1:]:
+            result = np.intersect1d(result, selection, assume_unique = True)
+        return result
+
+# The ish-history coordinates are stored in thousandths of a degree
+COORD_SCALE = 1000.
+# Values of the unknown coordinates in the ish-history data
+MISSING_LAT = -99999
+MISSING_LON = -999999
+
+EARTH_RADIUS_KM = 6371.
+
+# Default size of the cells of the spatial index, in degrees
+GRID_CELL_SIZE = 1.
+
+def great_circle_distance(lat1, lon1, lat2, lon2):
+    """ Distance in km between points given by their latitude and longitude
+    in degrees (haversine formula). Arrays are broadcast against each other.
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(x) for x in (lat1, lon1, lat2, lon2)]
+    a = (np.sin((lat2-lat1)/2)**2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2-lon1)/2)**2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.)))
+
+class SpatialIndex(object):
+    """ Grid index over the coordinates of the stations of a station table,
+    as returned by read_ish_history. The stations are bucketed into cells of
+    cell_size x cell_size degrees so that a query only looks at the stations
+    of the cells it overlaps. Stations with unknown coordinates are never
+    returned.
+
+    All queries can be restricted to the stations that have data between
+    year_start and year_end according to the BEGIN and END columns.
+    Stations with an unknown range of years are kept.
+    """
+    def __init__(self, location_db, cell_size = GRID_CELL_SIZE):
+        self.location_db = location_db
+        self.cell_size = cell_size
+        raw_lat = np.asarray(location_db["LAT"])
+        raw_lon = np.asarray(location_db["LON"])
+        self.lat = raw_lat / COORD_SCALE
+        self.lon = raw_lon / COORD_SCALE
+        located = ((raw_lat != MISSING_LAT) & (raw_lon != MISSING_LON) &
+                   (np.abs(self.lat) <= 90) & (np.abs(self.lon) <= 180) &
+                   ~((raw_lat == 0) & (raw_lon == 0)))
+        self.begin, self.end = ish_year_range(location_db)
+
+        self._num_lat_cells = int(np.ceil(180. / cell_size))
+        self._num_lon_cells = int(np.ceil(360. / cell_size))
+        located = np.flatnonzero(located)
+        cells = (self._lat_cells(self.lat[located]) * self._num_lon_cells
+                 + self._lon_cells(self.lon[located]))
+        # Stations sorted by cell, and range of each non empty cell
+        order = np.argsort(cells, kind = "mergesort")
+        self._cell_rows = located[order]
+        self._cell_ids, self._cell_starts = np.unique(cells[order],
+                                                      return_index = True)
+        self._cell_ends = np.append(self._cell_starts[1:], len(order))
+
+    def __len__(self):
+        return len(self._cell_rows)
+
+    def _lat_cells(self, lat):
+        cells = np.floor((np.asarray(lat) + 90) / self.cell_size).astype(np.int64)
+        return np.clip(cells, 0, self._num_lat_cells-1)
+
+    def _lon_cells(self, lon):
+        cells = np.floor((np.asarray(lon) + 180) / self.cell_size).astype(np.int64)
+        return cells % self._num_lon_cells
+
+    def _candidates(self, lat_min, lat_max, lon_min = -180., lon_max = 180.):
+        """ Positions of the stations in the cells overlapping the box. The
+        longitude range goes east from lon_min to lon_max and may cross the
+        180th meridian.
+        """
+        lat_cells = np.arange(self._lat_cells(max(lat_min, -90.)),
+                              self._lat_cells(min(lat_max, 90.))+1)
+        if lon_max < lon_min:
+            lon_max += 360.
+        if lon_max - lon_min >= 360.:
+            lon_cells = np.arange(self._num_lon_cells)
+        else:
+            first = int(np.floor((lon_min + 180) / self.cell_size))
+            last = int(np.floor((lon_max + 180) / self.cell_size))
+            lon_cells = np.unique(np.arange(first, last+1) % self._num_lon_cells)
+        cells = (lat_cells[:, np.newaxis] * self._num_lon_cells
+                 + lon_cells).ravel()
+        i = np.searchsorted(self._cell_ids, cells)
+        found = i < len(self._cell_ids)
+        i = i[found]
+        i = i[self._cell_ids[i] == cells[found]]
+        starts = self._cell_starts[i]
+        lengths = self._cell_ends[i] - starts
+        # Concatenate the ranges of rows of all the cells found
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return self._cell_rows[offsets + np.arange(lengths.sum())]
+
+    def available(self, positions, year_start = None, year_end = None):
+        """ Restrict positions to the stations with data between year_start
+        and year_end (included, open ended if None).
+        """
+        if year_start is None and year_end is None:
+            return positions
+        begin = self.begin[positions]
+        end = self.end[positions]
+        keep = (begin <= 0) | (end <= 0)
+        overlap = np.ones(len(positions), dtype = np.bool_)
+        if year_end is not None:
+            overlap &= begin <= year_end
+        if year_start is not None:
+            overlap &= end >= year_start
+        return positions[keep | overlap]
+
+    def within_radius(self, lat, lon, radius, year_start = None,
+                      year_end = None):
+        """ Stations less than radius km away from the point (lat, lon), in
+        degrees.
+
+        Returns the positions of the stations and their distance to the point,
+        sorted by increasing distance.
+        """
+        angle = radius / EARTH_RADIUS_KM
+        dlat = np.degrees(angle)
+        if angle >= np.pi/2 or abs(lat) + dlat >= 90:
+            # The circle contains a pole: all longitudes are covered
+            candidates = self._candidates(lat-dlat, lat+dlat)
+        else:
+            # Widest longitude span of the circle
+            dlon = np.degrees(np.arcsin(np.sin(angle) /
+                                        np.cos(np.radians(lat))))
+            candidates = self._candidates(lat-dlat, lat+dlat, lon-dlon, lon+dlon)
+        candidates = self.available(candidates, year_start, year_end)
+        distances = great_circle_distance(lat, lon, self.lat[candidates],
+                                          self.lon[candidates])
+        inside = distances <= radius
+        candidates, distances = candidates[inside], distances[inside]
+        order = np.argsort(distances, kind = "mergesort")
+        return candidates[order], distances[order]
+
+    def nearest(self, lat, lon, k = 1, year_start = None, year_end = None):
+        """ The k stations closest to the point (lat, lon), in degrees.
+
+        Returns the positions of the stations and their distance to the point,
+        sorted by increasing distance.
+        """
+        # Start with the size of a cell and double the radius until k
+        # stations are found
+        radius = np.radians(self.cell_size) * EARTH_RADIUS_KM
+        while True:
+            positions, distances = self.within_radius(lat, lon, radius,
+                                                      year_start, year_end)
+            if len(positions) >= k or radius >= np.pi * EARTH_RADIUS_KM:
+                return positions[:k], distances[:k]
+            radius *= 2
+
+    def in_box(self, lat_min, lat_max, lon_min, lon_max, year_start = None,
+               year_end = None):
+        """ Sorted positions of the stations inside the box, in degrees. The
+        longitude range goes east from lon_min to lon_max: lon_min larger than
+        lon_max describes a box crossing the 180th meridian.
+        """
+        candidates = self._candidates(lat_min, lat_max, lon_min, lon_max)
+        candidates = self.available(candidates, year_start, year_end)
+        lat = self.lat[candidates]
+        lon = self.lon[candidates]
+        inside = (lat >= lat_min) & (lat <= lat_max)
+        if lon_min <= lon_max:
+            inside &= (lon >= lon_min) & (lon <= lon_max)
+        else:
+            inside &= (lon >= lon_min) | (lon <= lon_max)
+        return np.sort(candidates[inside])
@@ -0,0 +1,99 @@
+""" Tests of the vectorized GSOD parser against the regex based parsing it
+replaces (pandas.read_table, see benchmark_gsod_parser).
+"""
+
+import unittest
+
+import numpy as np
+import pandas
+
+from benchmark_gsod_parser import synthetic_gsod_file, regex_read_table
+from gsod_parser import parse_gsod_buffer, unpack_frshtt, \
+    FRSHTT_INDICATORS, GSOD_MEASUREMENT_COLS
+
+# Columns of the regex parse holding a single number
+NUMBER_COLS = ['TEMP', 'TEMP-count', 'DEWP', 'DEWP-count', 'SLP', 'SLP-count',
+               'STP', 'STP-count', 'VISIB', 'VISIB-count', 'WDSP',
+               'WDSP-count', 'MXSPD', 'GUST', 'SNDP']
+# Columns of the regex parse with their flag attached (if any)
+FLAGGED_COLS = ['MAX', 'MIN', 'PRCP']
+# Letters of the flag of PRCP
+PRCP_FLAGS = "ABCDEFGHI"
+
+def split_flag(value):
+    """ Split a value parsed by the regex parsing into its number and its flag
+    character (None if there is none).
+    """
+    value = str(value).strip()
+    if value[-1] in "*" + PRCP_FLAGS:
+        return float(value[:-1]), value[-1]
+    return float(value), None
+
+class TestParseGSODBuffer(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        # Over a leap day and more than a year
+        self.content = synthetic_gsod_file(num_days = 800)
+        self.records = parse_gsod_buffer(self.content)
+        self.expected = regex_read_table(self.content)
+
+    def test_layout(self):
+        self.assertEqual(len(self.records), len(self.expected))
+        self.assertEqual(list(self.records.dtype.names),
+                         ['YEARMODA'] + GSOD_MEASUREMENT_COLS)
+
+    def test_dates(self):
+        index = self.expected.index
+        if not isinstance(index, pandas.DatetimeIndex):
+            index = pandas.to_datetime([str(day) for day in index],
+                                       format = "%Y%m%d")
+        np.testing.assert_array_equal(self.records['YEARMODA'],
+                                      index.values.astype('M8[D]'))
+
+    def test_numbers(self):
+        # Negative values and missing value sentinels included
+        self.assertTrue((self.records['TEMP'] < 0).any())
+        self.assertTrue((self.records['STP'] == np.float32(9999.9)).all())
+        self.assertTrue((self.records['GUST'] == np.float32(999.9)).all())
+        for name in NUMBER_COLS:
+            dtype = self.records[name].dtype
+            expected = self.expected[name].values.astype(np.float64)
+            np.testing.assert_array_equal(self.records[name],
+                                          expected.astype(dtype),
+                                          err_msg = name)
+
+    def test_flags(self):
+        for name in FLAGGED_COLS:
+            numbers, flags = zip(*[split_flag(value) for value
+                                   in self.expected[name].values])
+            np.testing.assert_array_equal(self.records[name],
+                                          np.array(numbers, dtype = np.float32),
+                                          err_msg = name)
+            if name == 'PRCP':
+                expected_flags = [0 if flag is None else ord(flag)
+                                  for flag in flags]
+            else:
+                expected_flags = [flag == "*" for flag in flags]
+            np.testing.assert_array_equal(self.records[name+'-flag'],
+                                          expected_flags, err_msg = name)
+        self.assertTrue(self.records['MAX-flag'].all())
+        self.assertFalse(self.records['MIN-flag'].any())
+        self.assertTrue((self.records['PRCP-flag'] == 0).any())
+        self.assertTrue((self.records['PRCP-flag'] != 0).any())
+
+    def test_frshtt(self):
+        # The digits of FRSHTT lose their leading zeros in the regex parsing
+        expected = [int("%06d" % value, 2)
+                    for value in self.expected['FRSHTT'].values]
+        np.testing.assert_array_equal(self.records['FRSHTT'], expected)
+        indicators = unpack_frshtt(self.records['FRSHTT'])
+        self.assertEqual(indicators.shape,
+                         (len(self.records), len(FRSHTT_INDICATORS)))
+        # Only rain is set, every other day
+        rain = FRSHTT_INDICATORS.index('Rain')
+        np.testing.assert_array_equal(indicators[:, rain],
+                                      np.arange(len(self.records)) % 2 == 1)
+        self.assertFalse(np.delete(indicators, rain, axis = 1).any())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+""" Tests of the retrieval of station files, against a local HTTP server
+exposing the same tree as the data source (see url_base).
+"""
+
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from retrieve_remote import retrieve_files, _retrieve_url, PARTIAL_SUFFIX
+
+YEAR = 2012
+STATIONS = [(10010, 99999), (10014, 99999), (725030, 14732), (722950, 23174)]
+MISSING_STATION = (999999, 99999)
+
+class TreeRequestHandler(SimpleHTTPRequestHandler):
+    """ Serve the files under the root folder of the server.
+    """
+    def translate_path(self, path):
+        parts = urlparse(path).path.strip("/").split("/")
+        return os.path.join(self.server.root, *parts)
+
+    def log_message(self, format, *args):
+        pass
+
+class StalledRequestHandler(SimpleHTTPRequestHandler):
+    """ Never answer.
+    """
+    def do_GET(self):
+        self.server.released.wait(10)
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def station_filename(location_WMO, location_WBAN, year = YEAR):
+    return "{0:0>6d}-{1:0>5d}-{2}.op.gz".format(location_WMO, location_WBAN,
+                                               year)
+
+class TestRetrieveFiles(unittest.TestCase):
+    def setUp(self):
+        self.remote_root = tempfile.mkdtemp()
+        self.local_root = tempfile.mkdtemp()
+        year_folder = os.path.join(self.remote_root, str(YEAR))
+        os.mkdir(year_folder)
+        self.contents = {}
+        for location_WMO, location_WBAN in STATIONS:
+            filename = station_filename(location_WMO, location_WBAN)
+            f_out = gzip.open(os.path.join(year_folder, filename), "wb")
+            try:
+                f_out.write("STN--- WBAN   YEARMODA    TEMP\n")
+                f_out.write("%s %s  %s0101    %s\n" % (location_WMO,
+                                                      location_WBAN, YEAR,
+                                                      location_WMO % 97))
+            finally:
+                f_out.close()
+            with open(os.path.join(year_folder, filename), "rb") as f_in:
+                self.contents[filename] = f_in.read()
+
+        self.server = ThreadedHTTPServer(("127.0.0.1", 0), TreeRequestHandler)
+        self.server.root = self.remote_root
+        self.server_thread = threading.Thread(target = self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.url_base = "http://127.0.0.1:%s/" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.remote_root)
+        shutil.rmtree(self.local_root)
+
+    def file_list(self, stations, folder):
+        return [(os.path.join(str(YEAR), station_filename(*station)),
+                 os.path.join(folder, station_filename(*station)))
+                for station in stations]
+
+    def assert_retrieved(self, local_filepaths):
+        for local_filepath in local_filepaths:
+            with open(local_filepath, "rb") as f_in:
+                content = f_in.read()
+            self.assertEqual(content,
+                             self.contents[os.path.basename(local_filepath)])
+            self.assertFalse(os.path.exists(local_filepath + PARTIAL_SUFFIX))
+
+    def test_concurrent_retrieval(self):
+        file_list = self.file_list(STATIONS, self.local_root)
+        retrieved = retrieve_files("NCDC", file_list, num_workers = 4,
+                                   max_per_host = 2, url_base = self.url_base)
+        self.assertEqual(retrieved, [local_filepath for remote_target,
+                                     local_filepath in file_list])
+        self.assert_retrieved(retrieved)
+
+    def test_same_files_as_serial_retrieval(self):
+        serial_folder = os.path.join(self.local_root, "serial")
+        concurrent_folder = os.path.join(self.local_root, "concurrent")
+        os.mkdir(serial_folder)
+        os.mkdir(concurrent_folder)
+        serial = retrieve_files("NCDC", self.file_list(STATIONS, serial_folder),
+                                num_workers = 1, url_base = self.url_base)
+        concurrent = retrieve_files("NCDC",
+                                    self.file_list(STATIONS, concurrent_folder),
+                                    num_workers = 8, url_base = self.url_base)
+        self.assertEqual([os.path.basename(filepath) for filepath in serial],
+                         [os.path.basename(filepath) for filepath in concurrent])
+        self.assert_retrieved(serial + concurrent)
+
+    def test_missing_file(self):
+        missing = []
+        file_list = self.file_list(STATIONS + [MISSING_STATION],
+                                   self.local_root)
+        retrieved = retrieve_files("NCDC", file_list, num_workers = 4,
+                                   url_base = self.url_base,
+                                   on_missing = missing.append)
+        self.assertEqual(len(retrieved), len(STATIONS))
+        self.assert_retrieved(retrieved)
+        self.assertEqual(missing, [file_list[-1][0]])
+        self.assertFalse(os.path.exists(file_list[-1][1]))
+        self.assertFalse(os.path.exists(file_list[-1][1] + PARTIAL_SUFFIX))
+
+class TestStalledServer(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadedHTTPServer(("127.0.0.1", 0),
+                                         StalledRequestHandler)
+        self.server.released = threading.Event()
+        self.server_thread = threading.Thread(target = self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.local_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.released.set()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.local_root)
+
+    def test_timeout(self):
+        url = "http://127.0.0.1:%s/%s/%s" % (self.server.server_address[1],
+                                             YEAR,
+                                             station_filename(*STATIONS[0]))
+        start = time.time()
+        self.assertRaises(IOError, _retrieve_url, url,
+                          os.path.join(self.local_root, "stalled.part"),
+                          timeout = 0.5)
+        self.assertTrue(time.time() - start < 5)
+
+if __name__ == "__main__":
+    unittest.main()